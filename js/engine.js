@@ -1,10 +1,151 @@
 var engine = (function() {
   const battles = {};
+  const snapshots = {};
 
+  // Must match metagrok.utils.to_id
+  const toId = function (s) {
+    return String(s).toLowerCase().replace(/[^a-z0-9+]+/g, '');
+  };
+
+  const CONST_NONE = '+none';
+  const CONST_HIDDEN = '+hidden';
+
+  const POKEMON_KEYS = [
+    'abilities', 'ability', 'baseAbility', 'baseSpecies', 'baseStats', 'boosts', 'details',
+    'fainted', 'gender', 'hp', 'ident', 'item', 'lastmove', 'level', 'maxhp', 'moveTrack', 'name',
+    'prevItem', 'species', 'status', 'statusData', 'types', 'volatiles',
+  ];
+  const ID_KEYS = ['ability', 'baseAbility', 'item', 'prevItem', 'species', 'baseSpecies'];
+
+  // Replaces references to pokemon with their idents, as metagrok.pkmn.engine.core._process does.
+  const plain = function (value) {
+    if (Array.isArray(value)) {
+      return value.map(function (v) {
+        return (v && typeof v === 'object') ? (v.ident || null) : v;
+      });
+    }
+    return value;
+  };
+
+  const plainDict = function (dict) {
+    const rv = {};
+    for (const k of Object.keys(dict || {})) {
+      rv[k] = plain(dict[k]);
+    }
+    return rv;
+  };
+
+  const compactPokemon = function (pokemon) {
+    const rv = {};
+    for (const k of POKEMON_KEYS) {
+      if (Object.prototype.hasOwnProperty.call(pokemon, k) && pokemon[k] !== undefined) {
+        rv[k] = pokemon[k];
+      }
+    }
+
+    rv.moveTrack = (rv.moveTrack || []).map(function (mp) { return [toId(mp[0]), mp[1]]; });
+    rv.status = toId(rv.status || CONST_NONE);
+    for (const k of ID_KEYS) {
+      if (k in rv) {
+        rv[k] = toId(rv[k] || CONST_HIDDEN);
+      }
+    }
+    rv.types = (rv.types || []).map(toId);
+    rv.abilities = {};
+    for (const k of Object.keys(pokemon.abilities || {})) {
+      rv.abilities[k] = toId(pokemon.abilities[k]);
+    }
+    rv.boosts = Object.assign({}, rv.boosts);
+    rv.statusData = Object.assign({}, rv.statusData);
+    rv.volatiles = plainDict(rv.volatiles);
+    return rv;
+  };
+
+  const compactSide = function (side) {
+    const active = side.active.map(function (p) { return p ? p.ident : null; });
+    const actives = new Set(active.filter(function (ident) { return ident; }));
+    const pokemon = side.pokemon.map(function (p) {
+      const rv = compactPokemon(p);
+      // Only the first pokemon with a given ident is marked active (see: Zoroark).
+      rv.active = actives.delete(rv.ident);
+      return rv;
+    });
+
+    return {
+      active: active,
+      id: side.id,
+      n: side.n,
+      name: side.name,
+      pokemon: pokemon,
+      sideConditions: plainDict(side.sideConditions),
+      totalPokemon: side.totalPokemon,
+    };
+  };
+
+  // Only the fields that metagrok's feature extractors and postprocessing read, already free of
+  // cycles and with names normalized to ids.
+  const compact = function (battle) {
+    return {
+      ended: battle.ended,
+      gameType: battle.gameType,
+      pseudoWeather: plain(battle.pseudoWeather),
+      sides: battle.sides.map(compactSide),
+      speciesClause: battle.speciesClause,
+      tier: battle.tier,
+      turn: battle.turn,
+      weather: toId(battle.weather || CONST_NONE),
+      weatherMinTimeLeft: battle.weatherMinTimeLeft,
+      weatherTimeLeft: battle.weatherTimeLeft,
+    };
+  };
+
+  const isDict = function (v) {
+    return v !== null && typeof v === 'object' && !Array.isArray(v);
+  };
+
+  // Appends [path, value] (set) and [path] (delete) operations that turn `prev` into `next`.
+  // `path` is a stack that the walk pushes to and pops from; only the ops get copies of it.
+  const diff = function (prev, next, path, ops) {
+    if (isDict(prev) && isDict(next)) {
+      for (const k of Object.keys(next)) {
+        path.push(k);
+        if (!(k in prev)) {
+          ops.push([path.slice(), next[k]]);
+        } else {
+          diff(prev[k], next[k], path, ops);
+        }
+        path.pop();
+      }
+      for (const k of Object.keys(prev)) {
+        if (!(k in next)) {
+          ops.push([path.concat([k])]);
+        }
+      }
+    } else if (Array.isArray(prev) && Array.isArray(next) && prev.length === next.length) {
+      for (let i = 0; i < next.length; i++) {
+        path.push(i);
+        diff(prev[i], next[i], path, ops);
+        path.pop();
+      }
+    } else if (typeof prev !== 'object' || typeof next !== 'object') {
+      // Most leaves are numbers and strings, which need no serializing to compare.
+      if (prev !== next) {
+        ops.push([path.slice(), next]);
+      }
+    } else if (JSON.stringify(prev) !== JSON.stringify(next)) {
+      ops.push([path.slice(), next]);
+    }
+    return ops;
+  };
+
+  // The calls that change state return true rather than undefined, which newer versions of
+  // py_mini_racer cannot return from MiniRacer.call.
   return {
     start: function (key) {
       battles[key] = new Battle();
       battles[key].play();
+      delete snapshots[key];
+      return true;
     },
 
     transition: function (key, changes) {
@@ -15,17 +156,35 @@ var engine = (function() {
       }
       battle.add(changes);
       battle.fastForwardTo(-1);
+      return true;
     },
 
     fetch: function (key) {
       return JSON.parse(JSON.stringify(JSON.decycle(battles[key])));
     },
 
+    fetchCompact: function (key) {
+      return compact(battles[key]);
+    },
+
+    // Returns {full: state} the first time, then {diff: ops} relative to the previous call.
+    fetchDiff: function (key) {
+      const state = compact(battles[key]);
+      const prev = snapshots[key];
+      snapshots[key] = state;
+      if (!prev) {
+        return {full: state};
+      }
+      return {diff: diff(prev, state, [], [])};
+    },
+
     stop: function (key) {
       battles[key].destroy();
       delete battles[key];
+      delete snapshots[key];
+      return true;
     },
   };
 })();
 
-this.engine = engine;
\ No newline at end of file
+this.engine = engine;
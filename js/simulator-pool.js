@@ -0,0 +1,86 @@
+// Runs many Showdown battles in a single long-lived Node process.
+//
+// Usage: node js/simulator-pool.js <path to the Pokemon-Showdown server directory>
+//
+// Every line on stdin and stdout is prefixed with a battle id and a tab:
+//
+//   stdin:  <bid>\t<message>   a `simulate-battle` input line (e.g. `>p1 move 1`) for battle <bid>
+//           <bid>\t>destroy    tears down battle <bid>
+//   stdout: <bid>\t<line>      one line of output for battle <bid>; an empty <line> terminates a
+//                              message, just like the blank line `simulate-battle` prints.
+//
+// Battles are created on the first message that mentions their id.
+'use strict';
+
+const path = require('path');
+const readline = require('readline');
+
+// Where the compiled simulator lives depends on the Showdown version: .sim-dist/ for early
+// TypeScript builds, dist/sim/ for later ones, and sim/ itself before the move to TypeScript.
+const SIM_DIRS = ['.sim-dist', path.join('dist', 'sim'), 'sim'];
+
+function loadBattleStream(psDir) {
+  for (const dir of SIM_DIRS) {
+    let modulePath;
+    try {
+      modulePath = require.resolve(path.join(psDir, dir, 'battle-stream'));
+    } catch (err) {
+      continue;
+    }
+    return require(modulePath).BattleStream;
+  }
+  throw new Error(`No battle-stream module in ${SIM_DIRS.join(', ')} under ${psDir}`);
+}
+
+const psDir = path.resolve(process.argv[2]);
+const BattleStream = loadBattleStream(psDir);
+
+const battles = new Map();
+
+function emit(bid, chunk) {
+  const lines = chunk.split('\n').map(line => `${bid}\t${line}`);
+  lines.push(`${bid}\t`);
+  process.stdout.write(lines.join('\n') + '\n');
+}
+
+async function pump(bid, stream) {
+  let chunk;
+  while ((chunk = await stream.read())) {
+    emit(bid, chunk);
+  }
+}
+
+function destroy(bid) {
+  const stream = battles.get(bid);
+  if (!stream) return;
+  battles.delete(bid);
+  if (stream.battle) stream.battle.destroy();
+  stream.writeEnd();
+}
+
+const rl = readline.createInterface({input: process.stdin});
+
+rl.on('line', line => {
+  const tab = line.indexOf('\t');
+  if (tab < 0) return;
+  const bid = line.slice(0, tab);
+  const message = line.slice(tab + 1);
+
+  if (message === '>destroy') {
+    destroy(bid);
+    return;
+  }
+
+  let stream = battles.get(bid);
+  if (!stream) {
+    stream = new BattleStream();
+    battles.set(bid, stream);
+    pump(bid, stream).catch(err => {
+      process.stderr.write(`${bid}: ${err.stack}\n`);
+      emit(bid, `error\n${err.message}`);
+    });
+  }
+  stream.write(message);
+});
+
+rl.on('close', () => process.exit(0));
@@ -0,0 +1,108 @@
+'''Batched policy inference for concurrently running battles.
+
+Every player calls `policy.act(state, candidates)` for every decision it makes. When many battles
+run concurrently in one process (as greenlets), those calls can be answered together: each caller
+extracts its own features, then waits while a server greenlet stacks the pending requests and runs
+a single forward pass through the underlying `TorchPolicy`.
+'''
+import logging
+import time
+
+import gevent
+import gevent.event
+import gevent.queue
+
+logger = logging.getLogger(__name__)
+
+class BatchedPolicy(object):
+  '''Wraps a TorchPolicy, answering `act` calls from many greenlets in batched forward passes.
+
+  `act` returns a gevent.event.AsyncResult, which callers (e.g. EnginePkmnPlayer) already know
+  how to wait on. Every caller still receives its own probs, log_probs and value_pred.
+
+  - max_batch_size: the most requests that are evaluated in a single forward pass.
+  - max_wait: once a request is pending, the longest time (in seconds) to wait for more requests
+      before running the forward pass anyway.
+  '''
+  def __init__(self, policy, max_batch_size = 64, max_wait = 0.002):
+    assert max_batch_size >= 1
+    assert max_wait >= 0.
+
+    self.policy = policy
+    self.max_batch_size = max_batch_size
+    self.max_wait = max_wait
+
+    self._queue = gevent.queue.Queue()
+    self._server = None
+
+    self.num_requests = 0
+    self.num_batches = 0
+
+  def extract(self, state, candidates):
+    return self.policy.extract(state, candidates)
+
+  def extract_fingerprint(self):
+    return self.policy.extract_fingerprint()
+
+  def act(self, state, candidates, return_features = False):
+    features = self.policy.extract(state, candidates)
+    rv = gevent.event.AsyncResult()
+    self._queue.put((features, rv, return_features))
+    self._ensure_server()
+    return rv
+
+  def stats(self):
+    return dict(
+        num_requests = self.num_requests,
+        num_batches = self.num_batches,
+        mean_batch_size = float(self.num_requests) / max(1, self.num_batches),
+    )
+
+  def close(self):
+    if self._server is not None:
+      self._server.kill()
+      self._server = None
+
+  def _ensure_server(self):
+    if self._server is None or self._server.dead:
+      self._server = gevent.spawn(self._serve)
+
+  def _serve(self):
+    while True:
+      batch = [self._queue.get()]
+
+      deadline = time.time() + self.max_wait
+      while len(batch) < self.max_batch_size:
+        remaining = deadline - time.time()
+        try:
+          if remaining > 0:
+            batch.append(self._queue.get(timeout = remaining))
+          else:
+            batch.append(self._queue.get_nowait())
+        except gevent.queue.Empty:
+          break
+
+      self._run(batch)
+
+  def _run(self, batch):
+    features_list = [features for features, _, _ in batch]
+    try:
+      results = self.policy.act_batch(features_list)
+    except Exception as e:
+      logger.exception('Batched forward pass failed')
+      for _, rv, _ in batch:
+        rv.set_exception(e)
+      return
+
+    self.num_requests += len(batch)
+    self.num_batches += 1
+    for (features, rv, return_features), result in zip(batch, results):
+      if return_features:
+        result['features'] = features
+      rv.set(result)
+
+  def __getattr__(self, name):
+    # Delegate everything else (e.g. `pkl`, `parameters`) to the underlying policy.
+    if name == 'policy':
+      raise AttributeError(name)
+    return getattr(self.policy, name)
@@ -1,11 +1,18 @@
+import json as stdjson
 import os
 import gzip
 
 from io import StringIO
 
+import numpy as np
+
 from metagrok import np_json as json
 from metagrok import jsons
 from metagrok import fileio
+from metagrok import utils
+
+JSONS_EXT = '.jsons.gz'
+COLUMNAR_EXT = '.cols.npz'
 
 class BattleLogger(object):
   def __init__(self, gid, log_dir = None):
@@ -29,8 +36,234 @@ class BattleLogger(object):
     if self._fd:
       self._fd.close()
 
-def parse(arg, gamma = 1.0, lam = 1.0, reward_shaper = None):
-  states = jsons.load(arg)
+class ColumnarBattleLogger(object):
+  '''Drop-in replacement for BattleLogger that writes `<gid>.cols.npz` (see `load_columnar`).
+
+  Blocks are buffered in memory and written when the logger is closed.
+  '''
+  def __init__(self, gid, log_dir = None):
+    self._fname = None
+    self._blocks = None
+    if log_dir:
+      self._fname = os.path.join(log_dir, gid + COLUMNAR_EXT)
+      self._blocks = []
+
+  def log(self, blob, **kwargs):
+    if self._blocks is not None:
+      blob.update(kwargs)
+      self._blocks.append(blob)
+
+  def result(self, opcode):
+    self.log({}, result = opcode)
+
+  def close(self):
+    if self._blocks is not None:
+      dump_columnar(self._fname, self._blocks)
+      self._blocks = None
+
+LOGGERS = dict(jsons = BattleLogger, columnar = ColumnarBattleLogger)
+
+def find(dirname, gid = '*'):
+  '''Yields one battle log for every player named `gid` under `dirname`.
+
+  A battle logged in both formats (e.g. converted without --delete) is yielded once, as its
+  columnar log.
+  '''
+  columnar = set()
+  for fname in utils.find(dirname, gid + COLUMNAR_EXT):
+    columnar.add(fname)
+    yield fname
+  for fname in utils.find(dirname, gid + JSONS_EXT):
+    if fname[:-len(JSONS_EXT)] + COLUMNAR_EXT not in columnar:
+      yield fname
+
+def load(arg, copy = True):
+  '''Returns the list of blocks in a battle log, in either format.
+
+  Blocks may be modified in place, as `jsons.load` returns them. For columnar logs, read-only
+  callers (e.g. rollups) can pass copy = False to skip copying (see `load_columnar`).
+  '''
+  if isinstance(arg, str) and arg.endswith(COLUMNAR_EXT):
+    return load_columnar(arg, copy = copy)
+  return jsons.load(arg)
+
+def num_blocks(fname):
+  if fname.endswith(COLUMNAR_EXT):
+    with np.load(fname) as npz:
+      return int(npz['num_blocks'])
+  return utils.linecount(fname)
+
+# -----------------------------------------------------------------------------
+# Columnar format
+#
+# A `.cols.npz` file holds one battle log as:
+# - num_blocks: the number of blocks.
+# - col_<key>, has_<key>: for every key whose values are numbers or numpy arrays of a single dtype
+#     and shape, the values stacked into one typed array (has_<key> marks the blocks that have the
+#     key, and is omitted when all of them do).
+# - meta: utf-8 JSON with the remaining keys of every block.
+# - states: utf-8 JSON with the state of every block, each stored as a diff against the previous
+#     one. States come straight from the engine, so they are plain JSON and decode without
+#     np_json's (slow) object hook.
+
+def dump_columnar(fname, blocks):
+  arrays = dict(num_blocks = np.asarray(len(blocks)))
+  columns = set()
+  for key in sorted(set(k for block in blocks for k in block)):
+    if key == 'state':
+      continue
+    present = [key in block for block in blocks]
+    column = _to_column([block[key] for block in blocks if key in block])
+    if column is None:
+      continue
+    columns.add(key)
+    arrays['col_' + key] = column
+    if not all(present):
+      arrays['has_' + key] = np.asarray(present)
+
+  metas = []
+  states = []
+  prev_state = None
+  for block in blocks:
+    metas.append({k: v for k, v in block.items() if k not in columns and k != 'state'})
+    if 'state' not in block:
+      states.append(None)
+    elif prev_state is None:
+      states.append(dict(full = block['state']))
+      prev_state = block['state']
+    else:
+      states.append(dict(diff = _diff(prev_state, block['state'], [], [])))
+      prev_state = block['state']
+
+  arrays['meta'] = _encode_json(metas, json.dumps)
+  arrays['states'] = _encode_json(states, stdjson.dumps)
+
+  # np.savez appends .npz to names that do not end with it.
+  tmp_fname = fname + '.tmp.npz'
+  np.savez_compressed(tmp_fname, **arrays)
+  os.rename(tmp_fname, fname)
+
+def load_columnar(fname, copy = True):
+  '''Reads a `.cols.npz` battle log back into the list of blocks that was logged.
+
+  With copy = False, consecutive states share the parts of their structure that did not change,
+  and array values are views of one array per key, so blocks must be treated as read-only (e.g.
+  transforms.reorder modifies states in place). Replacing a block's top-level values is fine.
+  '''
+  with np.load(fname) as npz:
+    arrays = {k: npz[k] for k in npz.files}
+
+  blocks = _decode_json(arrays.pop('meta'), json.loads)
+  states = _decode_json(arrays.pop('states'), stdjson.loads)
+  assert len(blocks) == int(arrays.pop('num_blocks'))
+
+  for name, column in arrays.items():
+    if not name.startswith('col_'):
+      continue
+    key = name[len('col_'):]
+    present = arrays.get('has_' + key)
+    idxs = range(len(blocks)) if present is None else np.flatnonzero(present)
+    if column.ndim == 1:
+      values = column.tolist()
+    elif copy:
+      values = [row.copy() for row in column]
+    else:
+      values = column
+    for idx, value in zip(idxs, values):
+      blocks[idx][key] = value
+
+  state = None
+  for block, entry in zip(blocks, states):
+    if entry is None:
+      continue
+    if 'full' in entry:
+      state = entry['full']
+    else:
+      state = _patch(state, entry['diff'])
+    # States are plain JSON, which round-trips faster than copy.deepcopy
+    block['state'] = stdjson.loads(stdjson.dumps(state)) if copy else state
+
+  return blocks
+
+def _encode_json(obj, dumps):
+  return np.frombuffer(dumps(obj).encode('utf-8'), dtype = 'uint8')
+
+def _decode_json(arr, loads):
+  return loads(arr.tobytes().decode('utf-8'))
+
+def convert(fname, out_fname = None):
+  '''Converts a `.jsons.gz` battle log to the columnar format.
+
+  Returns (fname, out_fname).
+  '''
+  assert fname.endswith(JSONS_EXT), fname
+  if out_fname is None:
+    out_fname = fname[:-len(JSONS_EXT)] + COLUMNAR_EXT
+  dump_columnar(out_fname, jsons.load(fname))
+  return fname, out_fname
+
+def _to_column(values):
+  if all(isinstance(v, (int, float, np.number)) and not isinstance(v, bool) for v in values):
+    if len(set(type(v) for v in values)) == 1:
+      return np.asarray(values)
+  elif all(isinstance(v, np.ndarray) for v in values):
+    if len(set((v.shape, v.dtype) for v in values)) == 1:
+      return np.stack(values)
+  return None
+
+def _diff(prev, next, path, ops):
+  '''Appends [path, value] (set) and [path] (delete) ops that turn `prev` into `next`.'''
+  if isinstance(prev, dict) and isinstance(next, dict):
+    for k, v in next.items():
+      if k not in prev:
+        ops.append([path + [k], v])
+      else:
+        _diff(prev[k], v, path + [k], ops)
+    for k in prev:
+      if k not in next:
+        ops.append([path + [k]])
+  elif (isinstance(prev, (list, tuple)) and isinstance(next, (list, tuple))
+      and len(prev) == len(next)):
+    for i, (p, n) in enumerate(zip(prev, next)):
+      _diff(p, n, path + [i], ops)
+  elif (isinstance(prev, np.ndarray) or isinstance(next, np.ndarray)
+      or type(prev) is not type(next) or prev != next):
+    ops.append([path, next])
+  return ops
+
+def _patch(obj, ops):
+  '''Applies ops from `_diff` to a copy of `obj`, copying only the containers that change.'''
+  obj = _shallow_copy(obj)
+  copied = set()
+  for op in ops:
+    path = op[0]
+    if not path:
+      obj = op[1]
+      continue
+    parent = obj
+    for i, k in enumerate(path[:-1]):
+      prefix = tuple(path[:i + 1])
+      if prefix not in copied:
+        parent[k] = _shallow_copy(parent[k])
+        copied.add(prefix)
+      parent = parent[k]
+    if len(op) == 1:
+      del parent[path[-1]]
+    else:
+      parent[path[-1]] = op[1]
+  return obj
+
+def _shallow_copy(obj):
+  return dict(obj) if isinstance(obj, dict) else list(obj)
+
+def parse(arg, gamma = 1.0, lam = 1.0, reward_shaper = None, returns = True, copy = True):
+  '''Returns the decision blocks of a battle log, with value_pred, advantage and returns filled in.
+
+  If `returns` is False, advantages and returns are left to the caller (see compute_returns_batch),
+  and the last block's reward is set to the final reward of the battle. Blocks are loaded with
+  `copy` (see `load`); parsing only sets their top-level values.
+  '''
+  states = load(arg, copy = copy)
   result = states[-1]['result']
   if result == 'winner':
     final_reward = 1.0
@@ -43,16 +276,35 @@ def parse(arg, gamma = 1.0, lam = 1.0, reward_shaper = None):
   if reward_shaper:
     reward_shaper(states)
 
-  states = states[:-1]
-  for state in states:
+  states = _drop_stateless(states[:-1])
+  next_value_pred = final_reward
+  for state in reversed(states):
     state['action'] = int(state['action'])
     if 'value_pred' not in state:
-      state['value_pred'] = 0.0
+      # The policy is not run for forced actions (see EnginePkmnPlayer(skip_forced = True)), so
+      # they borrow the value of the state they lead to.
+      state['value_pred'] = next_value_pred if state.get('forced') else 0.0
+    next_value_pred = state['value_pred']
 
-  compute_returns(states, final_reward, gamma, lam)
+  if states:
+    if returns:
+      compute_returns(states, final_reward, gamma, lam)
+    else:
+      states[-1]['reward'] = final_reward
 
   return states
 
+def _drop_stateless(states):
+  '''Drops forced blocks that were logged without a state, folding their rewards into the previous
+  block.'''
+  rv = []
+  for state in states:
+    if 'state' in state or not state.get('forced'):
+      rv.append(state)
+    elif rv and 'reward' in state:
+      rv[-1]['reward'] = rv[-1].get('reward', 0.0) + state['reward']
+  return rv
+
 def compute_returns(path, final_reward, gamma = 0.99, lam = 0.95):
   path[-1]['return'] = final_reward
   path[-1]['std_return'] = final_reward
@@ -67,7 +319,55 @@ def compute_returns(path, final_reward, gamma = 0.99, lam = 0.95):
     cp['return'] = gae + cp['value_pred']
     cp['std_return'] = gamma * np['std_return'] + cp.get('reward', 0.0)
 
+def compute_returns_batch(value_preds, rewards, dones, gamma = 0.99, lam = 0.95):
+  '''Vectorized compute_returns, over the rows of many battles laid end to end.
+
+  `dones` marks the last row of every battle, and the reward of that row is the battle's final
+  reward. Returns a dict of `advantage`, `return` and `std_return` arrays.
+  '''
+  value_preds = np.asarray(value_preds, dtype = np.float64)
+  rewards = np.asarray(rewards, dtype = np.float64)
+  dones = np.asarray(dones, dtype = bool)
+  n = len(value_preds)
+  rv = {k: np.zeros(n) for k in ['advantage', 'return', 'std_return']}
+  if n == 0:
+    return rv
+  assert dones[-1], 'the last row must end a battle'
+
+  # Lay the battles out as the rows of a matrix, padded at the end, and run the recursion over its
+  # columns, for all battles at once.
+  ends = np.flatnonzero(dones) + 1
+  starts = np.concatenate([[0], ends[:-1]])
+  lengths = ends - starts
+  cols = np.arange(n) - np.repeat(starts, lengths)
+  rows = np.repeat(np.arange(len(lengths)), lengths)
+
+  shape = (len(lengths), lengths.max() + 1)
+  vp = np.zeros(shape)
+  vp[rows, cols] = value_preds
+  r = np.zeros(shape)
+  r[rows, cols] = rewards
+  # A battle's last row does not bootstrap from the padding after it.
+  cont = np.zeros(shape)
+  cont[rows, cols] = ~dones
+
+  adv = np.zeros(shape)
+  std_return = np.zeros(shape)
+  for j in reversed(range(shape[1] - 1)):
+    delta = r[:, j] + cont[:, j] * gamma * vp[:, j + 1] - vp[:, j]
+    adv[:, j] = delta + cont[:, j] * gamma * lam * adv[:, j + 1]
+    std_return[:, j] = r[:, j] + cont[:, j] * gamma * std_return[:, j + 1]
+
+  rv['advantage'] = adv[rows, cols]
+  rv['return'] = rv['advantage'] + value_preds
+  rv['std_return'] = std_return[rows, cols]
+  return rv
+
 def result_only(file_name):
+  if file_name.endswith(COLUMNAR_EXT):
+    with np.load(file_name) as npz:
+      return _decode_json(npz['meta'], json.loads)[-1]['result']
+
   with fileio.open(file_name, 'rb') as fd:
     buf = StringIO(fd.read())
 
@@ -1,5 +1,7 @@
-import bisect
+import hashlib
 import logging
+import os
+import shutil
 
 import tqdm
 import numpy as np
@@ -10,6 +12,8 @@ from metagrok import config
 from metagrok import jsons
 from metagrok import np_json as json
 from metagrok import utils
+from metagrok.methods import learner
+from metagrok.torch_utils.data import ConcatNDArrayDictDataset
 
 logger = logging.getLogger(__name__)
 
@@ -21,6 +25,10 @@ class ExampleDataset(Dataset):
   def _get(self, index):
     raise NotImplementedError
 
+  def source_fingerprint(self):
+    '''Returns a digest that changes whenever the examples do (see FeaturizedDataset).'''
+    raise NotImplementedError
+
   def _convert(self, item):
     if self.transform:
       item = self.transform(item)
@@ -57,68 +65,143 @@ class InMemoryStringExampleJsonsDataset(ExampleDataset):
   def _get(self, index):
     return json.loads(self.examples[index])
 
-class ExampleJsonsDataset(Dataset):
+  def source_fingerprint(self):
+    h = hashlib.sha1()
+    for example in self.examples:
+      h.update(example.encode('utf-8') if isinstance(example, str) else example)
+      h.update(b'\n')
+    return h.hexdigest()
+
+class ExampleJsonsDataset(ExampleDataset):
   def __init__(self, fnames, policy, in_memory = False, transform = None):
     """
     Args:
         fnames (string): list of all the file names
         policy (TorchPolicy): transforms the data.
         transform (callable, optional): Optional transform to be applied on a sample.
+
+    Unless in_memory is set, examples are read on demand through an index of every file (see
+    metagrok.jsons.index), which is built the first time a file is used.
     """
-    self.policy = policy
-    self.transform = transform
+    super(ExampleJsonsDataset, self).__init__(policy, transform)
 
-    current = 0
     self.fnames = fnames
 
     self.examples = []
-    self.file_offsets = []
-    for i, fname in enumerate(tqdm.tqdm(self.fnames)):
+    self._raw_fnames = []
+    self._line_offsets = []
+    for fname in tqdm.tqdm(self.fnames):
       if in_memory:
         with open(fname) as fd:
           self.examples.extend(fd)
       else:
-        self.file_offsets.append((current, i))
-        current += utils.linecount(fname)
+        raw_fname, offsets = jsons.index(fname)
+        self._raw_fnames.append(raw_fname)
+        self._line_offsets.append(offsets)
 
     if in_memory:
       self.total = len(self.examples)
     else:
-      self.total = current
+      self.file_offsets = np.cumsum([0] + [len(o) - 1 for o in self._line_offsets])
+      self.total = int(self.file_offsets[-1])
+    self._fds = {}
 
   def __len__(self):
     return self.total
 
-  def __getitem__(self, idx):
-    if self.examples:
-      item = json.loads(self.examples[idx])
-    else:
-      result = bisect.bisect_left(self.file_offsets, (idx, len(self.fnames))) - 1
-      offset, fnames_idx = self.file_offsets[result]
-      fname = self.fnames[fnames_idx]
-      to_go = idx - offset
-      for i, item in enumerate(jsons.stream(fname)):
-        if i == to_go:
-          break
-      else:
-        raise ValueError('offset too high: %s, %s, %s' % (idx, offset, fname))
-
-    if self.transform:
-      item = self.transform(item)
-
-    fs = self.policy.extract(item['state'], item['candidates'])
-    rv = {
-        'actions': np.asarray([item['action']], dtype = config.nt()),
-        'advantages': np.asarray([item['advantage']], dtype = config.nt()),
-        'value_preds': np.asarray([item['value_pred']], dtype = config.nt()),
-        'returns': np.asarray([item['return']], dtype = config.nt()),
-    }
-
-    for k in ['probs', 'log_probs']:
-      if k in item:
-        rv[k] = item[k]
+  def source_fingerprint(self):
+    return utils.fingerprint([
+        (os.path.abspath(fname), os.path.getsize(fname), os.path.getmtime(fname))
+        for fname in self.fnames])
 
-    for k, v in fs.items():
-      rv['features_' + k] = v
+  def __getstate__(self):
+    # File descriptors are opened lazily, in whichever process reads (e.g. DataLoader workers).
+    state = dict(self.__dict__)
+    state['_fds'] = {}
+    return state
 
-    return rv
+  def _get(self, idx):
+    if self.examples:
+      return json.loads(self.examples[idx])
+
+    if idx < 0:
+      idx += self.total
+    if not 0 <= idx < self.total:
+      raise IndexError('index out of range: %s' % idx)
+    file_idx = int(np.searchsorted(self.file_offsets, idx, side = 'right')) - 1
+    if file_idx not in self._fds:
+      self._fds[file_idx] = os.open(self._raw_fnames[file_idx], os.O_RDONLY)
+    line = jsons.read_line(
+        self._fds[file_idx], self._line_offsets[file_idx], idx - self.file_offsets[file_idx])
+    return json.loads(line)
+
+  def __del__(self):
+    for fd in getattr(self, '_fds', {}).values():
+      os.close(fd)
+
+# -----------------------------------------------------------------------------
+# Featurization cache
+#
+# Featurizing an example (parsing its JSON, then running policy.extract) costs far more than
+# training on it. FeaturizedDataset does it once per example and keeps the results in a directory
+# of memory-mapped arrays, laid out like a rollup (see metagrok.methods.learner.save_rollup).
+
+# Bump to invalidate every existing cache when featurization changes in a way that cache_key does
+# not see: e.g. when ExampleDataset._convert changes, or code that the policy's module only reaches
+# indirectly (see TorchPolicy.extract_fingerprint).
+CACHE_VERSION = 1
+
+class FeaturizedDataset(ConcatNDArrayDictDataset):
+  '''Serves the examples of an ExampleDataset from a featurization cache under `cache_root`.
+
+  The cache is keyed on the examples (`dataset.source_fingerprint()`), the policy's extractor
+  (`policy.extract_fingerprint()`) and the transform, including the arguments of a
+  functools.partial and the attributes of a callable object (see utils.fingerprint), and is built
+  on first use; changing any of them, e.g. editing a model's default poke features or the dex,
+  starts a new cache.
+  '''
+  def __init__(self, dataset, cache_root, in_place_shuffle = True):
+    self.dirname = os.path.join(cache_root, cache_key(dataset))
+    if not os.path.isfile(os.path.join(self.dirname, learner.ROLLUP_MANIFEST)):
+      featurize(dataset, self.dirname)
+    else:
+      logger.info('Using featurization cache: %s', self.dirname)
+    super(FeaturizedDataset, self).__init__(
+        [learner.load_rollup(self.dirname)], in_place_shuffle = in_place_shuffle)
+
+def cache_key(dataset):
+  return utils.fingerprint([
+      CACHE_VERSION,
+      dataset.source_fingerprint(),
+      dataset.policy.extract_fingerprint(),
+      dataset.transform,
+  ])
+
+def featurize(dataset, dirname):
+  '''Writes every converted example of `dataset` to a rollup-style directory of .npy files.'''
+  logger.info('Featurizing %d examples into %s', len(dataset), dirname)
+  tmp_dirname = dirname + '.tmp'
+  shutil.rmtree(tmp_dirname, ignore_errors = True)
+  utils.mkdir_p(tmp_dirname)
+
+  arrays = {}
+  for i in tqdm.tqdm(range(len(dataset))):
+    item = {k: np.asarray(v) for k, v in dataset[i].items()}
+    if not arrays:
+      for k, v in item.items():
+        arrays[k] = np.lib.format.open_memmap(
+            os.path.join(tmp_dirname, k + '.npy'), mode = 'w+',
+            dtype = v.dtype, shape = (len(dataset),) + v.shape)
+    assert set(item) == set(arrays), (i, sorted(item), sorted(arrays))
+    for k, v in item.items():
+      arrays[k][i] = v
+
+  type_info = {}
+  for k, v in arrays.items():
+    v.flush()
+    type_info[k] = (v.shape, v.dtype)
+  del arrays
+  learner._write_manifest(tmp_dirname, type_info)
+
+  shutil.rmtree(dirname, ignore_errors = True)
+  os.rename(tmp_dirname, dirname)
@@ -3,7 +3,12 @@ import json
 import logging
 import math
 import os
+import subprocess
+import sys
 import textwrap
+import threading
+
+from six.moves import queue
 
 import gevent
 
@@ -20,12 +25,118 @@ def start(args):
   logger = utils.default_logger_setup(logging.INFO)
   logger.info('Writing to ' + args.outdir)
 
-  config.set_cuda(args.cuda)
-  p1dir = os.path.join(args.outdir, 'p1')
-  p2dir = os.path.join(args.outdir, 'p2')
+  game, policy_1, policy_2 = _setup(args)
 
-  utils.mkdir_p(p1dir)
-  utils.mkdir_p(p2dir)
+  wins = [0, 0]
+
+  logger.info('starting...')
+  num_played = 0
+  for i in range(args.num_matches):
+    result = _play(args, game, policy_1, policy_2, i)
+    num_played += 1
+    if result == 'winner':
+      wins[0] += 1
+    elif result == 'loser':
+      wins[1] += 1
+
+    if should_stop(wins[0], num_played, args):
+      logger.info('Stopping early after %d matches (z = %s)',
+          num_played, z_score(wins[0], num_played)[2])
+      break
+
+  return wins, num_played
+
+def start_parallel(args):
+  '''Like `start`, but plays matches in `args.parallelism` worker processes.
+
+  Each worker is this script, run with --worker. Matches are handed out one at a time, so results
+  are aggregated as they come in and the evaluation can stop as soon as it is significant.
+  '''
+  logger = utils.default_logger_setup(logging.INFO)
+  logger.info('Writing to %s with %d workers', args.outdir, args.parallelism)
+
+  worker_args = ['./rp', 'metagrok/exe/head2head.py', '--worker',
+      '--p1', args.p1,
+      '--p2', args.p2,
+      '--outdir', args.outdir,
+      '--format', args.format]
+  if args.play_best_move:
+    worker_args.extend(['--play-best-move', args.play_best_move])
+  if args.cuda:
+    worker_args.append('--cuda')
+
+  results = queue.Queue()
+  def read_results(wid, worker):
+    for line in worker.stdout:
+      results.put((wid, line))
+    results.put((wid, None))
+
+  env = os.environ.copy()
+  env['OMP_NUM_THREADS'] = '1'
+  env['MKL_NUM_THREADS'] = '1'
+  workers = []
+  for wid in range(args.parallelism):
+    worker = subprocess.Popen(worker_args, stdin = subprocess.PIPE, stdout = subprocess.PIPE,
+        env = env, encoding = 'utf-8', bufsize = 1)
+    reader = threading.Thread(target = read_results, args = (wid, worker))
+    reader.daemon = True
+    reader.start()
+    workers.append(worker)
+
+  next_match = 0
+  for worker in workers:
+    if next_match < args.num_matches:
+      worker.stdin.write('%d\n' % next_match)
+      next_match += 1
+
+  wins = [0, 0]
+  num_played = 0
+  while num_played < next_match:
+    wid, line = results.get()
+    if line is None:
+      raise RuntimeError('Worker %d exited unexpectedly' % wid)
+    _, result = line.split()
+    num_played += 1
+    if result == 'winner':
+      wins[0] += 1
+    elif result == 'loser':
+      wins[1] += 1
+    else:
+      assert result == 'tie', result
+
+    if num_played % 10 == 0:
+      logger.info('[%d/%d] p1 wins: %d, p2 wins: %d, z = %s',
+          num_played, args.num_matches, wins[0], wins[1], z_score(wins[0], num_played)[2])
+
+    if should_stop(wins[0], num_played, args):
+      logger.info('Stopping early after %d matches (z = %s)',
+          num_played, z_score(wins[0], num_played)[2])
+      break
+
+    if next_match < args.num_matches:
+      workers[wid].stdin.write('%d\n' % next_match)
+      next_match += 1
+
+  # Matches still in flight after an early stop are abandoned.
+  for worker in workers:
+    worker.kill()
+    worker.wait()
+
+  return wins, num_played
+
+def run_worker(args):
+  '''Plays the match numbers read from stdin, printing `<match number> <p1 result>` for each.'''
+  game, policy_1, policy_2 = _setup(args)
+  for line in iter(sys.stdin.readline, ''):
+    i = int(line)
+    result = _play(args, game, policy_1, policy_2, i)
+    sys.stdout.write('%d\t%s\n' % (i, result))
+    sys.stdout.flush()
+
+def _setup(args):
+  config.set_cuda(args.cuda)
+  utils.mkdir_p(os.path.join(args.outdir, 'p1'))
+  utils.mkdir_p(os.path.join(args.outdir, 'p2'))
 
   prog = os.path.join(
       config.get('showdown_root'),
@@ -36,33 +147,39 @@ def start(args):
 
   policy_1 = torch_policy.load(args.p1)
   policy_2 = torch_policy.load(args.p2)
+  return game, policy_1, policy_2
 
-  wins = [0, 0]
+def _play(args, game, policy_1, policy_2, i):
+  '''Plays match `i`, logs it, and returns p1's result.'''
+  p1 = EnginePkmnPlayer(policy_1, '%s-p1' % i,
+    play_best_move = args.play_best_move in ['p1', 'both'])
+  p2 = EnginePkmnPlayer(policy_2, '%s-p2' % i,
+    play_best_move = args.play_best_move in ['p2', 'both'])
+  game.play(p1, p2)
 
-  logger.info('starting...')
-  # TODO: make multithreaded. Maybe integrate this with RL experiment
-  for i in range(args.num_matches):
-    p1 = EnginePkmnPlayer(policy_1, '%s-p1' % i,
-      play_best_move = args.play_best_move in ['p1', 'both'])
-    p2 = EnginePkmnPlayer(policy_2, '%s-p2' % i,
-      play_best_move = args.play_best_move in ['p2', 'both'])
-    game.play(p1, p2)
+  for player, dirname in [(p1, 'p1'), (p2, 'p2')]:
+    bogger = battlelogs.BattleLogger(player.gid, os.path.join(args.outdir, dirname))
+    for block in player.blocks:
+      bogger.log(block)
+    bogger.close()
 
-    for j in [0, 1]:
-      player = [p1, p2][j]
-      dirname = [p1dir, p2dir][j]
+    assert player.result in ['winner', 'loser', 'tie']
 
-      bogger = battlelogs.BattleLogger(player.gid, dirname)
-      for block in player.blocks:
-        bogger.log(block)
-      bogger.close()
+  return p1.result
 
-      if player.result == 'winner':
-        wins[j] += 1
-      else:
-        assert player.result in ['loser', 'tie']
+def z_score(p1wins, num_matches):
+  '''Returns (mean, sem, z) for the hypothesis that p1 wins half of its matches.'''
+  mean = float(p1wins) / num_matches
+  var = mean * (1. - mean)
+  sem = math.sqrt(var / num_matches)
+  z = (mean - 0.5) / (1e-8 + sem)
+  return mean, sem, z
 
-  return wins
+def should_stop(p1wins, num_played, args):
+  if args.z_threshold is None or num_played < args.min_matches:
+    return False
+  _, _, z = z_score(p1wins, num_played)
+  return abs(z) >= args.z_threshold
 
 def parse_args():
   parser = argparse.ArgumentParser()
@@ -74,10 +191,21 @@ def parse_args():
   parser.add_argument('--progress-type', choices = ['bar', 'log'], default = 'log')
   parser.add_argument('--format', default = 'gen7randombattle')
   parser.add_argument('--cuda', action = 'store_true')
+  parser.add_argument('--parallelism', type = int, default = 1,
+      help = 'Number of worker processes to play matches in.')
+  parser.add_argument('--z-threshold', type = float,
+      help = 'Stop as soon as the absolute z-score reaches this value.')
+  parser.add_argument('--min-matches', type = int, default = 100,
+      help = 'Never stop early before this many matches have been played.')
+  parser.add_argument('--worker', action = 'store_true', help = argparse.SUPPRESS)
   return parser.parse_args()
 
 def main():
   args = parse_args()
+  if args.worker:
+    gevent.spawn(run_worker, args).get()
+    return
+
   utils.mkdir_p(args.outdir)
 
   params = vars(args)
@@ -86,19 +214,21 @@ def main():
   with open(os.path.join(args.outdir, 'args.json'), 'w') as fd:
     json.dump(params, fd)
 
-  p1wins, p2wins = gevent.spawn(start, parse_args()).get()
+  if args.parallelism > 1:
+    (p1wins, p2wins), num_played = start_parallel(args)
+  else:
+    (p1wins, p2wins), num_played = gevent.spawn(start, parse_args()).get()
 
   subject = 'head2head evaluation finished: ' + args.outdir
 
-  mean = float(p1wins) / args.num_matches
-  var = mean * (1. - mean)
-  sem = math.sqrt(var / args.num_matches)
-  z = (mean - 0.5) / (1e-8 + sem)
+  mean, sem, z = z_score(p1wins, num_played)
 
-  fmt_args = (args.p1, p1wins, args.p2, p2wins, mean, sem, z, json.dumps(params, indent = 2))
+  fmt_args = (
+      num_played, args.p1, p1wins, args.p2, p2wins, mean, sem, z, json.dumps(params, indent = 2))
 
   text = textwrap.dedent('''\
   Results:
+    num matches: %s
     p1 (%s) num wins: %s
     p2 (%s) num wins: %s
 
@@ -3,6 +3,7 @@ import shutil
 import subprocess
 import sys
 
+from metagrok import config
 from metagrok import utils
 from metagrok import np_json as json
 from metagrok import integrated_rl
@@ -15,6 +16,13 @@ def main():
   utils.mkdir_p(args.base_dir)
   expt = json.load(args.expt_name)
 
+  # With --in-process, iterations run in this process and share one pool of simulate workers,
+  # which load each new policy in place instead of being restarted.
+  worker_pool = None
+  if args.in_process:
+    config.set_cuda(args.cuda)
+    worker_pool = integrated_rl.WorkerPool(expt, args.parallelism)
+
   last_iter = None
   while True:
     current_iter = integrated_rl.divine_current_iteration(args.base_dir)
@@ -28,14 +36,24 @@ def main():
 
     if current_iter >= expt['num_iters']:
       break
-    cmd = ['./rp', 'metagrok/integrated_rl.py']
-    cmd.extend(sys.argv[1:])
-    logger.info('Running command: %s', cmd)
-    subprocess.check_call(cmd, stdout = sys.stdout, stderr = sys.stderr)
+    if worker_pool:
+      integrated_rl.run('run_one_iteration', args.expt_name, args.base_dir, args.parallelism,
+          args.cuda, worker_pool = worker_pool)
+    else:
+      cmd = ['./rp', 'metagrok/integrated_rl.py']
+      cmd.extend(a for a in sys.argv[1:] if a != '--in-process')
+      logger.info('Running command: %s', cmd)
+      subprocess.check_call(cmd, stdout = sys.stdout, stderr = sys.stderr)
+
+    # The pool's workers keep their logs and shared weights open across iterations, so leave /tmp
+    # alone while it is running.
+    if not worker_pool:
+      logger.info('Evicting /tmp directory')
+      shutil.rmtree('/tmp')
+      utils.mkdir_p('/tmp')
 
-    logger.info('Evicting /tmp directory')
-    shutil.rmtree('/tmp')
-    utils.mkdir_p('/tmp')
+  if worker_pool:
+    worker_pool.close()
 
   logger.info('Done!')
 
@@ -46,6 +64,8 @@ def parse_args():
   parser.add_argument('base_dir')
   parser.add_argument('--cuda', action = 'store_true')
   parser.add_argument('--parallelism', type = int, default = mp.cpu_count())
+  parser.add_argument('--in-process', action = 'store_true',
+      help = 'Run iterations in this process, reusing simulate workers across iterations.')
 
   return parser.parse_args()
 
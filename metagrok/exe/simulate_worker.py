@@ -1,6 +1,11 @@
+from metagrok import predef as _; assert _
+
 import os
 import sys
-import time
+
+import gevent
+import gevent.fileobject
+import gevent.queue
 
 from metagrok import battlelogs
 from metagrok import config
@@ -8,8 +13,11 @@ from metagrok import formats
 from metagrok import utils
 from metagrok import torch_policy
 from metagrok import np_json as json
+from metagrok.batch_inference import BatchedPolicy
+from metagrok.showdown_stdio import SimulatorPool
 
 from metagrok.pkmn.games import Game
+from metagrok.pkmn.engine import player as engine_player
 from metagrok.pkmn.engine.player import EnginePkmnPlayer
 
 def main():
@@ -21,40 +29,94 @@ def main():
 
   p1_policy = torch_policy.load(args.policy_tag)
   p2_policy = p1_policy
+  # The unwrapped policy, for `load` commands.
+  learner_policy = p1_policy
   if args.p2_policy_tag:
     p2_policy = torch_policy.load(args.p2_policy_tag)
 
+  if args.max_batch_size > 1:
+    batched = BatchedPolicy(p1_policy, args.max_batch_size, args.max_batch_wait)
+    if p2_policy is p1_policy:
+      p1_policy = p2_policy = batched
+    else:
+      p1_policy = batched
+      p2_policy = BatchedPolicy(p2_policy, args.max_batch_size, args.max_batch_wait)
+
+  engine_player.set_num_engines(args.num_engines)
+  engine_player.set_fetch_mode(args.fetch_mode)
+
   fmt = formats.get(args.fmt)
-  game = Game(fmt, '{}/{}/pokemon-showdown'.format(
+  prog = '{}/{}/pokemon-showdown'.format(
       config.get('showdown_root'),
-      config.get('showdown_server_dir')))
-  count = 0
-  while True:
-    time.sleep(0.1)
+      config.get('showdown_server_dir'))
+  pool = None
+  if args.simulator_pool:
+    pool = SimulatorPool(prog)
+  game = Game(fmt, prog, pool = pool)
 
-    r = sys.stdin.readline().strip()
+  # Each battle runs in its own greenlet. While one battle waits on its simulator subprocess, the
+  # others can use the CPU for feature extraction and inference.
+  queue = gevent.queue.JoinableQueue()
+  runners = [
+      gevent.spawn(_run_battles, queue, game, p1_policy, p2_policy, args)
+      for _ in range(args.concurrent_battles)]
 
+  # Commands:
+  # - battle: play one more battle
+  # - load <policy tag>: once every pending battle is done, load new weights into the p1 policy
+  # - done: finish pending battles and exit
+  count = 0
+  stdin = gevent.fileobject.FileObject(sys.stdin, 'r')
+  for line in stdin:
+    r = line.strip()
     if r == 'done':
       break
+    elif r.startswith('load '):
+      queue.join()
+      torch_policy.load_state(learner_policy, r[len('load '):])
+      continue
+    queue.put(count)
+    count += 1
+
+  for _ in runners:
+    queue.put(None)
+  gevent.joinall(runners, raise_error = True)
+
+  if pool:
+    pool.close()
+
+  sys.stderr.write('engine stats: %s\n' % json.dumps(engine_player.engine_stats()))
+
+def _run_battles(queue, game, p1_policy, p2_policy, args):
+  while True:
+    count = queue.get()
+    if count is None:
+      queue.task_done()
+      break
 
     battle_dir = os.path.join('/tmp', args.id, '%06d' % count)
     utils.mkdir_p(battle_dir)
 
-    p1 = EnginePkmnPlayer(p1_policy, 'p1', epsilon = args.epsilon)
-    p2 = EnginePkmnPlayer(p2_policy, 'p2', epsilon = args.epsilon)
+    # Player gids are shared by every battle in the process, so they must be unique.
+    p1 = EnginePkmnPlayer(p1_policy, '%06d-p1' % count, epsilon = args.epsilon,
+        persist_features = args.persist_features,
+        skip_forced = args.skip_forced, log_forced_state = not args.no_forced_state)
+    p2 = EnginePkmnPlayer(p2_policy, '%06d-p2' % count, epsilon = args.epsilon,
+        persist_features = args.persist_features,
+        skip_forced = args.skip_forced, log_forced_state = not args.no_forced_state)
     game.play(p1, p2)
 
     num_blocks = 0
     for i, player in enumerate([p1, p2]):
-      blogger = battlelogs.BattleLogger('p%d' % (i + 1), battle_dir)
+      blogger = battlelogs.LOGGERS[args.log_format]('p%d' % (i + 1), battle_dir)
       for block in player.blocks:
         blogger.log(block)
         num_blocks += 1
       blogger.close()
-    count += 1
 
     sys.stdout.write('%s\t%d\n' % (battle_dir, num_blocks))
     sys.stdout.flush()
+    queue.task_done()
 
 def parse_args():
   import argparse
@@ -64,6 +126,26 @@ def parse_args():
   parser.add_argument('id')
   parser.add_argument('--p2-policy-tag')
   parser.add_argument('--epsilon', type = float, default = 0.)
+  parser.add_argument('--max-batch-size', type = int, default = 1,
+      help = 'Batch concurrent policy evaluations into forward passes of up to this size.')
+  parser.add_argument('--max-batch-wait', type = float, default = 0.002,
+      help = 'Seconds to wait for more requests before running a partial batch.')
+  parser.add_argument('--concurrent-battles', type = int, default = 1,
+      help = 'Number of battles to run concurrently.')
+  parser.add_argument('--fetch-mode', choices = ['full', 'compact', 'diff'], default = 'full',
+      help = 'How state is fetched from the JS engine (see metagrok.pkmn.engine.core).')
+  parser.add_argument('--num-engines', type = int, default = 1,
+      help = 'Number of JS engines (V8 contexts) to spread concurrent battles over.')
+  parser.add_argument('--simulator-pool', action = 'store_true',
+      help = 'Simulate all battles in one long-lived Node process instead of one per battle.')
+  parser.add_argument('--log-format', choices = sorted(battlelogs.LOGGERS), default = 'jsons',
+      help = 'Battle log format (see metagrok.battlelogs).')
+  parser.add_argument('--persist-features', action = 'store_true',
+      help = 'Log the extracted features with every block, so that rollup can skip extraction.')
+  parser.add_argument('--skip-forced', action = 'store_true',
+      help = 'Play forced actions (only one legal candidate) without running the policy.')
+  parser.add_argument('--no-forced-state', action = 'store_true',
+      help = 'With --skip-forced, do not fetch or log the state for forced actions either.')
   return parser.parse_args()
 
 if __name__ == '__main__':
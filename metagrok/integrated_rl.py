@@ -4,13 +4,17 @@ import logging
 import multiprocessing as mp
 import numpy as np
 import os
+import selectors
 import shutil
 import six
 import subprocess
 import sys
+import tempfile
 import time
 import threading
 import torch
+import torch.distributed as dist
+import zipfile
 
 from metagrok import battlelogs
 from metagrok import config
@@ -23,16 +27,17 @@ from metagrok import utils
 
 from metagrok.scheduler import Scheduler
 from metagrok.methods import learner
+from metagrok.methods import updater
 
 from metagrok.pkmn.games import Game
 from metagrok.pkmn import reward_shaper
 from metagrok.pkmn.engine.player import EnginePkmnPlayer
 
-from metagrok.torch_utils.data import TTensorDictDataset
+from metagrok.torch_utils.data import ConcatNDArrayDictDataset
 from metagrok.torch_utils import debug as dbg
 
 
-def simulate_and_rollup(expt_name, base_dir, parallelism, cuda):
+def simulate_and_rollup(expt_name, base_dir, parallelism, cuda, worker_pool = None):
   logger = logging.getLogger('simulate_and_rollup')
 
   expt = json.load(expt_name)
@@ -53,8 +58,7 @@ def simulate_and_rollup(expt_name, base_dir, parallelism, cuda):
     if torch.isnan(param).any().item():
       raise ValueError('Encountered nan in latest model in parameter ' + name)
 
-  rollup_fname = os.path.join(iter_dir, 'rollup.npz')
-  assert not os.path.isfile(rollup_fname), 'rollup detected means matches already simulated'
+  assert not learner.find_rollup(iter_dir), 'rollup detected means matches already simulated'
 
   battles_dir = os.path.join(iter_dir, 'battles')
   utils.mkdir_p(battles_dir)
@@ -65,88 +69,99 @@ def simulate_and_rollup(expt_name, base_dir, parallelism, cuda):
   total_matches = expt['simulate_args']['num_matches']
   num_battles_remaining = total_matches - num_battles
   logger.info('%d battles left to simulate for this iteration', num_battles_remaining)
+
+  # With rollup_workers set, battles are rolled up (and zipped) as soon as they finish, so that
+  # rollup overlaps with simulation instead of running after it.
+  streaming = None
+  rollup_workers = expt['simulate_args'].get('rollup_workers', 0)
+  if rollup_workers:
+    streaming = start_streaming_rollup(expt, iter_dir, policy, rollup_workers)
+    for d in sorted(glob.glob(os.path.join(battles_dir, '*'))):
+      if len(os.listdir(d)) == 2:
+        streaming.add(d)
+
   if num_battles_remaining:
     start_time = time.time()
 
-    def spawn_battler(bid):
-      tag = str(bid)
-      logger.info('Spawn battler with ID %s', bid)
-      env = os.environ.copy()
-      env['OMP_NUM_THREADS'] = '1'
-      env['MKL_NUM_THREADS'] = '1'
-      err_fd = open('/tmp/%03d.err.log' % bid, 'w')
-      args = ['./rp', 'metagrok/exe/simulate_worker.py',
-        policy_tag,
-        expt.get('format', 'gen7randombattle'),
-        str(bid),
-      ]
-      if 'epsilon' in expt['simulate_args']:
-        args.append('--epsilon')
-        args.append(str(expt['simulate_args']['epsilon']))
-      if 'p2' in expt['simulate_args']:
-        args.append('--p2-policy-tag')
-        args.append(str(expt['simulate_args']['p2']))
-      rv = subprocess.Popen(
-        args,
-        stdout = subprocess.PIPE,
-        stdin = subprocess.PIPE,
-        stderr = err_fd,
-        env = env,
-        encoding = 'utf-8',
-        bufsize = 0,
-      )
-      os.system('taskset -p -c %d %d' % (bid % mp.cpu_count(), rv.pid))
-      return rv, err_fd
-
     num_blocks = 0
     battle_number = num_battles
+    num_assigned = 0
+
+    pool = worker_pool or WorkerPool(expt, parallelism)
+    workers = pool.acquire(policy_tag)
+
+    # Battles are handed out on demand: every worker starts with as many as it runs concurrently,
+    # and gets another one each time it reports a finished battle. This way a worker that happens
+    # to draw long battles never holds up the others at the end of the iteration.
+    per_worker = max(1, expt['simulate_args'].get('concurrent_battles', 1))
+
+    selector = selectors.DefaultSelector()
+    partial_lines = {}
+    for w in workers:
+      for _ in range(per_worker):
+        if num_assigned < num_battles_remaining:
+          w.stdin.write('battle\n')
+          num_assigned += 1
+      selector.register(w.stdout.fileno(), selectors.EVENT_READ, w)
+      partial_lines[w] = b''
 
-    workers, fds = list(zip(*[spawn_battler(i) for i in range(parallelism)]))
-    for i in range(num_battles_remaining):
-      workers[i % len(workers)].stdin.write('battle\n')
-    
     while battle_number < total_matches:
-      time.sleep(0.1)
-      for w in workers:
-        line = w.stdout.readline().strip()
-        if line:
+      events = selector.select(timeout = 1.)
+      if streaming:
+        streaming.poll()
+
+      for key, _ in events:
+        w = key.data
+        # Read straight from the pipe, so that nothing sits unseen in a Python-side buffer.
+        chunk = os.read(key.fd, 65536)
+        if not chunk:
+          raise RuntimeError('Worker %d exited unexpectedly' % workers.index(w))
+        lines = (partial_lines[w] + chunk).split(b'\n')
+        partial_lines[w] = lines.pop()
+
+        for line in lines:
+          line = line.decode('utf-8').strip()
+          if not line:
+            continue
           proc_battle_dir, num_blocks_in_battle = line.split()
           num_blocks_in_battle = int(num_blocks_in_battle)
           num_blocks += num_blocks_in_battle
           battle_dir = os.path.join(battles_dir, '%06d' % battle_number)
           shutil.rmtree(battle_dir, ignore_errors = True)
           shutil.move(proc_battle_dir, battle_dir)
+          if streaming:
+            streaming.add(battle_dir)
           battle_number += 1
+          if num_assigned < num_battles_remaining:
+            w.stdin.write('battle\n')
+            num_assigned += 1
+
           current_pct = int(100 * battle_number / total_matches)
           prev_pct = int(100 * (battle_number - 1) / total_matches)
 
           if current_pct > prev_pct:
-            logger.info('Battle %s (%s%%) completed. Num blocks: %s',
-              battle_number, current_pct, num_blocks_in_battle)
+            elapsed = time.time() - start_time
+            logger.info('Battle %s (%s%%) completed. Num blocks: %s. Rate: %.2f battles/s',
+              battle_number, current_pct, num_blocks_in_battle,
+              (battle_number - num_battles) / elapsed)
 
-          if battle_number >= total_matches:
-            break
-      for fd in fds:
-        fd.flush()
+      pool.flush()
+    selector.close()
 
-    for i, w in enumerate(workers):
-      logger.info('Shutting down worker %s', i)
-      w.stdin.write('done\n')
-      w.communicate()
-
-    for fd in fds:
-      fd.close()
-
-    for fname in glob.glob('/tmp/*.err.log'):
-      os.remove(fname)
+    if pool is not worker_pool:
+      pool.close()
 
     total_time = time.time() - start_time
     logger.info('Ran %d blocks in %ss, rate = %s block/worker/s',
       num_blocks, total_time, float(num_blocks) / len(workers) / total_time)
 
-  logger.info('Rolling up files...')
-  rollup_fname = os.path.join(iter_dir, 'rollup.npz')
-  num_records = perform_rollup(expt, iter_dir, policy_tag, parallelism, rollup_fname)
+  rollup_fname = os.path.join(iter_dir, 'rollup')
+  if streaming:
+    logger.info('Finishing streaming rollup...')
+    num_records = finish_streaming_rollup(streaming, iter_dir, rollup_fname)
+  else:
+    logger.info('Rolling up files...')
+    num_records = perform_rollup(expt, iter_dir, policy_tag, parallelism, rollup_fname)
 
   expt_shortname = os.path.splitext(os.path.basename(expt_name))[0]
 
@@ -162,7 +177,7 @@ def simulate_and_rollup(expt_name, base_dir, parallelism, cuda):
   )
 
 
-def perform_policy_update(expt_name, base_dir, parallelism, cuda):
+def perform_policy_update(expt_name, base_dir, parallelism, cuda, worker_pool = None):
   logger = logging.getLogger('perform_policy_update')
 
   expt = json.load(expt_name)
@@ -177,60 +192,30 @@ def perform_policy_update(expt_name, base_dir, parallelism, cuda):
   policy_tag = divine_current_policy_tag(expt, iter_dir, current_iter)
   logger.info('Using policy: %s', policy_tag)
 
-  rollup_fname = os.path.join(iter_dir, 'rollup.npz')
-  assert os.path.isfile(rollup_fname), 'cannot do policy update without rollup file'
+  assert learner.find_rollup(iter_dir), 'cannot do policy update without rollup file'
 
-  start_time = time.time()
-  npz = np.load(rollup_fname)
-  all_extras = collections.defaultdict(list)
+  r_fnames = []
   for iter_offset in range(expt.get('updater_buffer_length_iters', 1)):
     iter_num = current_iter - iter_offset
     if iter_num >= 0:
-      r_fname = os.path.join(base_dir, 'iter%06d' % iter_num, 'rollup.npz')
-      logger.info('Loading: %s', r_fname)
-      npz = np.load(r_fname)
-      for k in npz.files:
-        all_extras[k].append(npz[k])
-  extras = {}
-  for k, vs in list(all_extras.items()):
-    extras[k] = np.concatenate(vs)
-    # This is a hack to save on memory.
-    # The optimal solution is to
-    #   1) read each rollup to determine array size,
-    #   2) pre-allocate a big array and
-    #   3) fill.
-    # (metagrok/methods/learner.py does a similar thing but operates on jsons files.)
-    del all_extras[k]
-    del vs
-  del all_extras
-  learner.post_prepare(extras)
-
-  total_time = time.time() - start_time
-  logger.info('Loaded rollups in %ss', total_time)
+      r_fnames.append(learner.find_rollup(os.path.join(base_dir, 'iter%06d' % iter_num)))
 
   start_time = time.time()
   logger.info('Starting policy update...')
-  extras = {k: torch.from_numpy(v) for k, v in extras.items()}
-  extras = TTensorDictDataset(extras, in_place_shuffle = True)
-
-  policy = torch_policy.load(policy_tag)
-  updater_cls = utils.hydrate(expt['updater'])
-  updater_args = dict(expt['updater_args'])
-  for k, v in expt.get('updater_args_schedules', {}).items():
-    updater_args[k] = Scheduler(v).select(current_iter)
-  updater = updater_cls(policy = policy, **updater_args)
-  if config.use_cuda():
-    policy.cuda()
-
-  updater.update(extras)
-  if config.use_cuda():
-    policy.cpu()
+  num_procs = expt.get('updater_num_procs', 1)
+  if num_procs > 1:
+    # Data-parallel: every process loads the (memory-mapped) rollups and updates on its shard.
+    if config.use_cuda():
+      raise ValueError('updater_num_procs is only supported on CPU')
+    logger.info('Updating in %d processes', num_procs)
+    updater.spawn_distributed(_update_policy_distributed,
+        num_procs, (expt, current_iter, policy_tag, r_fnames, '/tmp/end_model_file.pytorch'))
+  else:
+    _update_policy(expt, current_iter, policy_tag, r_fnames, '/tmp/end_model_file.pytorch')
 
   total_time = time.time() - start_time
   logger.info('Ran policy update in %ss', total_time)
 
-  with open('/tmp/end_model_file.pytorch', 'wb') as fd:
-    torch.save(policy.state_dict(), fd)
   end_model_file = os.path.join(iter_dir, 'end.pytorch')
   shutil.move('/tmp/end_model_file.pytorch', end_model_file)
 
@@ -253,7 +238,51 @@ def perform_policy_update(expt_name, base_dir, parallelism, cuda):
   )
 
 
-def run_one_iteration(expt_name, base_dir, parallelism = mp.cpu_count(), cuda = False):
+def _update_policy_distributed(*args):
+  '''Runs _update_policy in a process started by updater.spawn_distributed.'''
+  config.set_cuda(False)
+  utils.default_logger_setup()
+  _update_policy(*args)
+
+def _update_policy(expt, current_iter, policy_tag, r_fnames, out_fname):
+  '''Updates the policy on the given rollups, and saves its weights to `out_fname`.
+
+  When the update is distributed, only the first process saves.
+  '''
+  logger = logging.getLogger('perform_policy_update')
+
+  # Rollups are memory-mapped and presented as one dataset, rather than concatenated in memory.
+  start_time = time.time()
+  parts = []
+  for r_fname in r_fnames:
+    logger.info('Loading: %s', r_fname)
+    parts.append(learner.load_rollup(r_fname))
+  learner.post_prepare_parts(parts)
+
+  total_time = time.time() - start_time
+  logger.info('Loaded rollups in %ss', total_time)
+
+  extras = ConcatNDArrayDictDataset(parts, in_place_shuffle = True)
+
+  policy = torch_policy.load(policy_tag)
+  updater_cls = utils.hydrate(expt['updater'])
+  updater_args = dict(expt['updater_args'])
+  for k, v in expt.get('updater_args_schedules', {}).items():
+    updater_args[k] = Scheduler(v).select(current_iter)
+  policy_updater = updater_cls(policy = policy, **updater_args)
+  if config.use_cuda():
+    policy.cuda()
+
+  policy_updater.update(extras)
+  if config.use_cuda():
+    policy.cpu()
+
+  if not (dist.is_initialized() and dist.get_rank() != 0):
+    with open(out_fname, 'wb') as fd:
+      torch.save(policy.state_dict(), fd)
+
+def run_one_iteration(expt_name, base_dir, parallelism = mp.cpu_count(), cuda = False,
+    worker_pool = None):
   logger = logging.getLogger('run_one_iteration')
 
   expt = json.load(expt_name)
@@ -265,10 +294,9 @@ def run_one_iteration(expt_name, base_dir, parallelism = mp.cpu_count(), cuda =
   logger.info('Current iteration: %d', current_iter)
 
   # 2: If rollup file exists, we've finished simulating battles
-  rollup_fname = os.path.join(iter_dir, 'rollup.npz')
-  if not os.path.isfile(rollup_fname):
+  if not learner.find_rollup(iter_dir):
     # 3: If not, finish simulations and make the rollup file.
-    simulate_and_rollup(expt_name, base_dir, parallelism, cuda)
+    simulate_and_rollup(expt_name, base_dir, parallelism, cuda, worker_pool = worker_pool)
 
   # 4: Do gradient update, write to end.pytorch
   result = perform_policy_update(expt_name, base_dir, parallelism, cuda)
@@ -319,6 +347,139 @@ def divine_current_policy_tag(expt, iter_dir, current_iter):
     del policy
   return '%s:%s' % (expt['policy_cls'], start_model_file)
 
+class WorkerPool(object):
+  '''The simulate_worker processes that play an iteration's battles.
+
+  A pool can be kept alive across iterations (see integrated_rl_script.py --in-process): instead of
+  starting fresh workers, which must import torch, build the JS engine and load the dex before
+  playing a single battle, `acquire` tells the running ones to load the new policy in place.
+
+  The workers' stderr logs, and the shared weights when there is no /dev/shm, live in a directory
+  that the pool owns and removes on `close`.
+  '''
+  logger = logging.getLogger('WorkerPool')
+
+  def __init__(self, expt, parallelism):
+    self._expt = expt
+    self._parallelism = parallelism
+    self._policy_tag = None
+    self.workers = []
+    self._err_fds = []
+    self._shared_tags = {}
+    self.dirname = tempfile.mkdtemp(prefix = 'metagrok-workers-')
+
+  def acquire(self, policy_tag):
+    '''Returns workers that are ready to play battles with `policy_tag`.'''
+    prev_policy_tag = self._policy_tag
+    self._policy_tag = policy_tag
+    shared_tag = self._share(policy_tag)
+    if not self.workers:
+      for bid in range(self._parallelism):
+        self._spawn(bid, shared_tag)
+    elif policy_tag != prev_policy_tag:
+      self.logger.info('Loading %s into %d workers', shared_tag, len(self.workers))
+      for w in self.workers:
+        w.stdin.write('load %s\n' % shared_tag)
+      # Every worker has already played (so loaded) the previous policy, and a file that is
+      # mapped stays valid after it is removed.
+      if prev_policy_tag != self._expt['simulate_args'].get('p2'):
+        self._unshare(prev_policy_tag)
+    return self.workers
+
+  def flush(self):
+    for fd in self._err_fds:
+      fd.flush()
+
+  def close(self):
+    for i, w in enumerate(self.workers):
+      self.logger.info('Shutting down worker %s', i)
+      w.stdin.write('done\n')
+      w.communicate()
+
+    for fd in self._err_fds:
+      fd.close()
+
+    for policy_tag in list(self._shared_tags):
+      self._unshare(policy_tag)
+
+    self.workers = []
+    self._err_fds = []
+    shutil.rmtree(self.dirname, ignore_errors = True)
+
+  def _share(self, policy_tag):
+    '''With simulate_args.shared_weights, returns a tag whose weights all workers map from one file.'''
+    if not self._expt['simulate_args'].get('shared_weights'):
+      return policy_tag
+    if policy_tag not in self._shared_tags:
+      dirname = '/dev/shm' if os.path.isdir('/dev/shm') else self.dirname
+      self._shared_tags[policy_tag] = torch_policy.share(policy_tag, dirname)
+    return self._shared_tags[policy_tag]
+
+  def _unshare(self, policy_tag):
+    shared_tag = self._shared_tags.pop(policy_tag, None)
+    if shared_tag and shared_tag != policy_tag:
+      fname = shared_tag.split(':', 1)[1]
+      for f in [fname, fname + '.json']:
+        if os.path.isfile(f):
+          os.remove(f)
+
+  def _spawn(self, bid, policy_tag):
+    expt = self._expt
+    self.logger.info('Spawn battler with ID %s', bid)
+    env = os.environ.copy()
+    env['OMP_NUM_THREADS'] = '1'
+    env['MKL_NUM_THREADS'] = '1'
+    err_fd = open(os.path.join(self.dirname, '%03d.err.log' % bid), 'w')
+    args = ['./rp', 'metagrok/exe/simulate_worker.py',
+      policy_tag,
+      expt.get('format', 'gen7randombattle'),
+      str(bid),
+    ]
+    if 'epsilon' in expt['simulate_args']:
+      args.append('--epsilon')
+      args.append(str(expt['simulate_args']['epsilon']))
+    if 'p2' in expt['simulate_args']:
+      args.append('--p2-policy-tag')
+      args.append(self._share(str(expt['simulate_args']['p2'])))
+    if 'max_batch_size' in expt['simulate_args']:
+      args.append('--max-batch-size')
+      args.append(str(expt['simulate_args']['max_batch_size']))
+    if 'max_batch_wait' in expt['simulate_args']:
+      args.append('--max-batch-wait')
+      args.append(str(expt['simulate_args']['max_batch_wait']))
+    if 'concurrent_battles' in expt['simulate_args']:
+      args.append('--concurrent-battles')
+      args.append(str(expt['simulate_args']['concurrent_battles']))
+    if 'fetch_mode' in expt['simulate_args']:
+      args.append('--fetch-mode')
+      args.append(str(expt['simulate_args']['fetch_mode']))
+    if 'num_engines' in expt['simulate_args']:
+      args.append('--num-engines')
+      args.append(str(expt['simulate_args']['num_engines']))
+    if expt['simulate_args'].get('simulator_pool'):
+      args.append('--simulator-pool')
+    if expt['simulate_args'].get('persist_features'):
+      args.append('--persist-features')
+    if expt['simulate_args'].get('skip_forced'):
+      args.append('--skip-forced')
+    if expt['simulate_args'].get('no_forced_state'):
+      args.append('--no-forced-state')
+    if 'log_format' in expt['simulate_args']:
+      args.append('--log-format')
+      args.append(str(expt['simulate_args']['log_format']))
+    rv = subprocess.Popen(
+      args,
+      stdout = subprocess.PIPE,
+      stdin = subprocess.PIPE,
+      stderr = err_fd,
+      env = env,
+      encoding = 'utf-8',
+      bufsize = 0,
+    )
+    os.system('taskset -p -c %d %d' % (bid % mp.cpu_count(), rv.pid))
+    self.workers.append(rv)
+    self._err_fds.append(err_fd)
+
 def perform_rollup(expt, iter_dir, policy_tag, parallelism, rollup_fname):
   policy = torch_policy.load(policy_tag)
   rew = expt['reward_args']
@@ -326,15 +487,13 @@ def perform_rollup(expt, iter_dir, policy_tag, parallelism, rollup_fname):
 
   iter_dir_arg = iter_dir
   if expt.get('player'):
-    iter_dir_arg = list(utils.find(iter_dir, '%s.jsons.gz' % expt['player']))
+    iter_dir_arg = list(battlelogs.find(iter_dir, expt['player']))
 
   extras = learner.rollup(
       policy, iter_dir_arg, rew['gamma'], rew['lam'], shaper,
       num_workers = parallelism,
       progress_type = 'log')
-  tmp_rollup_name = '/tmp/rollup.npz'
-  np.savez_compressed(tmp_rollup_name, **extras)
-  shutil.move(tmp_rollup_name, rollup_fname)
+  learner.save_rollup(rollup_fname, extras)
 
   # 4b. zip up battle files
   subprocess.check_call(['zip', '-q', '-r', '/tmp/battles', 'battles'], cwd = iter_dir)
@@ -342,6 +501,42 @@ def perform_rollup(expt, iter_dir, policy_tag, parallelism, rollup_fname):
   shutil.rmtree(os.path.join(iter_dir, 'battles'))
   return list(extras.values())[0].shape[0]
 
+class _StreamingRollup(object):
+  '''A learner.StreamingRollup that also appends every battle it is given to battles.zip.'''
+  def __init__(self, rollup, iter_dir):
+    self.rollup = rollup
+    self._iter_dir = iter_dir
+    self._zip = zipfile.ZipFile(os.path.join(iter_dir, 'battles.zip.tmp'), 'w')
+
+  def add(self, battle_dir):
+    self.rollup.add(battle_dir)
+    for fname in sorted(os.listdir(battle_dir)):
+      path = os.path.join(battle_dir, fname)
+      # Battle logs are already compressed.
+      self._zip.write(path, os.path.relpath(path, self._iter_dir), zipfile.ZIP_STORED)
+
+  def close(self):
+    self._zip.close()
+    shutil.move(self._zip.filename, os.path.join(self._iter_dir, 'battles.zip'))
+
+def start_streaming_rollup(expt, iter_dir, policy, num_workers):
+  rew = expt['reward_args']
+  shaper = reward_shaper.create(**rew['shaping'])
+  # Leftovers from an interrupted run are redone from the battle directories.
+  tmp_dir = os.path.join(iter_dir, 'rollup.tmp')
+  shutil.rmtree(tmp_dir, ignore_errors = True)
+  rollup = learner.StreamingRollup(
+      policy, tmp_dir, rew['gamma'], rew['lam'], shaper,
+      num_workers = num_workers,
+      gid = expt.get('player') or '*')
+  return _StreamingRollup(rollup, iter_dir)
+
+def finish_streaming_rollup(streaming, iter_dir, rollup_fname):
+  num_records = streaming.rollup.finish(rollup_fname)
+  streaming.close()
+  shutil.rmtree(os.path.join(iter_dir, 'battles'))
+  return num_records
+
 _name_to_prog = dict(
   run_one_iteration = run_one_iteration,
   simulate_and_rollup = simulate_and_rollup,
@@ -363,23 +558,29 @@ def main():
   remote_debug.listen()
 
   config.set_cuda(args.cuda)
+  utils.default_logger_setup()
+
+  run(args.prog, args.expt_name, args.base_dir, args.parallelism, args.cuda)
 
+def run(prog_name, expt_name, base_dir, parallelism, cuda, worker_pool = None):
+  '''Runs one of the programs in _name_to_prog, with logging to /tmp/iteration.log and email.'''
   utils.mkdir_p('/tmp')
 
-  logger = utils.default_logger_setup()
+  logger = logging.getLogger()
   fhandler = logging.FileHandler('/tmp/iteration.log')
   fhandler.setFormatter(logging.Formatter(constants.LOG_FORMAT))
   fhandler.setLevel(logging.INFO)
   logger.addHandler(fhandler)
 
-  prog = _name_to_prog[args.prog]
+  prog = _name_to_prog[prog_name]
 
   time_begin = utils.iso_ts()
   result = prog(
-    expt_name = args.expt_name,
-    base_dir = args.base_dir,
-    parallelism = args.parallelism,
-    cuda = args.cuda,
+    expt_name = expt_name,
+    base_dir = base_dir,
+    parallelism = parallelism,
+    cuda = cuda,
+    worker_pool = worker_pool,
   )
   time_end = utils.iso_ts()
 
@@ -387,8 +588,9 @@ def main():
   result['time_end'] = time_end
 
   fhandler.close()
+  logger.removeHandler(fhandler)
 
-  if args.prog != 'simulate_and_rollup' and result['iter'] % 5 == 0:
+  if prog_name != 'simulate_and_rollup' and result['iter'] % 5 == 0:
     mail.send(
       result['subject'],
       json.dumps(result, indent = 2, sort_keys = True),
@@ -1,5 +1,14 @@
+import os
+import shutil
+
+import numpy as np
+
 from metagrok import np_json as json
 from metagrok.fileio import to_fd
+from metagrok import fileio
+
+RAW_EXT = '.raw'
+INDEX_EXT = '.idx.npy'
 
 def load(fd_or_name):
   return list(stream(fd_or_name))
@@ -15,3 +24,45 @@ def dump(fd_or_name, itr, dumps = json.dumps):
       json_str = dumps(obj)
       fd.write(json_str)
       fd.write('\n')
+
+def index(fname):
+  '''Returns (raw_fname, offsets) for random access to the lines of the jsons file `fname`.
+
+  Line i is the bytes [offsets[i], offsets[i + 1]) of the uncompressed file raw_fname (`fname`
+  itself, unless it is gzipped). The offsets (and, for gzipped files, an uncompressed copy) are
+  written next to `fname` the first time, and rebuilt whenever `fname` is newer than them.
+  '''
+  raw_fname = fname
+  if fname.endswith('.gz'):
+    raw_fname = fname + RAW_EXT
+  idx_fname = fname + INDEX_EXT
+
+  mtime = os.path.getmtime(fname)
+  if not (os.path.isfile(idx_fname) and os.path.getmtime(idx_fname) >= mtime
+      and os.path.isfile(raw_fname) and os.path.getmtime(raw_fname) >= mtime):
+    _build_index(fname, raw_fname, idx_fname)
+
+  return raw_fname, np.load(idx_fname, mmap_mode = 'r')
+
+def _build_index(fname, raw_fname, idx_fname):
+  if raw_fname != fname:
+    with fileio.open(fname, 'rb') as src, open(raw_fname + '.tmp', 'wb') as dst:
+      shutil.copyfileobj(src, dst)
+    os.rename(raw_fname + '.tmp', raw_fname)
+
+  offsets = [0]
+  with open(raw_fname, 'rb') as fd:
+    for line in fd:
+      offsets.append(offsets[-1] + len(line))
+
+  # np.save appends .npy to names that do not end with it.
+  np.save(idx_fname + '.tmp.npy', np.asarray(offsets, dtype = 'int64'))
+  os.rename(idx_fname + '.tmp.npy', idx_fname)
+
+def read_line(fd, offsets, i):
+  '''Reads line i of an indexed file (see `index`) from the file descriptor `fd`.
+
+  Uses pread, so any number of threads or processes can read through the same descriptor.
+  '''
+  start = int(offsets[i])
+  return os.pread(fd, int(offsets[i + 1]) - start, start).decode('utf-8')
@@ -1,3 +1,4 @@
+import collections
 import glob
 import logging
 import os
@@ -19,6 +20,7 @@ import torch
 import tqdm
 
 from metagrok import battlelogs, config, utils, fileio
+from metagrok import np_json as json
 from metagrok.utils import mkdir_p
 from metagrok.torch_policy import TorchPolicy
 from metagrok.torch_utils.data import NDArrayDictDataset
@@ -112,22 +114,26 @@ def run_update(updater, iter_num, out_dir, gamma, lam, delete_logs):
 
 def check_results(iter_dir):
   results = {'winner': 0, 'loser': 0, 'tie': 0}
-  for fname in utils.find(iter_dir, '*.jsons.gz'):
+  for fname in battlelogs.find(iter_dir):
     key = battlelogs.result_only(fname)
     results[key] += 1
   return results
 
 def rollup(policy, iter_dir, gamma, lam, reward_shaper = None, num_workers = 0,
-    progress_type = 'bar'):
+    progress_type = 'bar', reuse_features = True):
   # Concatenate rollouts from this iteration, and store in parallel arrays:
   # - Features
   # - Action taken (as an index)
   # - Actual Return
   # - Advantage
+  #
+  # If reuse_features is set, features that were logged with a block (see
+  # EnginePkmnPlayer(persist_features = True)) by the same extractor (see
+  # TorchPolicy.extract_fingerprint) are copied instead of being extracted again.
   assert progress_type in {'bar', 'log', 'none'}
 
   if isinstance(iter_dir, six.string_types):
-    fnames = list(utils.find(iter_dir, '*.jsons.gz'))
+    fnames = list(battlelogs.find(iter_dir))
   else:
     assert isinstance(iter_dir, list)
     fnames = iter_dir
@@ -136,7 +142,7 @@ def rollup(policy, iter_dir, gamma, lam, reward_shaper = None, num_workers = 0,
 
   logger.info('Rollup has %s files' % len(fnames))
   pool = mulproc.Pool()
-  linecount = dict(list(zip(fnames, pool.map(utils.linecount, fnames))))
+  linecount = dict(list(zip(fnames, pool.map(battlelogs.num_blocks, fnames))))
   pool.close()
 
   start_rows = {}
@@ -147,27 +153,10 @@ def rollup(policy, iter_dir, gamma, lam, reward_shaper = None, num_workers = 0,
 
   logger.info('Rollup has %s rows' % nrows)
 
-  # read the first file, to see what the sizes are
-  t = battlelogs.parse(fnames[0], gamma = gamma, lam = lam, reward_shaper = reward_shaper)[-1]
+  # read the first battle with decision blocks, to see what the sizes are
+  t = _first_block(fnames, reward_shaper)
   fs = policy.extract(t['state'], t['candidates'])
-  n_actions = 0
-  if 'mask' in fs:
-    n_actions = fs['mask'].shape[0]
-
-  type_info = {
-      'actions': ((nrows,), 'int64'),
-      'advantages': ((nrows,), config.nt()),
-      'returns': ((nrows,), config.nt()),
-      'value_preds': ((nrows,), config.nt()),
-  }
-
-  for k in ['probs', 'log_probs']:
-    if k in t:
-      na = max(t[k].shape[0], n_actions)
-      type_info[k] = ((nrows, na), config.nt())
-
-  for k, v in fs.items():
-    type_info['features_' + k] = ((nrows,) + v.shape, v.dtype)
+  type_info = _rollup_type_info(t, fs, nrows)
 
   if num_workers > 0:
     mk_buf_fn = _mk_RawArray
@@ -199,6 +188,8 @@ def rollup(policy, iter_dir, gamma, lam, reward_shaper = None, num_workers = 0,
       reward_shaper = reward_shaper,
       in_queue = in_queue,
       out_queue = out_queue,
+      reuse_features = reuse_features,
+      fingerprint = policy.extract_fingerprint() if reuse_features else None,
   )
 
   # Read the rest of the files
@@ -222,10 +213,15 @@ def rollup(policy, iter_dir, gamma, lam, reward_shaper = None, num_workers = 0,
   if progress_type == 'bar':
     pbar = tqdm.tqdm(pbar)
 
+  # Forced blocks logged without a state have no row, so files may fill fewer rows than allotted.
+  keep = np.ones(nrows, dtype = bool)
   for i, _ in enumerate(pbar):
-    fname = out_queue.get()
-    if isinstance(fname, Exception):
-      raise fname
+    r = out_queue.get()
+    if isinstance(r, Exception):
+      raise r
+    fname, num_rows = r
+    start_row = start_rows[fname] + num_rows
+    keep[start_row:start_row + linecount[fname] - 1 - num_rows] = False
     if progress_type == 'bar':
       pbar.set_description(fname)
     elif progress_type == 'log':
@@ -237,8 +233,179 @@ def rollup(policy, iter_dir, gamma, lam, reward_shaper = None, num_workers = 0,
   for worker in workers:
     worker.join()
 
+  if not keep.all():
+    data = {k: v[keep] for k, v in data.items()}
+  _fill_returns(data, gamma, lam)
+  return data
+
+def _first_block(fnames, reward_shaper):
+  '''Returns the last decision block of the first battle log that has any.
+
+  A log may have none, e.g. if every block was a forced action logged without a state.
+  '''
+  for fname in fnames:
+    ts = battlelogs.parse(fname, reward_shaper = reward_shaper, returns = False, copy = False)
+    if ts:
+      return ts[-1]
+  raise ValueError('No battle log has a decision block')
+
+def _rollup_type_info(t, fs, nrows):
+  n_actions = 0
+  if 'mask' in fs:
+    n_actions = fs['mask'].shape[0]
+
+  type_info = {
+      'actions': ((nrows,), 'int64'),
+      'advantages': ((nrows,), config.nt()),
+      'returns': ((nrows,), config.nt()),
+      'value_preds': ((nrows,), config.nt()),
+      # Inputs to _fill_returns, which removes them.
+      'rewards': ((nrows,), config.nt()),
+      'dones': ((nrows,), 'bool'),
+  }
+
+  for k in ['probs', 'log_probs']:
+    if k in t:
+      na = max(t[k].shape[0], n_actions)
+      type_info[k] = ((nrows, na), config.nt())
+
+  for k, v in fs.items():
+    type_info['features_' + k] = ((nrows,) + v.shape, v.dtype)
+
+  return type_info
+
+class StreamingRollup(object):
+  '''Rolls up battles one at a time, as they finish, instead of all at once at the end.
+
+  `add(battle_dir)` hands a finished battle to a pool of worker processes. Their rows are appended
+  to one raw file per array in `out_dir` as they come back (in completion order), and `finish`
+  assembles those files into a rollup directory (see `save_rollup`).
+  '''
+  def __init__(self, policy, out_dir, gamma, lam, reward_shaper = None, num_workers = 1,
+      gid = '*', reuse_features = True):
+    self._out_dir = out_dir
+    self._gid = gid
+    mkdir_p(out_dir)
+
+    self._pool = mulproc.Pool(
+        num_workers,
+        initializer = _init_streaming_worker,
+        initargs = (policy.pkl(), gamma, lam, reward_shaper, reuse_features,
+          policy.extract_fingerprint() if reuse_features else None))
+    self._pending = collections.deque()
+    self._columns = {}
+
+    self.num_battles = 0
+    self.num_rows = 0
+
+  def add(self, battle_dir):
+    fnames = sorted(battlelogs.find(battle_dir, self._gid))
+    self._pending.append(self._pool.apply_async(_rollup_files, (fnames,)))
+    self.poll()
+
+  def poll(self, block = False):
+    '''Appends the rows of every battle that has been rolled up so far.'''
+    while self._pending and (block or self._pending[0].ready()):
+      self._append(self._pending.popleft().get())
+
+  def finish(self, dirname):
+    '''Waits for all pending battles, then writes the rollup directory. Returns the row count.'''
+    self.poll(block = True)
+    self._pool.close()
+    self._pool.join()
+
+    tmp_dirname = dirname + '.tmp'
+    shutil.rmtree(tmp_dirname, ignore_errors = True)
+    mkdir_p(tmp_dirname)
+    type_info = {}
+    for k, (fd, dtype, shape) in self._columns.items():
+      fd.close()
+      shape = (self.num_rows,) + shape
+      out = np.lib.format.open_memmap(
+          os.path.join(tmp_dirname, k + '.npy'), mode = 'w+', dtype = dtype, shape = shape)
+      out[:] = np.memmap(fd.name, dtype = dtype, mode = 'r', shape = shape)
+      out.flush()
+      del out
+      type_info[k] = (shape, dtype)
+    _write_manifest(tmp_dirname, type_info)
+
+    shutil.rmtree(dirname, ignore_errors = True)
+    os.rename(tmp_dirname, dirname)
+    shutil.rmtree(self._out_dir)
+    return self.num_rows
+
+  def _append(self, data):
+    self.num_battles += 1
+    if not data:
+      return
+
+    for k, v in data.items():
+      if k not in self._columns:
+        assert self.num_rows == 0, 'Found new array %s after %d rows' % (k, self.num_rows)
+        fd = open(os.path.join(self._out_dir, k + '.bin'), 'wb')
+        self._columns[k] = (fd, v.dtype, v.shape[1:])
+      fd, dtype, shape = self._columns[k]
+      assert v.dtype == dtype and v.shape[1:] == shape, (k, v.dtype, v.shape, dtype, shape)
+      fd.write(np.ascontiguousarray(v).tobytes())
+    self.num_rows += len(next(iter(data.values())))
+
+_streaming_worker = {}
+
+def _init_streaming_worker(policy_pkl, gamma, lam, reward_shaper, reuse_features, fingerprint):
+  _streaming_worker.update(
+      policy_pkl = policy_pkl,
+      policy = None,
+      gamma = gamma,
+      lam = lam,
+      reward_shaper = reward_shaper,
+      reuse_features = reuse_features,
+      fingerprint = fingerprint,
+      reference_features = None)
+
+def _rollup_files(fnames):
+  w = _streaming_worker
+  battles = [
+      battlelogs.parse(fname, reward_shaper = w['reward_shaper'], returns = False, copy = False)
+      for fname in fnames]
+  battles = [ts for ts in battles if ts]
+  if not battles:
+    return {}
+
+  nrows = sum(len(ts) for ts in battles)
+  type_info = _rollup_type_info(battles[0][-1], _reference_features(battles[0][-1]), nrows)
+
+  fss = []
+  for ts in battles:
+    fss.append([])
+    for t in ts:
+      fs = _logged_features(t, type_info, w['fingerprint']) if w['reuse_features'] else None
+      if fs is None:
+        fs = _streaming_policy().extract(t['state'], t['candidates'])
+      fss[-1].append(fs)
+
+  data = {k: np.zeros(shape, dtype = dtype) for k, (shape, dtype) in type_info.items()}
+  row_num = 0
+  for ts, battle_fss in zip(battles, fss):
+    _rollup_assign(data, ts, battle_fss, row_num)
+    row_num += len(ts)
+  _fill_returns(data, w['gamma'], w['lam'])
   return data
 
+def _streaming_policy():
+  # Building the policy is expensive, so only do it once per worker.
+  w = _streaming_worker
+  if w['policy'] is None:
+    w['policy'] = TorchPolicy.unpkl(w['policy_pkl'])
+  return w['policy']
+
+def _reference_features(t):
+  '''Returns features extracted by the policy (from block `t`, the first time), which logged
+  features must match to be reused.'''
+  w = _streaming_worker
+  if w.get('reference_features') is None:
+    w['reference_features'] = _streaming_policy().extract(t['state'], t['candidates'])
+  return w['reference_features']
+
 def _mk_RawArray(shape, dtype):
   size = six.moves.reduce(lambda x, y: x * y, shape, 1)
 
@@ -252,9 +419,9 @@ def _mk_volatile_buffer(shape, dtype):
 def _worker_loop(
     type_info, underlying,
     policy_pkl, gamma, lam, reward_shaper,
-    in_queue, out_queue):
+    in_queue, out_queue, reuse_features = True, fingerprint = None):
 
-  policy = TorchPolicy.unpkl(policy_pkl)
+  policy = None
   data = {}
   for k, (shape, dtype) in type_info.items():
     size = six.moves.reduce(lambda x, y: x * y, shape, 1)
@@ -268,26 +435,67 @@ def _worker_loop(
       if r is None:
         break
       fname, row_num = r
-      ts = battlelogs.parse(fname, gamma = gamma, lam = lam, reward_shaper = reward_shaper)
+      ts = battlelogs.parse(fname, reward_shaper = reward_shaper, returns = False, copy = False)
+      fss = []
       for t in ts:
-        fs = policy.extract(t['state'], t['candidates'])
-        _rollup_assign(data, t, fs, row_num)
-        row_num += 1
-      out_queue.put(fname)
+        fs = _logged_features(t, type_info, fingerprint) if reuse_features else None
+        if fs is None:
+          # Building the policy is expensive, so only do it if some block needs it.
+          if policy is None:
+            policy = TorchPolicy.unpkl(policy_pkl)
+          fs = policy.extract(t['state'], t['candidates'])
+        fss.append(fs)
+      _rollup_assign(data, ts, fss, row_num)
+      out_queue.put((fname, len(ts)))
   except Exception as e:
     out_queue.put(e)
 
-def _rollup_assign(data, t, fs, row_num):
-  for k, v in fs.items():
-    data['features_' + k][row_num] = v
-
-  data['actions'][row_num] = t['action']
-  data['advantages'][row_num] = t['advantage']
-  data['value_preds'][row_num] = t['value_pred']
-  data['returns'][row_num] = t['return']
+def _logged_features(t, type_info, fingerprint):
+  '''Returns the features logged with block `t`, or None if they were not logged by the extractor
+  with this fingerprint or do not match `type_info`.'''
+  if fingerprint is None or t.get('extract_fingerprint') != fingerprint:
+    return None
+  keys = [k for k in type_info if k.startswith('features_')]
+  if not all(k in t for k in keys):
+    return None
+  for k in keys:
+    shape, dtype = type_info[k]
+    if np.shape(t[k]) != shape[1:] or np.asarray(t[k]).dtype != np.dtype(dtype):
+      return None
+  return {k[len('features_'):]: t[k] for k in keys}
+
+def _rollup_assign(data, ts, fss, row_num):
+  '''Writes the rows of one battle, `ts` (from battlelogs.parse(..., returns = False)), and their
+  features `fss` starting at `row_num`. Advantages and returns are left to _fill_returns.'''
+  if not ts:
+    return
+  rows = slice(row_num, row_num + len(ts))
+  for k in fss[0]:
+    data['features_' + k][rows] = np.stack([fs[k] for fs in fss])
+
+  data['actions'][rows] = [t['action'] for t in ts]
+  data['value_preds'][rows] = [t['value_pred'] for t in ts]
+  data['rewards'][rows] = [t.get('reward', 0.0) for t in ts]
+  data['dones'][rows] = False
+  data['dones'][row_num + len(ts) - 1] = True
   for k in ['probs', 'log_probs']:
-    if k in t:
-      data[k][row_num, :t[k].shape[0]] = t[k]
+    if k not in data:
+      continue
+    widths = set(t[k].shape[0] for t in ts if k in t)
+    if len(widths) == 1 and all(k in t for t in ts):
+      data[k][rows, :widths.pop()] = np.stack([t[k] for t in ts])
+    else:
+      for i, t in enumerate(ts):
+        if k in t:
+          data[k][row_num + i, :t[k].shape[0]] = t[k]
+
+def _fill_returns(data, gamma, lam):
+  '''Computes advantages and returns for every row at once, from the rewards and dones columns,
+  which it then removes.'''
+  rv = battlelogs.compute_returns_batch(
+      data['value_preds'], data.pop('rewards'), data.pop('dones'), gamma, lam)
+  data['advantages'][:] = rv['advantage']
+  data['returns'][:] = rv['return']
 
 def prepare(match_files):
   shapes = {}
@@ -327,10 +535,78 @@ def prepare(match_files):
   return extras
 
 def post_prepare(extras):
-  adv = extras['advantages']
-  adv = adv - adv.mean()
-  adv = adv / (1e-8 + adv.std())
-  extras['advantages'] = adv
-
-  N = extras['log_probs'].shape[0]
-  extras['action_log_probs'] = extras['log_probs'][np.arange(N), extras['actions']]
+  post_prepare_parts([extras])
+
+def post_prepare_parts(parts):
+  '''Like post_prepare, but normalizes advantages across several rollups without concatenating.
+
+  Only the (small) derived arrays are created in memory; the rest of each part is left untouched,
+  so memory-mapped parts stay on disk.
+  '''
+  all_adv = np.concatenate([part['advantages'] for part in parts])
+  mean = all_adv.mean()
+  std = (all_adv - mean).std()
+  del all_adv
+
+  for extras in parts:
+    adv = extras['advantages']
+    adv = adv - mean
+    adv = adv / (1e-8 + std)
+    extras['advantages'] = adv
+
+    N = extras['log_probs'].shape[0]
+    extras['action_log_probs'] = extras['log_probs'][np.arange(N), extras['actions']]
+
+# -----------------------------------------------------------------------------
+# Rollup storage
+#
+# A rollup directory holds one uncompressed `<key>.npy` per array and a `manifest.json` with the
+# number of rows and the shape and dtype of every array. The manifest is written last, so a
+# directory without one is incomplete.
+
+ROLLUP_MANIFEST = 'manifest.json'
+
+def save_rollup(dirname, data):
+  tmp_dirname = dirname + '.tmp'
+  shutil.rmtree(tmp_dirname, ignore_errors = True)
+  mkdir_p(tmp_dirname)
+  for k, v in data.items():
+    np.save(os.path.join(tmp_dirname, k + '.npy'), v)
+  _write_manifest(tmp_dirname, {k: (v.shape, v.dtype) for k, v in data.items()})
+  shutil.rmtree(dirname, ignore_errors = True)
+  os.rename(tmp_dirname, dirname)
+
+def load_rollup(path, mmap_mode = 'r'):
+  '''Loads a rollup directory (memory-mapped) or a legacy rollup npz (into memory).'''
+  if not os.path.isdir(path):
+    with np.load(path) as npz:
+      return {k: npz[k] for k in npz.files}
+
+  with open(os.path.join(path, ROLLUP_MANIFEST)) as fd:
+    manifest = json.load(fd)
+  rv = {}
+  for k in manifest['arrays']:
+    rv[k] = np.load(os.path.join(path, k + '.npy'), mmap_mode = mmap_mode)
+    assert rv[k].shape[0] == manifest['num_rows'], (k, rv[k].shape, manifest['num_rows'])
+  return rv
+
+def find_rollup(iter_dir):
+  '''Returns the path of the finished rollup in `iter_dir` (in either format), or None.'''
+  dirname = os.path.join(iter_dir, 'rollup')
+  if os.path.isfile(os.path.join(dirname, ROLLUP_MANIFEST)):
+    return dirname
+  fname = os.path.join(iter_dir, 'rollup.npz')
+  if os.path.isfile(fname):
+    return fname
+  return None
+
+def _write_manifest(dirname, type_info):
+  num_rows = set(shape[0] for shape, _ in type_info.values())
+  assert len(num_rows) <= 1, num_rows
+  manifest = dict(
+      num_rows = num_rows.pop() if num_rows else 0,
+      arrays = {
+          k: dict(shape = list(shape), dtype = np.dtype(dtype).name)
+          for k, (shape, dtype) in type_info.items()})
+  with open(os.path.join(dirname, ROLLUP_MANIFEST), 'w') as fd:
+    json.dump(manifest, fd, indent = 2, sort_keys = True)
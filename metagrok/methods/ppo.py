@@ -14,7 +14,7 @@ from metagrok.games.tictactoe import Policy
 from metagrok.games import cgpi
 from metagrok.methods import learner
 from metagrok.methods.updater import PolicyUpdater
-from metagrok.torch_utils.data import TTensorDictDataset
+from metagrok.torch_utils.data import SHUFFLE_STRATEGIES, TTensorDictDataset
 
 class PPOUpdater(PolicyUpdater):
   'Implements Proximal Policy Optimization, as described in: https://arxiv.org/abs/1707.06347'
@@ -75,6 +75,8 @@ def parse_args():
   parser.add_argument('--num-iters', type = int, default = 100)
   parser.add_argument('--num-matches', type = int, default = 256)
   parser.add_argument('--opt-lr', type = float, default = 7e-4)
+  parser.add_argument('--shuffle', choices = SHUFFLE_STRATEGIES,
+      help = 'How to shuffle the training data between epochs (default: copy).')
   return parser.parse_args()
 
 def demo(args):
@@ -102,6 +104,7 @@ def demo(args):
       clip_param = args.clip_param,
       entropy_coef = args.entropy_coef,
       weight_decay = 0.001,
+      shuffle = args.shuffle,
   )
 
   start_dir = args.start_dir or utils.ts()
@@ -0,0 +1,119 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from metagrok import battlelogs
+from metagrok import config
+from metagrok.methods import learner
+
+config.set_cuda(False)
+
+class _Policy(object):
+  '''Extracts the turn number, scaled by `scale`.'''
+  def __init__(self, scale = 1.):
+    self.scale = scale
+
+  @staticmethod
+  def unpkl(arg):
+    return arg[0](*arg[1])
+
+  def pkl(self):
+    return (type(self), (self.scale,), {})
+
+  def extract_fingerprint(self):
+    return str(self.scale)
+
+  def extract(self, state, candidates):
+    return dict(
+        turn = np.asarray([self.scale * state['turn']], dtype = 'float32'),
+        mask = np.asarray([1. if c else 0. for c in candidates], dtype = 'float32'))
+
+def _blocks(num_blocks, result = 'winner', features = None, fingerprint = '1.0'):
+  '''Returns the blocks of a battle log, with `features(turn)` logged for each decision by the
+  extractor with this fingerprint.'''
+  blocks = []
+  for i in range(num_blocks):
+    probs = np.asarray([0.5, 0.5], dtype = 'float32')
+    blocks.append(dict(
+        state = dict(turn = i + 1),
+        candidates = ['move 1', 'move 2'],
+        probs = probs,
+        log_probs = np.log(probs),
+        value_pred = 0.,
+        action = i % 2,
+        _updates = []))
+    if features:
+      for k, v in features(i + 1).items():
+        blocks[-1]['features_' + k] = v
+      blocks[-1]['extract_fingerprint'] = fingerprint
+  blocks.append(dict(result = result, _updates = []))
+  return blocks
+
+class RollupTest(unittest.TestCase):
+  def setUp(self):
+    self.dirname = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.dirname)
+
+  def _log(self, gid, blocks):
+    battlelogs.dump_columnar(os.path.join(self.dirname, gid + battlelogs.COLUMNAR_EXT), blocks)
+
+  def test_first_log_without_decisions(self):
+    # Every block of the first log was a forced action logged without a state.
+    self._log('0-p1', [dict(forced = True, action = 0, _updates = [])] + _blocks(0))
+    self._log('1-p1', _blocks(3))
+    data = learner.rollup(_Policy(), self.dirname, 1., 1., num_workers = 1, progress_type = 'none')
+    self.assertEqual([1., 2., 3.], data['features_turn'][:, 0].tolist())
+
+  def test_logged_features(self):
+    self._log('0-p1', _blocks(2, features = _logged))
+    self._log('1-p1', _blocks(2, features = _logged, fingerprint = '2.0'))
+    data = learner.rollup(_Policy(), self.dirname, 1., 1., num_workers = 1, progress_type = 'none')
+    self.assertEqual([100., 200., 1., 2.], data['features_turn'][:, 0].tolist())
+
+def _logged(turn):
+  return dict(
+      turn = np.asarray([100. * turn], dtype = 'float32'),
+      mask = np.ones(2, dtype = 'float32'))
+
+def _stale(turn):
+  # An older feature layout
+  return dict(turn = np.asarray([100. * turn, 0.], dtype = 'float32'))
+
+def _float64(turn):
+  return {k: v.astype('float64') for k, v in _logged(turn).items()}
+
+class StreamingRollupTest(unittest.TestCase):
+  def setUp(self):
+    self.dirname = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.dirname)
+
+  def test_logged_features(self):
+    streaming = learner.StreamingRollup(_Policy(), os.path.join(self.dirname, 'tmp'), 1., 1.)
+    logs = [
+        _blocks(2, features = _stale),
+        _blocks(2, features = _logged),
+        _blocks(2),
+        _blocks(2, features = _logged, fingerprint = '2.0'),
+        _blocks(2, features = _float64),
+    ]
+    for i, blocks in enumerate(logs):
+      battle_dir = os.path.join(self.dirname, 'battles', str(i))
+      os.makedirs(battle_dir)
+      battlelogs.dump_columnar(os.path.join(battle_dir, 'p1' + battlelogs.COLUMNAR_EXT), blocks)
+      streaming.add(battle_dir)
+    rollup_dir = os.path.join(self.dirname, 'rollup')
+    self.assertEqual(10, streaming.finish(rollup_dir))
+
+    # Only features from the same extractor, with the same shapes and dtypes, are reused.
+    turns = learner.load_rollup(rollup_dir)['features_turn'][:, 0].tolist()
+    self.assertEqual([1., 2., 100., 200., 1., 2., 1., 2., 1., 2.], turns)
+
+if __name__ == '__main__':
+  unittest.main()
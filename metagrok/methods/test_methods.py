@@ -1,3 +1,8 @@
+import glob
+import json
+import os
+import shutil
+import tempfile
 import unittest
 
 import numpy as np
@@ -9,6 +14,7 @@ from metagrok.games.tictactoe import Policy
 from metagrok.torch_utils.data import TTensorDictDataset
 
 from metagrok.methods import learner
+from metagrok.methods import updater
 from metagrok.methods.vanilla_pg import VanillaPGUpdater
 from metagrok.methods.ppo import PPOUpdater
 
@@ -138,6 +144,163 @@ class PPOTest(MethodTest):
     self.assertGreater(new_probs[2], old_probs[2])
     self.assertLess(new_probs[4], old_probs[4])
 
+class CPUTrainingTest(MethodTest):
+  def setUp(self):
+    self.out_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.out_dir)
+
+  def test_cpu_options(self):
+    policy = Policy().type(config.tt())
+    updater = PPOUpdater(
+        policy = policy,
+        opt_lr = 1e-1,
+        num_epochs = 1,
+        vbatch_size = 2,
+        clip_param = 0.1,
+        out_dir = self.out_dir,
+        autocast = 'bfloat16',
+        num_threads = 1,
+        compile = 'eager',
+    )
+
+    state = np.array([[0, 0, 0], [0, 1, 0], [0, 0, 0]], dtype = int)
+    mask = np.array([1, 1, 1, 1, 1, 1, 1, 1, 1])
+    features = policy.extract(state, mask)
+    extras = dict(
+        advantages = np.array([-1., +1.], dtype = config.nt()),
+        log_probs = np.full((2, 9), np.log(1. / 9), dtype = config.nt()),
+        actions = np.array([4, 2], dtype = 'int64'),
+        value_preds = np.zeros(2, dtype = config.nt()),
+        returns = np.zeros(2, dtype = config.nt()),
+    )
+    for k, v in features.items():
+      extras['features_' + k] = np.repeat(np.expand_dims(v, axis = 0), 2, axis = 0)
+    learner.post_prepare(extras)
+    num_threads = torch.get_num_threads()
+    updater.update(TTensorDictDataset({k: torch.from_numpy(v) for k, v in extras.items()}))
+
+    # The compiled forward pass and thread count do not outlive the update
+    self.assertNotIn('forward', vars(policy))
+    self.assertEqual(torch.get_num_threads(), num_threads)
+
+    diag_fname, = glob.glob(os.path.join(self.out_dir, 'diagnostics.*.json'))
+    with open(diag_fname) as fd:
+      diagnostics = json.load(fd)
+    self.assertGreater(diagnostics['train']['_samples_per_sec'], 0)
+
+  def test_invalid_options(self):
+    policy = Policy().type(config.tt())
+    for kwargs in [dict(autocast = 'bf16'), dict(compile = 1), dict(shuffle = 'random')]:
+      with self.assertRaises(ValueError):
+        PPOUpdater(policy = policy, opt_lr = 1e-1, num_epochs = 1, vbatch_size = 2,
+            clip_param = 0.1, **kwargs)
+
+  def test_shuffle(self):
+    policy = Policy().type(config.tt())
+    updater = PPOUpdater(policy = policy, opt_lr = 1e-1, num_epochs = 2, vbatch_size = 8,
+        clip_param = 0.1, shuffle = 'blocks')
+    dataset = _copies(policy, 16)
+    updater.update(dataset)
+    self.assertEqual('blocks', dataset.shuffle)
+
+  def test_num_workers_ignored(self):
+    policy = Policy().type(config.tt())
+    updater = PPOUpdater(policy = policy, opt_lr = 1e-1, num_epochs = 1, vbatch_size = 8,
+        clip_param = 0.1, num_workers = 2)
+    with self.assertLogs(updater.logger, 'WARNING') as logs:
+      updater.update(_copies(policy, 16))
+    self.assertIn('num_workers', logs.output[0])
+
+def _copies(policy, n):
+  '''Returns a dataset of `n` copies of one example, in which action 2 was good.'''
+  state = np.array([[0, 0, 0], [0, 1, 0], [0, 0, 0]], dtype = int)
+  mask = np.array([1, 1, 1, 1, 1, 1, 1, 1, 1])
+  extras = dict(
+      advantages = np.ones(n, dtype = config.nt()),
+      log_probs = np.full((n, 9), np.log(1. / 9), dtype = config.nt()),
+      action_log_probs = np.full(n, np.log(1. / 9), dtype = config.nt()),
+      actions = np.full(n, 2, dtype = 'int64'),
+      value_preds = np.zeros(n, dtype = config.nt()),
+      returns = np.zeros(n, dtype = config.nt()),
+  )
+  for k, v in policy.extract(state, mask).items():
+    extras['features_' + k] = np.repeat(np.expand_dims(v, axis = 0), n, axis = 0)
+  return TTensorDictDataset({k: torch.from_numpy(v) for k, v in extras.items()})
+
+def _update_on_copies(out_fname):
+  '''Runs a PPO update on copies of one example, and saves the policy on the first process.'''
+  torch.manual_seed(0)
+  policy = Policy().type(config.tt())
+  policy_updater = PPOUpdater(
+      policy = policy,
+      opt_lr = 1e-1,
+      num_epochs = 2,
+      vbatch_size = 8,
+      pbatch_size = 2,
+      clip_param = 0.1,
+  )
+  policy_updater.update(_copies(policy, 16))
+
+  if not torch.distributed.is_initialized() or torch.distributed.get_rank() == 0:
+    torch.save(policy.state_dict(), out_fname)
+
+class DistributedTest(MethodTest):
+  def setUp(self):
+    self.out_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.out_dir)
+
+  def test_matches_single_process(self):
+    'Gradients averaged over shards of identical examples are the single process gradients'
+    single_fname = os.path.join(self.out_dir, 'single.pytorch')
+    dist_fname = os.path.join(self.out_dir, 'dist.pytorch')
+    _update_on_copies(single_fname)
+    updater.spawn_distributed(_update_on_copies, 2, (dist_fname,))
+
+    single = torch.load(single_fname)
+    dist = torch.load(dist_fname)
+    for k in single:
+      self.assertTrue(np.allclose(single[k].numpy(), dist[k].numpy(), atol = 1e-6), k)
+
+class AutotuneTest(MethodTest):
+  def _updater(self, policy, **kwargs):
+    return PPOUpdater(
+        policy = policy,
+        opt_lr = 1e-1,
+        num_epochs = 1,
+        vbatch_size = 8,
+        pbatch_size = 'auto',
+        clip_param = 0.1,
+        **kwargs)
+
+  def _autotune(self, **kwargs):
+    policy = Policy().type(config.tt())
+    policy_updater = self._updater(policy, **kwargs)
+    policy_updater.update(_copies(policy, 16))
+    return policy_updater._pbatch_size
+
+  def test_divides_vbatch_size(self):
+    self.assertIn(self._autotune(), [1, 2, 4, 8])
+
+  def test_memory_budget(self):
+    # Nothing fits, so the smallest batch size is used
+    self.assertEqual(1, self._autotune(pbatch_memory_mb = 1e-6))
+
+  def test_max_size(self):
+    self.assertIn(self._autotune(pbatch_max_size = 2), [1, 2])
+
+  def test_restores_state(self):
+    policy = Policy().type(config.tt())
+    state = {k: v.clone() for k, v in policy.state_dict().items()}
+    rng_state = torch.random.get_rng_state()
+    self._updater(policy)._autotune_pbatch_size(_copies(policy, 16))
+
+    for k, v in policy.state_dict().items():
+      self.assertTrue(torch.equal(state[k], v), k)
+    self.assertTrue(torch.equal(rng_state, torch.random.get_rng_state()))
 
 if __name__ == '__main__':
   unittest.main()
\ No newline at end of file
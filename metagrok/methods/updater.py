@@ -1,13 +1,18 @@
 import collections
+import contextlib
 import logging
 import glob
+import multiprocessing as mp
 import os
 import re
+import time
 
 import random
+import socket
 
 import torch
 import torch.cuda
+import torch.distributed as dist
 import torch.autograd as ag
 import torch.nn as nn
 import torch.optim as optim
@@ -16,6 +21,7 @@ import torch.random
 from metagrok import config
 from metagrok import np_json as json
 from metagrok import utils
+from metagrok.torch_utils import data
 from metagrok.torch_utils import dataloader
 
 DEPRECATED_KEYS = [
@@ -27,7 +33,6 @@ class PolicyUpdater(object):
   logger = logging.getLogger('PolicyUpdater')
 
   def __init__(self, **kwargs):
-    # TODO: dataset augmentation
     for key in DEPRECATED_KEYS:
       if key in kwargs:
         raise ValueError('Deprecated PolicyUpdater option: ' + key)
@@ -37,17 +42,51 @@ class PolicyUpdater(object):
     self._entropy_coef = kwargs.get('entropy_coef')
     self._value_coef = kwargs.get('value_coef', 1.)
     self._vbatch_size = kwargs['vbatch_size']
+    # 'auto' picks the fastest of a few divisors of vbatch_size, up to pbatch_max_size, whose
+    # training steps fit in memory (and in pbatch_memory_mb; see _autotune_pbatch_size).
     self._pbatch_size = kwargs.get('pbatch_size', self._vbatch_size)
+    self._pbatch_max_size = kwargs.get('pbatch_max_size')
+    self._pbatch_memory_mb = kwargs.get('pbatch_memory_mb')
+    self._autotune_steps = kwargs.get('autotune_steps', 3)
 
-    assert self._vbatch_size % self._pbatch_size == 0, \
+    assert self._pbatch_size == 'auto' or self._vbatch_size % self._pbatch_size == 0, \
       '%s does not divide %s' % (self._pbatch_size, self._vbatch_size)
 
     self._weight_decay = kwargs.get('weight_decay', 0.)
     self._max_grad_norm = kwargs.get('max_grad_norm')
+    # DataLoader workers, for datasets that are not read in whole batches (see data.supports_batches)
     self._num_workers = kwargs.get('num_workers', 0)
+    # Read the next batch in the background (only for datasets that support whole batches)
+    self._prefetch = kwargs.get('prefetch', False)
+    # How in-memory (TTensorDictDataset) datasets are shuffled between epochs, one of
+    # data.SHUFFLE_STRATEGIES; 'index' and 'blocks' avoid copying the whole dataset. Unset keeps the
+    # dataset's own strategy.
+    self._shuffle = kwargs.get('shuffle')
     self._batch_size_scaling = kwargs.get('batch_size_scaling')
     self._early_stopping = kwargs.get('early_stopping')
 
+    # Training batches go through this function (or the one with this name, e.g.
+    # 'metagrok.pkmn.transforms.scramble_batch') before the losses are computed.
+    self._augment = utils.hydrate(kwargs.get('augment'))
+
+    # CPU training options:
+    # - autocast: dtype to run forward passes in (e.g. 'bfloat16'), where the CPU supports it
+    # - num_threads: intra-op threads to use while updating ('auto' for one per core)
+    # - compile: compile the policy's forward pass (True, or the name of a torch.compile backend)
+    self._autocast = kwargs.get('autocast')
+    self._num_threads = kwargs.get('num_threads')
+    self._compile = kwargs.get('compile', False)
+    self._cpu_dtype = None
+    if self._autocast and self._autocast not in _AUTOCAST_DTYPES:
+      raise ValueError('autocast must be one of %s, not %r' % (_AUTOCAST_DTYPES, self._autocast))
+    if not isinstance(self._compile, (bool, str)):
+      raise ValueError('compile must be a bool or a torch.compile backend, not %r' % self._compile)
+    if self._shuffle and self._shuffle not in data.SHUFFLE_STRATEGIES:
+      raise ValueError('shuffle must be one of %s, not %r' % (data.SHUFFLE_STRATEGIES, self._shuffle))
+    # Set by update: this process's place among the processes updating the policy together
+    self._rank = 0
+    self._world_size = 1
+
     self._opt_lr = kwargs['opt_lr']
     self._optimizer = None
     self._out_dir = kwargs.get('out_dir')
@@ -58,8 +97,51 @@ class PolicyUpdater(object):
   def add_hook(self, hook):
     self._hooks.append(hook)
 
+  def _autocast_dtype(self):
+    '''Returns the dtype to autocast to, or None to train in config.nt().'''
+    if not self._autocast or config.use_cuda():
+      return None
+    # Older versions of torch have neither CPU autocast nor (for bfloat16) the dtype itself.
+    if not hasattr(torch, 'autocast') or not hasattr(torch, self._autocast):
+      self.logger.warning('This version of torch cannot autocast to %s, training in %s',
+          self._autocast, config.nt())
+      return None
+    dtype = getattr(torch, self._autocast)
+    if dtype == torch.bfloat16:
+      try:
+        supported = torch.ops.mkldnn._is_mkldnn_bf16_supported()
+      except (AttributeError, RuntimeError):
+        supported = False
+      if not supported:
+        self.logger.warning('This CPU does not support bfloat16, training in %s', config.nt())
+        return None
+    return dtype
+
+  def _autocast_context(self):
+    if self._cpu_dtype is None:
+      return contextlib.nullcontext()
+    return torch.autocast('cpu', dtype = self._cpu_dtype)
+
+  def _compile_policy(self):
+    '''Replaces the policy's forward pass with a compiled one, until `_uncompile_policy`.'''
+    if not self._compile:
+      return
+    # TorchScript cannot compile forward(**kwargs), so older versions of torch train eagerly.
+    if not hasattr(torch, 'compile'):
+      self.logger.warning('This version of torch has no torch.compile, not compiling the policy')
+      return
+    backend = self._compile if isinstance(self._compile, str) else 'inductor'
+    self.policy.forward = torch.compile(self.policy.forward, backend = backend)
+
+  def _uncompile_policy(self):
+    if 'forward' in vars(self.policy):
+      del self.policy.forward
+
   def _get_batch_iterator(self, dataset):
-    if getattr(dataset, 'in_place_shuffle'):
+    if data.supports_batches(dataset):
+      return data.iterate_batches(dataset, self._pbatch_size, prefetch = self._prefetch)
+
+    if getattr(dataset, 'in_place_shuffle', False):
       dataset.shuffle_()
       itr = dataloader.DataLoader(
           dataset,
@@ -78,7 +160,10 @@ class PolicyUpdater(object):
           drop_last = True)
     return itr
 
-  def _setup(self):
+  def _setup(self, dataset):
+    if self._pbatch_size == 'auto':
+      self._pbatch_size = self._autotune_pbatch_size(dataset)
+
     # set lr to some dummy value
     self._optimizer = optim.Adam(
       self.policy.parameters(),
@@ -87,8 +172,18 @@ class PolicyUpdater(object):
     )
 
     if self._out_dir:
-      utils.mkdir_p(self._out_dir)
-      result = _load_latest(self._out_dir)
+      # Only the first process writes checkpoints; the others load whatever it found or wrote.
+      result = None
+      if self._rank == 0:
+        utils.mkdir_p(self._out_dir)
+        result = _load_latest(self._out_dir)
+        if not result:
+          self._current_epoch = 0
+          self._save_checkpoint(override = 0)
+      if self._world_size > 1:
+        dist.barrier()
+        if self._rank != 0:
+          result = _load_latest(self._out_dir)
 
       if result:
         model_fname = result['model']
@@ -107,12 +202,13 @@ class PolicyUpdater(object):
 
         self.logger.info('Loading model: %s', model_fname)
         self.policy.load_state_dict(torch.load(model_fname))
-      else:
-        self._current_epoch = 0
-        self._save_checkpoint(override = 0)
     else:
       self._current_epoch = 0
 
+    if self._world_size > 1:
+      for tensor in self.policy.state_dict().values():
+        dist.broadcast(tensor, 0)
+
     self._prepare_learning_rate()
 
   def _save_checkpoint(self, override = None, diagnostics = None):
@@ -152,10 +248,11 @@ class PolicyUpdater(object):
     eval_batch = None
 
     dataset_size = len(dataset)
+    start_time = time.time()
     rv = collections.defaultdict(float)
     count = 0
     batch_count = 0
-    pbatches_per_vbatch = self._vbatch_size / self._pbatch_size
+    pbatches_per_vbatch = self._vbatch_size / (self._pbatch_size * self._world_size)
 
     for batch in self._get_batch_iterator(dataset):
       # `batch` is actually a dictionary
@@ -165,7 +262,11 @@ class PolicyUpdater(object):
       if eval_batch is None:
         eval_batch = batch
 
-      losses = self._compute_losses(batch)
+      if optimize and self._augment:
+        batch = self._augment(batch)
+
+      with self._autocast_context():
+        losses = self._compute_losses(batch)
 
       if optimize:
         total_loss = 0
@@ -175,6 +276,7 @@ class PolicyUpdater(object):
         total_loss.backward()
         
         if batch_count % pbatches_per_vbatch == 0:
+          self._reduce_gradients()
           if self._max_grad_norm is not None:
             nn.utils.clip_grad_norm(self.policy.parameters(), self._max_grad_norm)
           self.optimizer.step()
@@ -195,15 +297,80 @@ class PolicyUpdater(object):
 
     del batch
     self.optimizer.zero_grad()
-    return eval_batch, rv
+    rv['_samples_per_sec'] = count / (time.time() - start_time)
+    return eval_batch, self._reduce_metrics(rv)
+
+  def _reduce_gradients(self):
+    '''Averages gradients across the processes updating the policy together, before each step.'''
+    if self._world_size == 1:
+      return
+    grads = [p.grad.data for p in self.policy.parameters() if p.grad is not None]
+    flat = torch.cat([g.reshape(-1) for g in grads])
+    dist.all_reduce(flat)
+    flat /= self._world_size
+    offset = 0
+    for g in grads:
+      g.copy_(flat[offset:offset + g.numel()].view_as(g))
+      offset += g.numel()
+
+  def _reduce_metrics(self, rv):
+    '''Averages losses (and sums throughput) across processes, so they all make the same early
+    stopping decisions.'''
+    if self._world_size == 1:
+      return rv
+    names = sorted(rv)
+    values = torch.tensor([rv[name] for name in names], dtype = torch.float64)
+    dist.all_reduce(values)
+    rv = {}
+    for name, value in zip(names, values.tolist()):
+      rv[name] = value if name == '_samples_per_sec' else value / self._world_size
+    return rv
 
   def update(self, dataset, validation = None):
+    '''Updates the policy on `dataset`.
+
+    When torch.distributed is initialized (see `spawn_distributed`), every process in the group
+    must call this with the same dataset: each trains on its own shard, and gradients are averaged
+    across processes, so that each optimizer step still covers `vbatch_size` examples.
+    '''
+    if self._shuffle and isinstance(dataset, data.TTensorDictDataset):
+      dataset.shuffle = self._shuffle
+    if self._num_workers and data.supports_batches(dataset):
+      self.logger.warning('Ignoring num_workers = %s: %s is read in whole batches, without '
+          'DataLoader workers (set prefetch to read ahead instead)',
+          self._num_workers, type(dataset).__name__)
+
+    if dist.is_available() and dist.is_initialized():
+      self._rank = dist.get_rank()
+      self._world_size = dist.get_world_size()
+      assert self._pbatch_size == 'auto' or \
+        self._vbatch_size % (self._pbatch_size * self._world_size) == 0, \
+        '%s processes with pbatch_size %s do not divide %s' % (
+          self._world_size, self._pbatch_size, self._vbatch_size)
+      dataset = data.shard(dataset, self._rank, self._world_size)
+      if validation:
+        validation = data.shard(validation, self._rank, self._world_size)
+
+    num_threads = torch.get_num_threads()
+    if self._num_threads:
+      torch.set_num_threads(mp.cpu_count() if self._num_threads == 'auto' else self._num_threads)
+      self.logger.info('Using %d threads', torch.get_num_threads())
+    self._cpu_dtype = self._autocast_dtype()
+    self._compile_policy()
+
+    try:
+      self._update(dataset, validation)
+    finally:
+      self._uncompile_policy()
+      torch.set_num_threads(num_threads)
+
+  def _update(self, dataset, validation):
     self.policy.train()
 
     best_validation_loss = None
 
     # set up first epoch
-    self._setup()
+    self._setup(dataset)
 
     while self._current_epoch < self._num_epochs:
       self._prepare_learning_rate()
@@ -233,13 +400,138 @@ class PolicyUpdater(object):
       del eval_batch
 
       self.logger.info(json.dumps(diagnostics))
-      if self._out_dir:
+      if self._out_dir and self._rank == 0:
         self._save_checkpoint(diagnostics = diagnostics)
 
       self._current_epoch += 1
 
     self.policy.eval()
 
+  def _autotune_pbatch_size(self, dataset):
+    '''Times training steps on the first examples of `dataset` at growing physical batch sizes
+    (vbatch_size halved up to _AUTOTUNE_CANDIDATES - 1 times, at most pbatch_max_size), and
+    returns the one with the highest throughput.
+
+    Probing stops at the first batch size that runs out of memory or, where this version of torch
+    can measure it (see _time_training_step), needs more than pbatch_memory_mb. The policy's state
+    and the random state are restored afterwards.
+    '''
+    per_process = self._vbatch_size // self._world_size
+    sizes = [
+        per_process >> k for k in range(_AUTOTUNE_CANDIDATES)
+        if per_process % (1 << k) == 0]
+    max_size = min(len(dataset), self._pbatch_max_size or per_process)
+    candidates = [size for size in reversed(sizes) if size <= max_size] or [sizes[-1]]
+
+    if self._pbatch_memory_mb is not None and not _can_measure_memory():
+      self.logger.warning('This version of torch cannot measure memory use, ignoring '
+          'pbatch_memory_mb (pbatch_max_size still applies)')
+
+    state = {k: v.clone() for k, v in self.policy.state_dict().items()}
+    rng_state = torch.random.get_rng_state()
+    if config.use_cuda():
+      cuda_rng_state = torch.cuda.random.get_rng_state_all()
+
+    throughputs = {}
+    try:
+      for size in candidates:
+        if data.supports_batches(dataset):
+          batch = dataset[0:size]
+        else:
+          batch = dataloader.default_collate([dataset[i] for i in range(size)])
+
+        try:
+          secs, nbytes = self._time_training_step(batch)
+        except RuntimeError as e:
+          if not _is_out_of_memory(e):
+            raise
+          self.logger.info('pbatch_size %d: out of memory', size)
+          self.policy.zero_grad()
+          if config.use_cuda():
+            torch.cuda.empty_cache()
+          break
+
+        if nbytes is None:
+          self.logger.info('pbatch_size %d: %.0f examples/s', size, size / secs)
+        else:
+          mb = nbytes / 2. ** 20
+          self.logger.info('pbatch_size %d: %.0f examples/s, %.0f MB', size, size / secs, mb)
+          if self._pbatch_memory_mb is not None and mb > self._pbatch_memory_mb:
+            # Larger batches only need more memory
+            break
+        throughputs[size] = size / secs
+    finally:
+      self.policy.load_state_dict(state)
+      torch.random.set_rng_state(rng_state)
+      if config.use_cuda():
+        torch.cuda.random.set_rng_state_all(cuda_rng_state)
+
+    if throughputs:
+      best_size = max(throughputs, key = throughputs.get)
+    else:
+      best_size = candidates[0]
+      self.logger.warning('No pbatch_size fits in memory, using %d', best_size)
+
+    if self._world_size > 1:
+      # Every process must take the same number of steps
+      choice = torch.tensor([best_size])
+      dist.broadcast(choice, 0)
+      best_size = int(choice.item())
+
+    self.logger.info('Using pbatch_size %d (%.0f examples/s)',
+        best_size, throughputs.get(best_size, 0.))
+    return best_size
+
+  def _time_training_step(self, batch):
+    '''Returns the mean seconds per forward and backward pass on `batch`, and the bytes it used
+    (None where this version of torch cannot tell).
+
+    On CPU, the bytes are the batch plus the tensors autograd saves for the backward pass; on GPU,
+    the peak allocated memory.
+    '''
+    saved = {}
+    hooks = contextlib.nullcontext()
+    if _can_measure_memory() and not config.use_cuda():
+      params = {p.data.untyped_storage().data_ptr() for p in self.policy.parameters()}
+      def pack(tensor):
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in params:
+          saved[storage.data_ptr()] = storage.nbytes()
+        return tensor
+      hooks = torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor)
+
+    if config.use_cuda():
+      reset = (getattr(torch.cuda, 'reset_peak_memory_stats', None)
+          or getattr(torch.cuda, 'reset_max_memory_allocated', None))
+      if reset:
+        reset()
+
+    # The first step is a warm-up (e.g. for torch.compile)
+    start_time = time.time()
+    for step in range(self._autotune_steps + 1):
+      if step == 1:
+        start_time = time.time()
+      with hooks:
+        with self._autocast_context():
+          losses = self._compute_losses(batch)
+      total_loss = 0
+      for name, loss in losses.items():
+        if not name.startswith('_'):
+          total_loss += loss
+      total_loss.backward()
+      self.policy.zero_grad()
+    if config.use_cuda():
+      torch.cuda.synchronize()
+    secs = (time.time() - start_time) / max(self._autotune_steps, 1)
+
+    if config.use_cuda():
+      nbytes = torch.cuda.max_memory_allocated()
+    elif _can_measure_memory():
+      nbytes = sum(saved.values()) + sum(v.numel() * v.element_size() for v in batch.values())
+    else:
+      nbytes = None
+    return secs, nbytes
+
   def _prepare_learning_rate(self):
     target_lr = None
 
@@ -277,6 +569,40 @@ class PolicyUpdater(object):
   def policy(self):
     return self._policy
 
+def spawn_distributed(fn, num_procs, args = ()):
+  '''Calls fn(*args) in `num_procs` new processes on this machine, which form a torch.distributed
+  process group (gloo backend) for the duration of the call.
+
+  `fn` and `args` must be picklable. The cores are split evenly between the processes (updaters
+  can ask for a different number of threads with num_threads).
+  '''
+  sock = socket.socket()
+  sock.bind(('127.0.0.1', 0))
+  port = sock.getsockname()[1]
+  sock.close()
+  torch.multiprocessing.spawn(_run_distributed,
+      args = (num_procs, port, fn, args), nprocs = num_procs)
+
+def _run_distributed(rank, num_procs, port, fn, args):
+  dist.init_process_group('gloo',
+      init_method = 'tcp://127.0.0.1:%d' % port, rank = rank, world_size = num_procs)
+  torch.set_num_threads(max(1, mp.cpu_count() // num_procs))
+  try:
+    fn(*args)
+  finally:
+    dist.destroy_process_group()
+
+def _can_measure_memory():
+  '''Whether _time_training_step can tell how much memory a training step uses.'''
+  if config.use_cuda():
+    return True
+  graph = getattr(torch.autograd, 'graph', None)
+  return hasattr(graph, 'saved_tensors_hooks') and hasattr(torch.Tensor, 'untyped_storage')
+
+def _is_out_of_memory(e):
+  msg = str(e)
+  return 'out of memory' in msg or "can't allocate memory" in msg
+
 def compute_metrics(policy, batch, losses):
   rv = {}
 
@@ -364,6 +690,12 @@ def _load_latest(path):
 
   return dict(epoch = m_epoch, model = model, optimizer = optimizer, random = rand)
 
+# Dtypes the autocast option accepts
+_AUTOCAST_DTYPES = ['bfloat16', 'float16']
+
+# Physical batch sizes tried by _autotune_pbatch_size
+_AUTOTUNE_CANDIDATES = 6
+
 _MODEL_TEMPLATE = 'model.%s.pytorch'
 _OPTIMIZER_TEMPLATE = 'optimizer.%s.pytorch'
 _RANDOM_TEMPLATE = 'random.%s.pytorch'
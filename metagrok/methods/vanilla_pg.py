@@ -11,6 +11,7 @@ from metagrok.games.tictactoe import Policy
 from metagrok.games import cgpi
 from metagrok.methods import learner
 from metagrok.methods.updater import PolicyUpdater
+from metagrok.torch_utils.data import SHUFFLE_STRATEGIES
 
 class VanillaPGUpdater(PolicyUpdater):
   'Implements the standard Policy Gradient algorithm.'
@@ -45,6 +46,8 @@ def parse_args():
   parser.add_argument('--num-matches', type = int, default = 256)
   parser.add_argument('--max-grad-norm', type = float)
   parser.add_argument('--opt-lr', type = float, default = 7e-4)
+  parser.add_argument('--shuffle', choices = SHUFFLE_STRATEGIES,
+      help = 'How to shuffle the training data between epochs (default: copy).')
   parser.add_argument('--delete-logs', action = 'store_true')
   parser.add_argument('--cuda', action = 'store_true')
   return parser.parse_args()
@@ -69,6 +72,7 @@ def demo(args):
       vbatch_size = args.vbatch_size,
       max_grad_norm = args.max_grad_norm,
       num_epochs = 1,
+      shuffle = args.shuffle,
   )
 
   start_dir = args.start_dir or utils.ts()
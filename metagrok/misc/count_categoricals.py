@@ -1,7 +1,7 @@
 from collections import Counter
 
 from metagrok import np_json as json
-from metagrok import jsons
+from metagrok import battlelogs
 from metagrok import utils
 
 logger = utils.default_logger_setup()
@@ -9,9 +9,9 @@ logger = utils.default_logger_setup()
 def main():
   args = parse_args()
   seen_categoricals = {k: Counter() for k in ['species', 'items', 'abilities', 'moves']}
-  for fname in utils.find(args.dirname, '*.jsons.gz'):
+  for fname in battlelogs.find(args.dirname):
     logger.info('Loading %s', fname)
-    log = next(jsons.stream(fname))
+    log = battlelogs.load(fname)[0]
     pokemon = [poke for side in log['state']['sides'] for poke in side['pokemon']]
     for poke in pokemon:
       for category, key in _stuff_to_read:
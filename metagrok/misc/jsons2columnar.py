@@ -0,0 +1,45 @@
+'''Converts `.jsons.gz` battle logs to the columnar format (see metagrok.battlelogs).'''
+import multiprocessing as mulproc
+import os
+
+from metagrok import battlelogs
+from metagrok import utils
+
+logger = utils.default_logger_setup()
+
+def main():
+  args = parse_args()
+
+  fnames = []
+  for path in args.paths:
+    if os.path.isdir(path):
+      fnames.extend(utils.find(path, '*' + battlelogs.JSONS_EXT))
+    else:
+      fnames.append(path)
+  fnames = sorted(fnames)
+  logger.info('Converting %d files', len(fnames))
+
+  pool = mulproc.Pool(args.num_workers or None)
+  in_bytes = out_bytes = 0
+  for i, (fname, out_fname) in enumerate(pool.imap_unordered(battlelogs.convert, fnames)):
+    in_bytes += os.path.getsize(fname)
+    out_bytes += os.path.getsize(out_fname)
+    if args.delete:
+      os.remove(fname)
+    if (i + 1) % 1000 == 0:
+      logger.info('Converted %d/%d files', i + 1, len(fnames))
+  pool.close()
+
+  logger.info('Done: %d bytes -> %d bytes', in_bytes, out_bytes)
+
+def parse_args():
+  import argparse
+  parser = argparse.ArgumentParser()
+  parser.add_argument('paths', nargs = '+', help = 'Battle log files, or directories to search.')
+  parser.add_argument('--num-workers', type = int, default = 0)
+  parser.add_argument('--delete', action = 'store_true',
+      help = 'Delete each .jsons.gz file once it has been converted.')
+  return parser.parse_args()
+
+if __name__ == '__main__':
+  main()
@@ -1,3 +1,4 @@
+import atexit
 import difflib
 import json
 import io
@@ -39,6 +40,22 @@ def reconstruct(input, output):
   ps_sha = version_command[len('>version '):]
   options = json.loads(start_command[len('>start '):])
 
+  pool = simulator_pool(ps_sha)
+  blocks = try_reconstruct(options, inputlog, original_spectator, data, pool = pool)
+  jsons.dump(output, blocks)
+
+_pool = {}
+
+def simulator_pool(ps_sha):
+  '''Returns a SimulatorPool running Showdown at `ps_sha`.
+
+  Replays recorded at the same commit reuse the checkout, the build and the Node process.
+  '''
+  if _pool.get('sha') == ps_sha:
+    return _pool['pool']
+
+  close_simulator_pool()
+
   try:
     subprocess.check_call(['git', 'checkout', ps_sha], cwd = PS_DIR)
   except subprocess.CalledProcessError:
@@ -49,33 +66,46 @@ def reconstruct(input, output):
   if os.path.isfile(os.path.join(PS_DIR, 'build')):
     subprocess.check_call(['node', 'build'], cwd = PS_DIR)
 
-  blocks = try_reconstruct(options, inputlog, original_spectator, data)
-  jsons.dump(output, blocks)
-
-def try_reconstruct(options, inputlog, original_spectator, data):
-  battle = showdown_stdio.Battle(
-    options = options,
-    prog = PS_DIR + '/pokemon-showdown',
-    timeout_ok = True)
+  _pool['sha'] = ps_sha
+  _pool['pool'] = showdown_stdio.SimulatorPool(PS_DIR + '/pokemon-showdown')
+  return _pool['pool']
+
+@atexit.register
+def close_simulator_pool():
+  '''Shuts down the cached SimulatorPool, if any.'''
+  if _pool:
+    _pool.pop('pool').close()
+    _pool.clear()
+
+def try_reconstruct(options, inputlog, original_spectator, data, pool = None):
+  if pool:
+    battle = pool.battle(options = options, timeout_ok = True)
+  else:
+    battle = showdown_stdio.Battle(
+      options = options,
+      prog = PS_DIR + '/pokemon-showdown',
+      timeout_ok = True)
   blocks = []
 
-  battle._send(inputlog[0]) # >p1 ...
-  battle._send(inputlog[1]) # >p2 ...
-
-  blocks.append(battle.recv())
-
-  for log in inputlog[2:]:
-    battle._send(log)
-  
-    try:
-      block = battle.recv()
-      blocks.append(block)
-      if block['winner']:
-        break
-    except showdown_stdio.BattleInputIncomplete:
-      pass
-  
-  battle.close()
+  # A pooled battle that is not closed stays alive in the pool's process for the rest of the run.
+  try:
+    battle._send(inputlog[0]) # >p1 ...
+    battle._send(inputlog[1]) # >p2 ...
+
+    blocks.append(battle.recv())
+
+    for log in inputlog[2:]:
+      battle._send(log)
+
+      try:
+        block = battle.recv()
+        blocks.append(block)
+        if block['winner']:
+          break
+      except showdown_stdio.BattleInputIncomplete:
+        pass
+  finally:
+    battle.close()
 
   if not all(b['omniscient'] for b in blocks):
     raise ValueError('We skipped a beat in parsing the battle logs')
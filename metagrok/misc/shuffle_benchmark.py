@@ -0,0 +1,107 @@
+'''Compares the TTensorDictDataset shuffle strategies (see metagrok.torch_utils.data) on a rollup.
+
+Every strategy runs in a fresh process, which reports its peak RSS and how long shuffling and one
+pass over the data (in training-sized batches) took. Without --rollup, the data is a synthetic
+rollup with the layout of metagrok.pkmn.models.v4_speedup features, sized like one iteration of
+expts/01.json.
+'''
+import multiprocessing as mulproc
+import resource
+import time
+
+import numpy as np
+import torch
+
+from metagrok import utils
+from metagrok.torch_utils import data
+
+logger = utils.default_logger_setup()
+
+def main():
+  args = parse_args()
+  ctx = mulproc.get_context('spawn')
+  results = ctx.Queue()
+  for shuffle in args.strategies:
+    proc = ctx.Process(target = run, args = (args, shuffle, results))
+    proc.start()
+    result = results.get()
+    proc.join()
+    logger.info(
+        '%-6s: %d rows, %.0f MB data, peak RSS %.0f MB (%.0f MB over data), '
+        'shuffle %.2fs, epoch %.2fs',
+        shuffle, result['rows'], result['data_mb'], result['peak_mb'],
+        result['peak_mb'] - result['loaded_mb'], result['shuffle_secs'], result['epoch_secs'])
+
+def run(args, shuffle, results):
+  arrays = load(args)
+  data_mb = sum(v.nbytes for v in arrays.values()) / 2. ** 20
+  loaded_mb = _peak_mb()
+  dataset = data.TTensorDictDataset(
+      {k: torch.from_numpy(v) for k, v in arrays.items()},
+      shuffle = shuffle, block_size = args.block_size)
+  # The dataset must hold the only references, or copies could not free the originals.
+  del arrays
+
+  shuffle_secs = epoch_secs = 0.
+  for _ in range(args.num_epochs):
+    start = time.time()
+    dataset.shuffle_()
+    shuffle_secs += time.time() - start
+
+    start = time.time()
+    for batch in data.iterate_batches(dataset, args.batch_size):
+      for v in batch.values():
+        v.sum()
+    epoch_secs += time.time() - start
+
+  results.put(dict(
+      rows = len(dataset),
+      data_mb = data_mb,
+      loaded_mb = loaded_mb,
+      peak_mb = _peak_mb(),
+      shuffle_secs = shuffle_secs / args.num_epochs,
+      epoch_secs = epoch_secs / args.num_epochs))
+
+def load(args):
+  if args.rollup:
+    from metagrok.methods import learner
+    return {k: np.array(v) for k, v in learner.load_rollup(args.rollup).items()}
+
+  from metagrok import config
+  from metagrok.pkmn.models import v4_speedup
+
+  n = args.matches * args.rows_per_match
+  rng = np.random.RandomState(0)
+  features = v4_speedup.compiled_extractor(v4_speedup._default_poke_features).allocate(n)
+  arrays = {'features_' + k: v for k, v in features.items()}
+  arrays['features_mask'] = np.zeros((n, 22), dtype = config.nt())
+  arrays['probs'] = np.zeros((n, 22), dtype = config.nt())
+  arrays['log_probs'] = np.zeros((n, 22), dtype = config.nt())
+  arrays['actions'] = np.zeros(n, dtype = 'int64')
+  for k in ['advantages', 'returns', 'value_preds']:
+    arrays[k] = np.zeros(n, dtype = config.nt())
+  # Zeroed pages are not resident until they are written.
+  for v in arrays.values():
+    v[...] = rng.randint(0, 100)
+  return arrays
+
+def _peak_mb():
+  # ru_maxrss is in kilobytes on Linux
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+def parse_args():
+  import argparse
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--rollup', help = 'A rollup (directory or npz) to use instead of synthetic data.')
+  parser.add_argument('--matches', type = int, default = 7680)
+  parser.add_argument('--rows-per-match', type = int, default = 40,
+      help = 'Decisions per match, over both players.')
+  parser.add_argument('--strategies', nargs = '+', choices = data.SHUFFLE_STRATEGIES,
+      default = data.SHUFFLE_STRATEGIES)
+  parser.add_argument('--block-size', type = int, default = 4096)
+  parser.add_argument('--batch-size', type = int, default = 8192)
+  parser.add_argument('--num-epochs', type = int, default = 2)
+  return parser.parse_args()
+
+if __name__ == '__main__':
+  main()
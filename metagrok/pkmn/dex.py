@@ -1,5 +1,6 @@
 from functools import lru_cache
 import glob
+import hashlib
 import logging
 import os
 import re
@@ -55,6 +56,16 @@ class Dex(object):
     self.data = lru_cache(maxsize = None)(self.data)
     self.spec = lru_cache(maxsize = None)(self.spec)
     self.gen7rb_stats = lru_cache(maxsize = None)(self.gen7rb_stats)
+    self.fingerprint = lru_cache(maxsize = None)(self.fingerprint)
+
+  def fingerprint(self):
+    '''Returns a digest of the dex's data files.'''
+    h = hashlib.sha1()
+    for fname in sorted(self._filenames):
+      h.update(os.path.basename(fname).encode('utf-8'))
+      with open(fname, 'rb') as fd:
+        h.update(hashlib.sha1(fd.read()).digest())
+    return h.hexdigest()
   
   def data(self, key):
     full_path = self._json_base_to_full_path[key]
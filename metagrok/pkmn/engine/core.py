@@ -2,6 +2,8 @@ import collections
 import logging
 import six
 
+import gevent.threadpool
+
 from metagrok import config
 from metagrok import fileio
 from metagrok.utils import retrocycle, walk, to_id, const
@@ -26,28 +28,54 @@ def mk_ctx():
 
 def postprocess(state, req):
   _postprocess_engine_state(state)
+  _postprocess_request(state, req)
+
+def postprocess_compact(state, req):
+  _process_compact(state)
+  _postprocess_request(state, req)
+
+def _postprocess_request(state, req):
   if req:
     _update_with_request(state, req)
     _remove_illusions(state)
 
+# How Engine.fetch gets state out of the JS engine:
+# - full: the entire client Battle object, de-cycled and normalized in Python.
+# - compact: only the fields the feature extractors consume, de-cycled and normalized in JS.
+# - diff: like compact, but only the changes since the previous fetch cross the JS boundary, and
+#   Python copies only the parts of its snapshot that change.
+FETCH_MODES = {'full', 'compact', 'diff'}
+
 class Engine(object):
-  def __init__(self, id = None):
+  def __init__(self, id = None, fetch_mode = 'full'):
+    assert fetch_mode in FETCH_MODES, fetch_mode
     self.id = id
+    self.fetch_mode = fetch_mode
     self._ctx = mk_ctx()
+    self._snapshots = {}
 
   def start(self, gid):
     logger.debug('engine.start(%s)', gid)
+    self._snapshots.pop(gid, None)
     return self._ctx.call('engine.start', gid)
 
   def fetch(self, gid, req = None):
-    state = self._fetch(gid)
-    postprocess(state, req)
+    if self.fetch_mode == 'full':
+      state = self._fetch(gid)
+      postprocess(state, req)
+    else:
+      if self.fetch_mode == 'compact':
+        state = self._fetch_compact(gid)
+      else:
+        state = self._fetch_diff(gid)
+      postprocess_compact(state, req)
     if logger.isEnabledFor(3):
       logger.log(3, 'fetch(%s) = %s', gid, state)
     return state
 
   def stop(self, gid):
     logger.debug('engine.stop(%s)', gid)
+    self._snapshots.pop(gid, None)
     return self._ctx.call('engine.stop', gid)
 
   def update(self, gid, changes):
@@ -58,6 +86,130 @@ class Engine(object):
     logger.debug('engine.fetch(%s)', gid)
     return self._ctx.call('engine.fetch', gid)
 
+  def _fetch_compact(self, gid):
+    logger.debug('engine.fetchCompact(%s)', gid)
+    return self._ctx.call('engine.fetchCompact', gid)
+
+  def _fetch_diff(self, gid):
+    '''Keeps a snapshot of the compact state per gid and patches it with the ops from JS.'''
+    logger.debug('engine.fetchDiff(%s)', gid)
+    result = self._ctx.call('engine.fetchDiff', gid)
+    if 'full' in result:
+      snapshot = result['full']
+    else:
+      snapshot = apply_diff(self._snapshots[gid], result['diff'])
+    self._snapshots[gid] = snapshot
+
+    # Snapshots are never changed in place, and postprocess_compact copies what it changes below
+    # the top level, so the state handed out can share everything else with the snapshot.
+    return dict(snapshot)
+
+class EnginePool(object):
+  '''Spreads battles over several engines, each with its own V8 context.
+
+  Every gid is pinned to one engine from `start` until `stop`; new gids go to the engine with the
+  fewest active battles. With more than one engine, each engine makes its calls from a dedicated
+  thread, so JS work for battles on different engines can overlap.
+  '''
+  def __init__(self, num_engines = 1, fetch_mode = 'full', threaded = None, engine_cls = Engine):
+    assert num_engines >= 1, num_engines
+    if threaded is None:
+      threaded = num_engines > 1
+    self.engines = [engine_cls(id = i, fetch_mode = fetch_mode) for i in range(num_engines)]
+    self._threads = [
+        gevent.threadpool.ThreadPool(1) if threaded else None
+        for _ in range(num_engines)]
+    self._gid2idx = {}
+    self._active = [0] * num_engines
+    self._pending = [0] * num_engines
+    self._max_pending = [0] * num_engines
+    self._calls = [0] * num_engines
+    self._total_depth = [0] * num_engines
+
+  @property
+  def fetch_mode(self):
+    return self.engines[0].fetch_mode
+
+  @fetch_mode.setter
+  def fetch_mode(self, fetch_mode):
+    assert fetch_mode in FETCH_MODES, fetch_mode
+    for engine in self.engines:
+      engine.fetch_mode = fetch_mode
+
+  def start(self, gid):
+    assert gid not in self._gid2idx, gid
+    idx = min(range(len(self.engines)), key = lambda i: (self._active[i], self._pending[i]))
+    self._gid2idx[gid] = idx
+    self._active[idx] += 1
+    return self._call(idx, 'start', gid)
+
+  def fetch(self, gid, req = None):
+    return self._call(self._gid2idx[gid], 'fetch', gid, req)
+
+  def update(self, gid, changes):
+    return self._call(self._gid2idx[gid], 'update', gid, changes)
+
+  def stop(self, gid):
+    idx = self._gid2idx.pop(gid)
+    self._active[idx] -= 1
+    return self._call(idx, 'stop', gid)
+
+  def stats(self):
+    '''Returns per-engine active battles and call queue depths.'''
+    return [
+        dict(
+            id = engine.id,
+            active = self._active[i],
+            pending = self._pending[i],
+            max_pending = self._max_pending[i],
+            calls = self._calls[i],
+            mean_pending = float(self._total_depth[i]) / max(self._calls[i], 1),
+        )
+        for i, engine in enumerate(self.engines)]
+
+  def _call(self, idx, name, *args):
+    # `pending` counts this call too, so it is the depth of the engine's queue as seen on arrival.
+    self._pending[idx] += 1
+    self._calls[idx] += 1
+    self._total_depth[idx] += self._pending[idx]
+    self._max_pending[idx] = max(self._max_pending[idx], self._pending[idx])
+    try:
+      fn = getattr(self.engines[idx], name)
+      if self._threads[idx] is None:
+        return fn(*args)
+      return self._threads[idx].apply(fn, args)
+    finally:
+      self._pending[idx] -= 1
+
+  def close(self):
+    for thread in self._threads:
+      if thread is not None:
+        thread.kill()
+
+def apply_diff(obj, ops):
+  '''Returns `obj` with the [path, value] (set) and [path] (delete) operations made by
+  engine.fetchDiff applied. `obj` is left as is: only the containers along the changed paths are
+  copied, and the result shares everything else with it.'''
+  rv = dict(obj)
+  copied = set()
+  for op in ops:
+    path = op[0]
+    parent = rv
+    for i, key in enumerate(path[:-1]):
+      prefix = tuple(path[:i + 1])
+      if prefix not in copied:
+        parent[key] = _shallow_copy(parent[key])
+        copied.add(prefix)
+      parent = parent[key]
+    if len(op) == 2:
+      parent[path[-1]] = op[1]
+    else:
+      del parent[path[-1]]
+  return rv
+
+def _shallow_copy(obj):
+  return dict(obj) if isinstance(obj, dict) else list(obj)
+
 def _postprocess_engine_state(state):
   retrocycle(state)
   _strip_cycles(state)
@@ -194,6 +346,25 @@ def _process(rv):
 
   walk(rv, fn)
 
+def _process_compact(state):
+  '''
+  The part of `_process` that engine.fetchCompact leaves to Python: estimating stats and rescaling
+  hp for every pokemon.
+
+  The sides and pokemon are copied before they are changed (by this and by `_postprocess_request`),
+  as diff mode shares them with the engine's snapshot.
+  '''
+  state['sides'] = [
+      dict(side, pokemon = [dict(val) for val in side['pokemon']]) for side in state['sides']]
+  for side in state['sides']:
+    for val in side['pokemon']:
+      stats = F.estimate_stats(val['baseStats'], val['level'])
+      hp_pct = float(val['hp']) / val['maxhp']
+      val['maxhp'] = stats['hp']
+      val['hp'] = stats['hp'] * hp_pct
+      del stats['hp']
+      val['stats'] = stats
+
 def _reorder_movetrack(move_track, moves):
   rv = []
   idx = []
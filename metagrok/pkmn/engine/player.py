@@ -8,10 +8,11 @@ import numpy as np
 from metagrok import config
 
 from metagrok.pkmn import parser
-from metagrok.pkmn.engine.core import Engine
+from metagrok.pkmn.engine.core import EnginePool, FETCH_MODES
 
 class EnginePkmnPlayer(object):
-  def __init__(self, policy, gid, epsilon = 0., play_best_move = False):
+  def __init__(self, policy, gid, epsilon = 0., play_best_move = False, persist_features = False,
+      skip_forced = False, log_forced_state = True):
     self.gid = gid
     self.policy = policy
     self.blocks = []
@@ -23,6 +24,11 @@ class EnginePkmnPlayer(object):
 
     self._epsilon = epsilon
     self._play_best_move = play_best_move
+    self._persist_features = persist_features
+    # Logged with the features, so rollups only reuse features from the same extractor.
+    self._extract_fingerprint = policy.extract_fingerprint() if persist_features else None
+    self._skip_forced = skip_forced
+    self._log_forced_state = log_forced_state
     assert self._epsilon >= 0. and self._epsilon <= 1.
 
   def update(self, opcode, data):
@@ -47,8 +53,28 @@ class EnginePkmnPlayer(object):
 
     rv = gevent.event.AsyncResult()
     def fn():
-      state = self.engine.fetch(self.gid, self.request)
-      if self.request.get('teamPreview') and self.candidates == 'teampreview':
+      forced = self._forced_action() if self._skip_forced else None
+      state = None
+      if forced is None or self._log_forced_state:
+        state = self.engine.fetch(self.gid, self.request)
+
+      if forced is not None:
+        # Only one legal action: play it without running the policy. value_pred is left out, and
+        # filled in by battlelogs.parse.
+        probs = np.zeros(len(self.candidates), dtype = config.nt())
+        probs[forced] = 1.
+        action_string = self._action_strings()[forced]
+        result = dict(
+          forced = True,
+          probs = probs,
+          log_probs = np.zeros_like(probs),
+          candidates = self.candidates,
+          action = forced,
+          actionString = action_string,
+          _updates = block_updates)
+        if state is not None:
+          result['state'] = state
+      elif self.request.get('teamPreview') and self.candidates == 'teampreview':
         order = [str(i + 1) for i in range(self.request['maxTeamSize'])]
         random.shuffle(order)
         action_string = 'team ' + ','.join(order)
@@ -57,10 +83,18 @@ class EnginePkmnPlayer(object):
           actionString = action_string,
           _updates = block_updates)
       else:
-        result = self.policy.act(state, self.candidates)
+        if self._persist_features:
+          result = self.policy.act(state, self.candidates, return_features = True)
+        else:
+          result = self.policy.act(state, self.candidates)
         mask = np.asarray([1. if c else 0. for c in self.candidates])
         if isinstance(result, gevent.event.AsyncResult):
           result = result.get()
+        if self._persist_features:
+          # Stored flat, under the same names rollup uses (see metagrok.methods.learner).
+          for k, v in result.pop('features').items():
+            result['features_' + k] = v
+          result['extract_fingerprint'] = self._extract_fingerprint
         probs = result['probs']
         probs = (1. - self._epsilon) * probs + (self._epsilon * mask / sum(mask)).astype(config.nt())
         if self._play_best_move:
@@ -69,12 +103,7 @@ class EnginePkmnPlayer(object):
           action = np.random.choice(len(self.candidates), p = probs)
 
         # TODO: why not just use self.candidates?
-        if self.request.get('teamPreview'):
-          all_actions = _teampreview_actions
-        else:
-          all_actions = _singles_actions
-
-        action_string = all_actions[action]
+        action_string = self._action_strings()[action]
         result['candidates'] = self.candidates
         result['state'] = state
         result['action'] = action
@@ -85,6 +114,37 @@ class EnginePkmnPlayer(object):
     gevent.spawn(fn)
     return rv
 
-_engine = Engine()
+  def _forced_action(self):
+    '''Returns the index of the only legal action, or None if there is a choice to make.'''
+    if self.candidates == 'teampreview':
+      return None
+    legal = [i for i, c in enumerate(self.candidates) if c]
+    if len(legal) == 1:
+      return legal[0]
+    return None
+
+  def _action_strings(self):
+    if self.request.get('teamPreview'):
+      return _teampreview_actions
+    return _singles_actions
+
+def set_fetch_mode(fetch_mode):
+  '''Sets how the shared engines fetch state (see metagrok.pkmn.engine.core.FETCH_MODES).'''
+  assert fetch_mode in FETCH_MODES, fetch_mode
+  _engine.fetch_mode = fetch_mode
+
+def set_num_engines(num_engines):
+  '''Replaces the shared engine pool with one of `num_engines` engines. Call before any battles.'''
+  global _engine
+  if num_engines == len(_engine.engines):
+    return
+  fetch_mode = _engine.fetch_mode
+  _engine.close()
+  _engine = EnginePool(num_engines, fetch_mode = fetch_mode)
+
+def engine_stats():
+  return _engine.stats()
+
+_engine = EnginePool()
 _singles_actions = parser.all_actions_singles()
 _teampreview_actions = parser.team_preview_actions_singles()
\ No newline at end of file
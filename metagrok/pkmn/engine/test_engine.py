@@ -2,7 +2,11 @@ import copy
 import json
 import unittest
 
+import numpy as np
+
+from metagrok import config
 from metagrok.pkmn.engine import core
+from metagrok.pkmn.models import v4_speedup as v4
 
 update_with_request = core._update_with_request
 get_side = core._get_side
@@ -48,6 +52,133 @@ class UpdateWithRequestTest(unittest.TestCase):
     postproc(state)
     update_with_request(state, req_zoroark_switch)
 
+class ApplyDiffTest(unittest.TestCase):
+  def test_apply_diff(self):
+    state = {'turn': 1, 'sides': [{'pokemon': [{'hp': 10}, {'hp': 20}], 'sideConditions': {}}]}
+    expected = {
+        'turn': 2,
+        'sides': [{'pokemon': [{'hp': 10}, {'hp': 5, 'fainted': False}], 'sideConditions': {}}],
+        'weather': '+none',
+    }
+    original = copy.deepcopy(state)
+    patched = core.apply_diff(state, [
+      [['turn'], 2],
+      [['sides', 0, 'pokemon', 1, 'hp'], 5],
+      [['sides', 0, 'pokemon', 1, 'fainted'], False],
+      [['weather'], '+none'],
+    ])
+    self.assertEqual(expected, patched)
+
+    # Only the changed containers are copied
+    self.assertEqual(original, state)
+    self.assertIs(state['sides'][0]['pokemon'][0], patched['sides'][0]['pokemon'][0])
+    self.assertIs(state['sides'][0]['sideConditions'], patched['sides'][0]['sideConditions'])
+
+    patched = core.apply_diff(patched, [[['weather']], [['sides', 0, 'pokemon'], []]])
+    self.assertEqual({'turn': 2, 'sides': [{'pokemon': [], 'sideConditions': {}}]}, patched)
+
+class _FakeEngine(object):
+  def __init__(self, id = None, fetch_mode = 'full'):
+    self.id = id
+    self.fetch_mode = fetch_mode
+    self.gids = set()
+
+  def start(self, gid):
+    self.gids.add(gid)
+
+  def fetch(self, gid, req = None):
+    return dict(engine = self.id, gid = gid)
+
+  def update(self, gid, changes):
+    assert gid in self.gids
+
+  def stop(self, gid):
+    self.gids.remove(gid)
+
+class EnginePoolTest(unittest.TestCase):
+  def test_pinning(self):
+    pool = core.EnginePool(3, threaded = False, engine_cls = _FakeEngine)
+    for gid in ['a', 'b', 'c', 'd']:
+      pool.start(gid)
+    self.assertEqual([2, 1, 1], [len(e.gids) for e in pool.engines])
+
+    pool.update('d', [])
+    engine = pool.fetch('d')['engine']
+    self.assertIn('d', pool.engines[engine].gids)
+
+    pool.stop('b')
+    pool.stop('c')
+    pool.start('e')
+    self.assertEqual([2, 1, 0], [len(e.gids) for e in pool.engines])
+    self.assertEqual(['a', 'd', 'e'], sorted(pool._gid2idx))
+
+    stats = pool.stats()
+    self.assertEqual([2, 1, 0], [s['active'] for s in stats])
+    self.assertEqual(9, sum(s['calls'] for s in stats))
+    self.assertEqual(0, sum(s['pending'] for s in stats))
+
+  def test_fetch_mode(self):
+    pool = core.EnginePool(2, threaded = False, engine_cls = _FakeEngine)
+    pool.fetch_mode = 'diff'
+    self.assertEqual(['diff', 'diff'], [e.fetch_mode for e in pool.engines])
+
+def _replay(fname):
+  '''Yields ('update', line) for each line of a pslog, and ('request', req) for each request once
+  the updates that follow it are in, as in a live battle.'''
+  req = None
+  with open(fname) as fd:
+    for line in fd.read().splitlines():
+      if not line.startswith('|request|'):
+        yield 'update', line
+        continue
+      if req:
+        yield 'request', req
+      req = line.split('|', 2)[2].strip()
+      req = json.loads(req) if req else None
+      if req and req.get('wait'):
+        req = None
+  if req:
+    yield 'request', req
+
+class FetchModeTest(unittest.TestCase):
+  def test_same_features(self):
+    for name in ['zmove', 'fainted-zoroark']:
+      fname = '{}/{}.pslog'.format(config.get('test_data_root'), name)
+      engines = {mode: core.Engine(fetch_mode = mode) for mode in sorted(core.FETCH_MODES)}
+      for engine in engines.values():
+        engine.start(name)
+
+      num_decisions = 0
+      # (state, copy of it when fetched) for each diff-mode fetch
+      diff_states = []
+      for opcode, data in _replay(fname):
+        if opcode == 'update':
+          for engine in engines.values():
+            engine.update(name, data)
+          continue
+
+        num_decisions += 1
+        features = {}
+        for mode, engine in engines.items():
+          state = engine.fetch(name, copy.deepcopy(data))
+          features[mode] = v4.extract(state, v4._default_poke_features)
+          if mode == 'diff':
+            diff_states.append((state, copy.deepcopy(state)))
+        for mode in ['compact', 'diff']:
+          self.assertSetEqual(set(features['full']), set(features[mode]))
+          for k, v in features['full'].items():
+            msg = '%s, decision %d, %s: %s' % (name, num_decisions, mode, k)
+            self.assertEqual(v.dtype, features[mode][k].dtype, msg)
+            self.assertTrue(np.array_equal(v, features[mode][k]), msg)
+      self.assertGreater(num_decisions, 1, name)
+
+      # States share parts with the engine's snapshot, but later fetches never change them.
+      for i, (state, expected) in enumerate(diff_states):
+        self.assertEqual(expected, state, '%s, decision %d' % (name, i + 1))
+
+      for engine in engines.values():
+        engine.stop(name)
+
 state_begin = json.loads(r'''{
   "turn": 1,
   "ended": false,
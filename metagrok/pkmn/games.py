@@ -9,10 +9,16 @@ from metagrok.pkmn import parser
 from metagrok.showdown_stdio import Battle
 
 class Game(api.BaseGame):
-  def __init__(self, options = None, prog = None):
+  def __init__(self, options = None, prog = None, pool = None):
+    '''
+    - options: battle options passed to `>start`.
+    - prog: path to the `pokemon-showdown` executable; each battle runs in its own subprocess.
+    - pool: a showdown_stdio.SimulatorPool; if given, battles run in the pool instead of `prog`.
+    '''
     super(Game, self).__init__()
     self.options = options or formats.default()
     self.prog = prog
+    self.pool = pool
 
   @property
   def num_players(self):
@@ -24,7 +30,10 @@ class Game(api.BaseGame):
     p2 = GamePlayer('p2', p2)
     players = {p.name: p for p in [p1, p2]}
 
-    battle = Battle(options = self.options, prog = self.prog)
+    if self.pool:
+      battle = self.pool.battle(options = self.options)
+    else:
+      battle = Battle(options = self.options, prog = self.prog)
 
     while True:
       block = battle.recv()
@@ -1,6 +1,10 @@
 import copy
+import json
 import unittest
 
+import numpy as np
+
+from metagrok import torch_policy
 from metagrok.pkmn import parser
 from metagrok.pkmn.engine.test_engine import state_begin, req_begin
 from metagrok.pkmn.engine.core import postprocess
@@ -33,3 +37,43 @@ class ModelsTest(unittest.TestCase):
     rv = policy.act(state, candidates)
 
     self.assertSetEqual(set(rv.keys()), {'probs', 'log_probs', 'value_pred'})
+
+class ExtractFingerprintTest(unittest.TestCase):
+  def test_covers_dex(self):
+    policy = v4.Policy()
+    fingerprint = policy.extract_fingerprint()
+    self.assertEqual(fingerprint, v4.Policy().extract_fingerprint())
+    self.assertNotEqual(fingerprint, v4.Policy(depth = 2).extract_fingerprint())
+
+    dex_fingerprint = v4.DEX.fingerprint
+    v4.DEX.fingerprint = lambda: 'edited'
+    try:
+      self.assertNotEqual(fingerprint, policy.extract_fingerprint())
+    finally:
+      v4.DEX.fingerprint = dex_fingerprint
+
+  def test_covers_imported_modules(self):
+    digests = torch_policy._source_digests(v4)
+    for name in ['metagrok.pkmn.models.v4_speedup', 'metagrok.pkmn.dex', 'metagrok.pkmn.parser']:
+      self.assertIn(name, digests)
+
+class CompiledExtractorTest(unittest.TestCase):
+  def test_matches_reference_extract(self):
+    features = v4._default_poke_features
+    extractor = v4.CompiledExtractor(features)
+
+    states = []
+    for i in [1, 2, 3]:
+      with open('test-data/pkmn-example-%d.json' % i) as fd:
+        states.append(json.load(fd)['state'])
+
+    batch = extractor.extract_batch(states)
+    for b, state in enumerate(states):
+      expected = v4.extract(state, features)
+      actual = extractor.extract(state)
+      self.assertSetEqual(set(expected.keys()), set(actual.keys()))
+      for k, v in expected.items():
+        self.assertEqual(v.dtype, actual[k].dtype, k)
+        self.assertEqual(v.shape, actual[k].shape, k)
+        self.assertTrue(np.array_equal(v, actual[k]), k)
+        self.assertTrue(np.array_equal(v, batch[k][b]), k)
@@ -85,6 +85,10 @@ class Policy(TorchPolicy):
     self.value_fc1 = nn.Linear(self.shared_size, self.pkmn_size)
     self.value_fc2 = nn.Linear(self.pkmn_size, 1)
 
+  def extract_fingerprint(self):
+    # Features are looked up in the dex, so its data is part of the extractor too.
+    return utils.fingerprint([super(Policy, self).extract_fingerprint(), DEX.fingerprint()])
+
   def extract(self, state, candidates):
     rv = extract(state, self.poke_features)
     candidates = list(candidates)
@@ -83,15 +83,19 @@ class Policy(TorchPolicy):
     self.value_fc1 = nn.Linear(self.shared_size, self.pkmn_size)
     self.value_fc2 = nn.Linear(self.pkmn_size, 1)
 
-  def extract(self, state, candidates):
-    rv = extract(state, self.poke_features)
-    candidates = list(candidates)
-
-    while len(candidates) < len(parser.all_actions_singles()):
-      candidates.append(None)
+  def extract_fingerprint(self):
+    # Features are looked up in the dex, so its data is part of the extractor too.
+    return utils.fingerprint([super(Policy, self).extract_fingerprint(), DEX.fingerprint()])
 
-    rv['mask'] = np.asarray([float(bool(c)) for c in candidates]).astype(config.nt())
+  def extract(self, state, candidates):
+    rv = compiled_extractor(self.poke_features).extract(state)
+    rv['mask'] = _mask(candidates)
+    return rv
 
+  def extract_batch(self, states, candidates_list):
+    '''Like `extract`, but for many states at once; every array gets a leading batch dimension.'''
+    rv = compiled_extractor(self.poke_features).extract_batch(states)
+    rv['mask'] = np.stack([_mask(candidates) for candidates in candidates_list])
     return rv
 
   def forward_common(self, s):
@@ -251,6 +255,14 @@ class Policy(TorchPolicy):
 
     return torch.cat([active, group, side['sideConditions']], 1), pkmns, moves
 
+def _mask(candidates):
+  candidates = list(candidates)
+
+  while len(candidates) < len(parser.all_actions_singles()):
+    candidates.append(None)
+
+  return np.asarray([float(bool(c)) for c in candidates]).astype(config.nt())
+
 # -----------------------------------------------------------------------------
 # Extraction code below this line
 
@@ -453,3 +465,180 @@ _default_poke_features = [
 
 # TODO: Fix this for zoroarks.
 _pad_pokes = pad(6, default_poke(), 'head')
+
+# -----------------------------------------------------------------------------
+# Compiled extraction
+#
+# `extract` above runs every PokeFeature pipeline one closure at a time and allocates a handful of
+# small arrays per feature per pokemon. CompiledExtractor produces exactly the same output, but
+# looks at the feature list once up front and then writes every value straight into arrays that
+# are preallocated for a whole side (or a whole batch of states).
+
+class CompiledExtractor(object):
+  def __init__(self, poke_features):
+    self.poke_features = list(poke_features)
+
+    # Shapes, dtypes and the values for padding pokemon all come from the reference pipeline.
+    self._default_row = poke2feat(default_poke(), self.poke_features)
+    self._writers = [(f.name, _compile_feature(f)) for f in self.poke_features]
+
+    self._layout = collections.OrderedDict()
+    for side in ['player', 'opponent']:
+      self._layout[side + '_activeIdx'] = ((1,), np.dtype('int64'))
+      self._layout[side + '_sideConditions'] = ((SideConditions.size,), np.dtype(config.nt()))
+      for f in self.poke_features:
+        v = self._default_row[f.name]
+        self._layout['%s_pokemon_%s' % (side, f.name)] = ((6,) + v.shape, v.dtype)
+    self._layout['weather'] = ((Weathers.size,), np.dtype(config.nt()))
+    self._layout['weatherMinTimeLeft'] = ((1,), np.dtype(config.nt()))
+    self._layout['weatherTimeLeft'] = ((1,), np.dtype(config.nt()))
+
+  def allocate(self, batch_size):
+    return {
+        k: np.zeros((batch_size,) + shape, dtype = dtype)
+        for k, (shape, dtype) in self._layout.items()}
+
+  def extract(self, state):
+    return {k: v[0] for k, v in self.extract_batch([state]).items()}
+
+  def extract_batch(self, states):
+    out = self.allocate(len(states))
+    for b, state in enumerate(states):
+      self.extract_into(state, out, b)
+    return out
+
+  def extract_into(self, state, out, b):
+    '''Writes the features of `state` into row `b` of arrays made by `allocate`.'''
+    player, opponent = extract_players(state)
+    self._side_into(player, 'player', out, b)
+    self._side_into(opponent, 'opponent', out, b)
+
+    out['weather'][b] = Weathers.nhot(state['weather'])
+    out['weatherMinTimeLeft'][b, 0] = float(state.get('weatherMinTimeLeft', 0.))
+    out['weatherTimeLeft'][b, 0] = float(state.get('weatherTimeLeft', 0.))
+
+  def _side_into(self, side, prefix, out, b):
+    pokes = side['pokemon'][:6]
+
+    active_idx = -1
+    for name, write in self._writers:
+      arr = out['%s_pokemon_%s' % (prefix, name)]
+      arr[b] = 0
+      for i, poke in enumerate(pokes):
+        write(poke, arr, b, i)
+      if len(pokes) < 6:
+        arr[b, len(pokes):] = self._default_row[name]
+
+    for i, poke in enumerate(pokes):
+      if poke['active']:
+        active_idx = i
+    out[prefix + '_activeIdx'][b, 0] = active_idx
+
+    sc = out[prefix + '_sideConditions']
+    sc[b] = 0.
+    for name in side['sideConditions']:
+      sc[b, SideConditions.to_index(name)] = 1.
+
+def compiled_extractor(poke_features):
+  key = id(poke_features)
+  rv = _compiled.get(key)
+  if rv is None or rv.poke_features != list(poke_features):
+    rv = _compiled[key] = CompiledExtractor(poke_features)
+  return rv
+
+_compiled = {}
+
+def _compile_feature(feature):
+  writer = _writers.get(feature.name)
+  if writer is not None and _default_by_name.get(feature.name) is feature:
+    return writer
+
+  # Unknown (or customized) features fall back to running the pipeline.
+  def write(poke, arr, b, i):
+    v = poke
+    for fn in feature.pipeline:
+      v = fn(v)
+    arr[b, i] = box(v)
+  return write
+
+def _write_index(key, spec, default = _nodefault):
+  def write(poke, arr, b, i):
+    if default is _nodefault:
+      if key not in poke:
+        raise ValueError('Could not find %r in %r' % (key, poke))
+      v = poke[key]
+    else:
+      v = poke.get(key, default)
+    arr[b, i, 0] = spec.to_index(v)
+  return write
+
+def _write_scalar(key, fn):
+  def write(poke, arr, b, i):
+    arr[b, i, 0] = fn(poke[key])
+  return write
+
+def _write_abilities(poke, arr, b, i):
+  names = list(poke['abilities'].values())
+  if len(names) > 3:
+    raise ValueError('Found more than %s els in %s' % (3, names))
+  for j, name in enumerate(names):
+    arr[b, i, j] = Abilities.to_index(name)
+
+def _write_boosts(poke, arr, b, i):
+  boosts = poke['boosts']
+  arr[b, i] = np.asarray([boosts.get(k, 0.) for k in Boosts]) / 6.
+
+def _write_moves(poke, arr, b, i):
+  move_track = poke['moveTrack'][-4:]
+  for j, move in enumerate(move_track):
+    arr[b, i, j] = Moves.to_index(move[0])
+
+def _write_pp_used(poke, arr, b, i):
+  move_track = poke['moveTrack'][-4:]
+  for j, move in enumerate(move_track):
+    arr[b, i, j] = move[1]
+
+def _write_stats(poke, arr, b, i):
+  stats = poke['stats']
+  for j, k in enumerate(Stats):
+    arr[b, i, j] = (stats[k] - MeanStats[k]) / StdStats[k] / 3.
+
+def _write_status(poke, arr, b, i):
+  arr[b, i, Statuses.to_index(poke['status'])] = 1.
+
+def _write_types(poke, arr, b, i):
+  types = list(poke['types'])
+  if len(types) > 2:
+    raise ValueError('Found more than %s els in %s' % (2, types))
+  if len(types) < 2:
+    types.extend([None] * (2 - len(types)))
+  for name in types:
+    arr[b, i, Types.to_index(name)] = 1.
+
+def _write_volatiles(poke, arr, b, i):
+  for name in poke.get('volatiles', {}):
+    arr[b, i, Volatiles.to_index(name)] = 1.
+
+_writers = dict(
+    abilities = _write_abilities,
+    ability = _write_index('ability', Abilities),
+    baseAbility = _write_index('baseAbility', Abilities),
+    baseSpecies = _write_index('baseSpecies', Species, None),
+    boosts = _write_boosts,
+    hp = _write_scalar('hp', lambda hp: hp / MaxHp),
+    isActive = _write_scalar('active', float),
+    isFainted = _write_scalar('fainted', float),
+    item = _write_index('item', Items),
+    lastmove = _write_index('lastmove', Moves, None),
+    maxhp = _write_scalar('maxhp', whiten_hp),
+    moves = _write_moves,
+    ppUsed = _write_pp_used,
+    prevItem = _write_index('prevItem', Items, None),
+    species = _write_index('species', Species),
+    stats = _write_stats,
+    status = _write_status,
+    types = _write_types,
+    volatiles = _write_volatiles,
+)
+
+_default_by_name = {f.name: f for f in _default_poke_features}
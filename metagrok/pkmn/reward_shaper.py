@@ -1,3 +1,5 @@
+import numpy as np
+
 class RewardShaper(object):
   def __init__(self, **kwargs):
     self._faint = kwargs.get('faint')
@@ -7,48 +9,21 @@ class RewardShaper(object):
     self._immune = kwargs.get('immune')
     self._iteration = kwargs.get('iteration', 0)
 
+    # Reward per event that happened to the player ([:, 1]) or to the opponent ([:, 0]).
+    self._weights = np.zeros((len(EVENTS), 2))
+    if self._faint is not None:
+      self._weights[_event_idx['faint']] = [+self._faint, -self._faint]
+    if self._fail is not None:
+      self._weights[_event_idx['fail'], 1] = -self._fail
+    if self._supereffective is not None:
+      self._weights[_event_idx['supereffective'], 0] = +self._supereffective
+    if self._resisted is not None:
+      self._weights[_event_idx['resisted'], 0] = -self._resisted
+    if self._immune is not None:
+      self._weights[_event_idx['immune'], 0] = -self._immune
+
   def __call__(self, blobs):
-    for i in reversed(list(range(len(blobs) - 1))):
-      nex = blobs[i + 1]
-      cur = blobs[i]
-      state = cur['state']
-      if isinstance(state, list):
-        state = state[-1]['state']
-      updates = nex['_updates']
-      reward = cur.get('reward', 0.)
-
-      # Determine if player is p1 or p2
-      whoami = state['whoami']
-      if state['sides'][0]['name'] == whoami:
-        who = 'p1'
-      else:
-        assert state['sides'][1]['name'] == whoami
-        who = 'p2'
-
-      for update in updates:
-        if self._faint is not None and update.startswith('|faint|'):
-          if update.split('|')[2].startswith(who):
-            reward -= self._faint
-          else:
-            reward += self._faint
-
-        if self._fail is not None and update.startswith('|-fail|'):
-          if update.split('|')[2].startswith(who):
-            reward -= self._fail
-
-        if self._supereffective is not None and update.startswith('|-supereffective|'):
-          if not update.split('|')[2].startswith(who):
-            reward += self._supereffective
-
-        if self._resisted is not None and update.startswith('|-resisted|'):
-          if not update.split('|')[2].startswith(who):
-            reward -= self._resisted
-
-        if self._immune is not None and update.startswith('|-immune|'):
-          if not update.split('|')[2].startswith(who):
-            reward -= self._immune
-
-      cur['reward'] = reward
+    _apply(blobs, self._weights)
 
 class NewRewardShaper(object):
   def __init__(self, **kwargs):
@@ -58,29 +33,80 @@ class NewRewardShaper(object):
       if kwargs.get(key):
         self._events[key] = kwargs[key]
 
+    # See `mentions`: events that happen to the player count +1, and to the opponent -1 (but only
+    # when zero_sum is set).
+    self._weights = np.zeros((len(EVENTS), 2))
+    for event, delta in self._events.items():
+      self._weights[_event_idx[event], 1] = delta
+      if self._zero_sum:
+        self._weights[_event_idx[event], 0] = -delta
+
   def __call__(self, blobs):
-    for i in reversed(list(range(len(blobs) - 1))):
-      nex = blobs[i + 1]
-      cur = blobs[i]
-      state = cur['state']
-      updates = nex['_updates']
-      reward = cur.get('reward', 0.)
-
-      # Determine if player is p1 or p2
-      whoami = state['whoami']
-      if state['sides'][0]['name'] == whoami:
-        who = 'p1'
-      else:
-        assert state['sides'][1]['name'] == whoami
-        who = 'p2'
-
-      for update in updates:
-        for event, delta in self._events.items():
-          v = mentions(update, _key_to_event[event], who)
-          if v != 0:
-            if v > 0 or self._zero_sum:
-              reward += delta * v
-      cur['reward'] = reward
+    _apply(blobs, self._weights)
+
+def _apply(blobs, weights):
+  '''Adds the reward for the updates following each block to that block, for every block but the
+  last.'''
+  if len(blobs) < 2:
+    return
+  rewards = count_events(blobs).reshape(len(blobs) - 1, -1).dot(weights.reshape(-1))
+  for cur, reward in zip(blobs, rewards.tolist()):
+    cur['reward'] = cur.get('reward', 0.) + reward
+
+def count_events(blobs):
+  '''Counts the events mentioned in the updates that follow every block but the last.
+
+  Returns an int array of shape (len(blobs) - 1, len(EVENTS), 2), where [i, e, 1] is the number of
+  times event EVENTS[e] happened to the player after block i, and [i, e, 0] to the opponent.
+  '''
+  who = _whoami(blobs)
+  blocks, events, mine = tokenize(blobs, who)
+  counts = np.zeros((len(blobs) - 1, len(EVENTS), 2), dtype = 'int64')
+  np.add.at(counts, (blocks, events, mine), 1)
+  return counts
+
+def tokenize(blobs, who):
+  '''Scans the updates of a battle once, for the events in EVENTS.
+
+  Returns parallel arrays with one entry per update that mentions an event: the index of the block
+  it rewards (the one before the update), the index of the event, and whether it happened to `who`.
+  '''
+  blocks = []
+  events = []
+  mine = []
+  for i in range(1, len(blobs)):
+    for update in blobs[i]['_updates']:
+      if not update.startswith('|'):
+        continue
+      end = update.find('|', 1)
+      if end < 0:
+        continue
+      event = _keyword_idx.get(update[1:end])
+      if event is None:
+        continue
+      blocks.append(i - 1)
+      events.append(event)
+      mine.append(update.startswith(who, end + 1))
+  return (
+      np.asarray(blocks, dtype = 'int64'),
+      np.asarray(events, dtype = 'int64'),
+      np.asarray(mine, dtype = 'int64'))
+
+def _whoami(blobs):
+  '''Returns 'p1' or 'p2', for the player whose battle log `blobs` is.'''
+  for blob in blobs:
+    state = blob.get('state')
+    if state is None:
+      continue
+    if isinstance(state, list):
+      state = state[-1]['state']
+
+    whoami = state['whoami']
+    if state['sides'][0]['name'] == whoami:
+      return 'p1'
+    assert state['sides'][1]['name'] == whoami
+    return 'p2'
+  raise ValueError('No block has a state')
 
 def mentions(update, event, who):
   '''
@@ -101,9 +127,15 @@ _key_to_event = dict(
     immune = '|-immune|',
 )
 
+EVENTS = sorted(_key_to_event)
+
+_event_idx = {key: i for i, key in enumerate(EVENTS)}
+# e.g. '-fail' -> the index of 'fail'
+_keyword_idx = {_key_to_event[key][1:-1]: i for i, key in enumerate(EVENTS)}
+
 def create(new_style = False, **kwargs):
   if new_style:
     ctor = NewRewardShaper
   else:
     ctor = RewardShaper
-  return ctor(**kwargs)
\ No newline at end of file
+  return ctor(**kwargs)
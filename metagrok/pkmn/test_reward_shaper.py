@@ -3,7 +3,8 @@ import unittest
 from metagrok import config
 from metagrok import jsons
 
-from metagrok.pkmn.reward_shaper import RewardShaper
+from metagrok.pkmn import reward_shaper
+from metagrok.pkmn.reward_shaper import RewardShaper, NewRewardShaper
 
 def load_test_data():
   return jsons.load('{}/reward-shaper-tests.jsons'.format(config.get('test_data_root')))
@@ -34,5 +35,38 @@ class RewardShaperTest(unittest.TestCase):
     shaper(data)
     self.assertAlmostEqual(data[-10]['reward'], 0.01)
 
+def _reference_rewards(data, events, zero_sum):
+  '''NewRewardShaper, one update and event at a time.'''
+  rv = []
+  for i in range(len(data) - 1):
+    state = data[i]['state']
+    who = 'p1' if state['sides'][0]['name'] == state['whoami'] else 'p2'
+    reward = 0.
+    for update in data[i + 1]['_updates']:
+      for event, delta in events.items():
+        v = reward_shaper.mentions(update, reward_shaper._key_to_event[event], who)
+        if v > 0 or (v < 0 and zero_sum):
+          reward += delta * v
+    rv.append(reward)
+  return rv
+
+class NewRewardShaperTest(unittest.TestCase):
+  def test_matches_reference(self):
+    events = dict(faint = 0.1, fail = 0.02, supereffective = 0.01, resisted = 0.01, immune = 0.03)
+    for zero_sum in [False, True]:
+      data = load_test_data()
+      NewRewardShaper(zero_sum = zero_sum, **events)(data)
+      expected = _reference_rewards(load_test_data(), events, zero_sum)
+      for e, block in zip(expected, data):
+        self.assertAlmostEqual(e, block['reward'], places = 12)
+
+  def test_count_events(self):
+    data = load_test_data()
+    counts = reward_shaper.count_events(data)
+    self.assertEqual((len(data) - 1, len(reward_shaper.EVENTS), 2), counts.shape)
+    faint = reward_shaper.EVENTS.index('faint')
+    self.assertEqual(1, counts[len(data) - 2, faint, 1])
+    self.assertEqual(1, counts[len(data) - 9, faint, 0])
+
 if __name__ == '__main__':
   unittest.main()
\ No newline at end of file
@@ -0,0 +1,66 @@
+import copy
+import unittest
+
+import numpy as np
+import torch
+
+from metagrok import np_json as json
+from metagrok import utils
+from metagrok.pkmn import transforms
+from metagrok.pkmn.models import v4_speedup as v4
+
+def _load(i):
+  with open('test-data/pkmn-example-%d.json' % i) as fd:
+    return json.load(fd)
+
+def _batch(policy, items):
+  fs = policy.extract_batch([item['state'] for item in items], [item['candidates'] for item in items])
+  batch = {'features_' + k: torch.from_numpy(v) for k, v in utils.flatten_dict(fs).items()}
+  batch['probs'] = torch.from_numpy(np.stack([item['probs'] for item in items]).astype('float32'))
+  batch['actions'] = torch.LongTensor([item['action'] for item in items])
+  return batch
+
+class PermuteBatchTest(unittest.TestCase):
+  def test_matches_reorder(self):
+    policy = v4.Policy()
+    items = [_load(i) for i in [1, 2, 3]]
+    rng = np.random.RandomState(0)
+
+    # The examples all have 6 pokemon with 4 moves each on the player side, where reorder and
+    # permute_batch agree exactly. Opponent sides are incomplete, so they are left alone.
+    player_moves = [[list(rng.permutation(4)) for _ in range(6)] for _ in items]
+    player_pkmns = [[0] + list(1 + rng.permutation(5)) for _ in items]
+    identity_moves = [[list(range(4)) for _ in range(6)] for _ in items]
+    identity_pkmns = [list(range(6)) for _ in items]
+
+    expected = []
+    for item, moves, pkmns in zip(items, player_moves, player_pkmns):
+      item = copy.deepcopy(item)
+      transforms.reorder(item, moves, pkmns, [list(range(4))] * 6, list(range(6)))
+      expected.append(item)
+    expected = _batch(policy, expected)
+
+    actual = transforms.permute_batch(
+        _batch(policy, items),
+        torch.LongTensor(player_moves), torch.LongTensor(player_pkmns),
+        torch.LongTensor(identity_moves), torch.LongTensor(identity_pkmns))
+
+    self.assertSetEqual(set(expected.keys()), set(actual.keys()))
+    for k, v in expected.items():
+      self.assertEqual(v.dtype, actual[k].dtype, k)
+      self.assertTrue(torch.equal(v, actual[k]), k)
+
+  def test_scramble_batch(self):
+    policy = v4.Policy()
+    batch = _batch(policy, [_load(i) for i in [1, 2, 3]])
+    scrambled = transforms.scramble_batch(batch, torch.Generator().manual_seed(0))
+    for k, v in batch.items():
+      self.assertEqual(v.shape, scrambled[k].shape, k)
+    # The action that was taken is still legal, and just as likely.
+    rows = torch.arange(3)
+    self.assertTrue(torch.equal(
+        batch['probs'][rows, batch['actions']], scrambled['probs'][rows, scrambled['actions']]))
+    self.assertTrue(bool((scrambled['features_mask'][rows, scrambled['actions']] == 1.).all()))
+
+if __name__ == '__main__':
+  unittest.main()
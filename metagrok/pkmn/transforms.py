@@ -2,6 +2,8 @@
 'Transforms for dataset augmentation on .example.json objects.'
 import random
 
+import torch
+
 from metagrok.pkmn.engine.navigation import extract_players
 
 def scramble(item):
@@ -76,6 +78,87 @@ def reorder(item,
   item['probs'] = probs[candidate_perm]
   item['action'] = candidate_perm.index(item['action'])
 
+# -----------------------------------------------------------------------------
+# Batch augmentation
+#
+# scramble_batch is scramble for a batch of already-extracted features (as produced by
+# metagrok.pkmn.models.v4_speedup.Policy.extract and stored in rollups): it permutes pokemon slots
+# and move slots in the feature tensors, and permutes mask, probs, log_probs and actions to match.
+#
+# Unlike reorder, which drops missing pokemon and moves before the features are padded, the
+# permutations here also move padding slots around. The policy only sees pokemon through their
+# slots (max-pooled, picked by activeIdx, or lined up with the switch actions), so the augmented
+# examples are as valid as those from scramble.
+
+# Pokemon features with a move axis (after the pokemon axis)
+MOVE_FEATURES = ['moves', 'ppUsed']
+
+def scramble_batch(batch, generator = None):
+  '''Applies independent random permutations to every example of `batch` (see permute_batch).'''
+  batch_size = batch['features_mask'].shape[0]
+  perms = []
+  for _ in ['player', 'opponent']:
+    moves = torch.argsort(torch.rand(batch_size, 6, 4, generator = generator), -1)
+    # Slot 0 stays put, like in scramble.
+    keys = torch.rand(batch_size, 6, generator = generator)
+    keys[:, 0] = -1.
+    pkmns = torch.argsort(keys, -1)
+    perms.extend([moves, pkmns])
+  return permute_batch(batch, *perms)
+
+def permute_batch(batch, player_moves, player_pkmns, opponent_moves, opponent_pkmns):
+  '''Returns a copy of `batch` with the same reordering as `reorder`, applied to features.
+
+  - batch: a dict of tensors with a leading batch dimension: features_* (flattened, as in a
+    rollup), and optionally mask-aligned probs, log_probs and actions.
+  - player_moves, opponent_moves: LongTensors (batch_size, 6, 4); [b, i] permutes the moves of the
+    pokemon in slot i.
+  - player_pkmns, opponent_pkmns: LongTensors (batch_size, 6); [b] permutes the pokemon slots.
+  '''
+  rv = dict(batch)
+  active = batch['features_player_activeIdx'].view(-1)
+  for side, moves, pkmns in [
+      ('player', player_moves, player_pkmns),
+      ('opponent', opponent_moves, opponent_pkmns)]:
+    prefix = 'features_%s_pokemon_' % side
+    # The move permutation for each pokemon, in its new slot
+    slot_moves = _gather_rows(moves, pkmns)
+    for k, v in batch.items():
+      if not k.startswith(prefix):
+        continue
+      v = _gather_rows(v, pkmns)
+      if k[len(prefix):] in MOVE_FEATURES:
+        v = _gather_rows(v.reshape((-1,) + v.shape[2:]), slot_moves.reshape(-1, 4)).view(v.shape)
+      rv[k] = v
+
+    k = 'features_%s_activeIdx' % side
+    old = batch[k].view(-1).long()
+    new = torch.argsort(pkmns, -1).gather(1, old.clamp(min = 0).unsqueeze(-1)).squeeze(-1)
+    rv[k] = torch.where(old >= 0, new, old).view(batch[k].shape).type(batch[k].dtype)
+
+  # Candidates: the active pokemon's moves (plain, mega, zmove, ultra) and the switches
+  has_active = (active >= 0).unsqueeze(-1)
+  identity = torch.arange(4).unsqueeze(0).expand(len(active), -1)
+  move_perm = torch.where(
+      has_active, _gather_rows(player_moves, active.clamp(min = 0).long().unsqueeze(-1))[:, 0],
+      identity)
+  candidate_perm = torch.cat(
+      [move_perm, 4 + player_pkmns, 10 + move_perm, 14 + move_perm, 18 + move_perm], 1)
+
+  for k in ['features_mask', 'probs', 'log_probs']:
+    if k in batch:
+      rv[k] = batch[k].gather(1, candidate_perm)
+  if 'actions' in batch:
+    actions = batch['actions']
+    inverse = torch.argsort(candidate_perm, -1)
+    new = inverse.gather(1, actions.view(-1, 1).long()).squeeze(-1)
+    rv['actions'] = new.view(actions.shape).type(actions.dtype)
+  return rv
+
+def _gather_rows(v, idx):
+  '''Returns rv[b, j] = v[b, idx[b, j]].'''
+  return v[torch.arange(v.shape[0]).unsqueeze(-1), idx]
+
 def _apply_perm(old, perm):
   new = []
   for i in perm:
@@ -3,6 +3,7 @@ import copy
 import json
 import logging
 import os
+import queue
 import select
 import signal
 import subprocess
@@ -26,6 +27,9 @@ def _timeout():
 
 _all_pids = set()
 
+_POOL_SCRIPT = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'js', 'simulator-pool.js')
+
 @atexit.register
 def shutdown():
   for pid in _all_pids:
@@ -42,6 +46,11 @@ class Battle(object):
     )
     _all_pids.add(self.proc.pid)
 
+    self._closed = False
+    self._timeout_ok = timeout_ok
+    self._start(options)
+
+  def _start(self, options):
     options = copy.deepcopy(options)
     p1 = options.pop('p1')
     p2 = options.pop('p2')
@@ -50,9 +59,6 @@ class Battle(object):
     self._send('>player p1 {}'.format(json.dumps(p1)))
     self._send('>player p2 {}'.format(json.dumps(p2)))
 
-    self._closed = False
-    self._timeout_ok = timeout_ok
-
   def close(self):
     if not self._closed:
       os.kill(self.proc.pid, signal.SIGINT)
@@ -147,14 +153,7 @@ class Battle(object):
     timeout = 3.0 if self._timeout_ok else 60.
 
     while True:
-      r, _, _ = select.select([self.proc.stdout.fileno()], [], [], timeout)
-      if self.proc.stdout.fileno() not in r:
-        if not self._timeout_ok:
-          _timeout()
-        else:
-          raise BattleInputIncomplete()
-
-      line = self.proc.stdout.readline().decode('utf-8')
+      line = self._readline(timeout)
       self.logger.debug(repr(line))
       line = line.strip()
       if not line:
@@ -164,9 +163,114 @@ class Battle(object):
 
     return rv
 
+  def _readline(self, timeout):
+    r, _, _ = select.select([self.proc.stdout.fileno()], [], [], timeout)
+    if self.proc.stdout.fileno() not in r:
+      self._on_timeout()
+    return self.proc.stdout.readline().decode('utf-8')
+
+  def _on_timeout(self):
+    if not self._timeout_ok:
+      _timeout()
+    else:
+      raise BattleInputIncomplete()
+
   def _flush(self):
     self.proc.stdout.flush()
 
+class SimulatorPool(object):
+  '''A long-lived Node process that simulates many battles at once (see js/simulator-pool.js).
+
+  Starting `pokemon-showdown simulate-battle` loads Node and all of the Showdown data, which
+  dominates the cost of short battles. A pool pays that once; `battle()` returns objects that
+  behave like `Battle` but share the pool's process.
+  '''
+  def __init__(self, prog, script = _POOL_SCRIPT):
+    self.logger = logging.getLogger(__name__)
+    self.proc = subprocess.Popen(
+      ('node', script, os.path.dirname(prog)),
+      stdin = subprocess.PIPE,
+      stdout = subprocess.PIPE,
+      bufsize = 0,
+    )
+    _all_pids.add(self.proc.pid)
+
+    self._lock = threading.Lock()
+    self._queues = {}
+    self._next_bid = 0
+    self._closed = False
+
+    self._reader = threading.Thread(target = self._read_loop)
+    self._reader.daemon = True
+    self._reader.start()
+
+  def battle(self, options = DEFAULT_OPTIONS, timeout_ok = False):
+    return PooledBattle(self, options = options, timeout_ok = timeout_ok)
+
+  @property
+  def num_battles(self):
+    return len(self._queues)
+
+  def close(self):
+    if not self._closed:
+      self.proc.stdin.close()
+      self.proc.wait()
+      _all_pids.remove(self.proc.pid)
+      self._closed = True
+
+  def _register(self):
+    with self._lock:
+      bid = str(self._next_bid)
+      self._next_bid += 1
+      self._queues[bid] = queue.Queue()
+    return bid, self._queues[bid]
+
+  def _release(self, bid):
+    self._send(bid, '>destroy')
+    with self._lock:
+      del self._queues[bid]
+
+  def _send(self, bid, msg):
+    with self._lock:
+      self.proc.stdin.write(('%s\t%s\n' % (bid, msg)).encode('utf-8'))
+
+  def _read_loop(self):
+    for line in self.proc.stdout:
+      bid, _, content = line.decode('utf-8').rstrip('\n').partition('\t')
+      q = self._queues.get(bid)
+      if q is not None:
+        q.put(content + '\n')
+      else:
+        self.logger.debug('Dropping output for finished battle %s: %r', bid, content)
+
+class PooledBattle(Battle):
+  '''A `Battle` whose messages are multiplexed over a SimulatorPool's process.'''
+  def __init__(self, pool, options = DEFAULT_OPTIONS, timeout_ok = False):
+    self.logger = logging.getLogger(__name__)
+    self._pool = pool
+    self._bid, self._queue = pool._register()
+    self._closed = False
+    self._timeout_ok = timeout_ok
+    self._start(options)
+
+  def close(self):
+    if not self._closed:
+      self._pool._release(self._bid)
+      self._closed = True
+
+  def _send(self, msg):
+    self.logger.debug(msg)
+    self._pool._send(self._bid, msg)
+
+  def _readline(self, timeout):
+    try:
+      return self._queue.get(timeout = timeout)
+    except queue.Empty:
+      self._on_timeout()
+
+  def _flush(self):
+    pass
+
 def _parse_update(update):
   logs = {k: [] for k in ['spectator', 'p1', 'p2', 'omniscient']}
   itr = iter(update)
@@ -0,0 +1,64 @@
+import unittest
+
+import gevent
+import numpy as np
+
+from metagrok.batch_inference import BatchedPolicy
+
+class FakePolicy(object):
+  'Echoes the features back, and records the size of every batch it was asked to evaluate.'
+  def __init__(self):
+    self.batch_sizes = []
+
+  def extract(self, state, candidates):
+    return dict(x = np.asarray([state], dtype = 'float32'))
+
+  def act_batch(self, features_list):
+    self.batch_sizes.append(len(features_list))
+    return [
+        dict(value_pred = float(f['x'][0]), probs = f['x'] * 2, log_probs = f['x'] * 3)
+        for f in features_list]
+
+class BatchedPolicyTest(unittest.TestCase):
+  def test_concurrent_requests_share_forward_pass(self):
+    fake = FakePolicy()
+    policy = BatchedPolicy(fake, max_batch_size = 8, max_wait = 0.01)
+
+    def act(i):
+      return policy.act(i, None).get()
+
+    jobs = [gevent.spawn(act, i) for i in range(20)]
+    gevent.joinall(jobs, raise_error = True)
+    policy.close()
+
+    for i, job in enumerate(jobs):
+      self.assertEqual(float(i), job.value['value_pred'])
+      self.assertEqual(2. * i, job.value['probs'][0])
+      self.assertEqual(3. * i, job.value['log_probs'][0])
+
+    self.assertEqual(20, sum(fake.batch_sizes))
+    self.assertEqual([8, 8, 4], fake.batch_sizes)
+
+  def test_partial_batch_after_wait(self):
+    fake = FakePolicy()
+    policy = BatchedPolicy(fake, max_batch_size = 8, max_wait = 0.)
+
+    result = policy.act(5, None).get()
+    policy.close()
+
+    self.assertEqual(5., result['value_pred'])
+    self.assertEqual([1], fake.batch_sizes)
+
+  def test_return_features(self):
+    fake = FakePolicy()
+    policy = BatchedPolicy(fake, max_batch_size = 8, max_wait = 0.)
+
+    with_features = policy.act(5, None, return_features = True).get()
+    without_features = policy.act(5, None).get()
+    policy.close()
+
+    self.assertEqual([5.], with_features['features']['x'].tolist())
+    self.assertNotIn('features', without_features)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,147 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from metagrok import battlelogs
+
+def _blocks():
+  state = dict(turn = 1, weather = '+none', sides = [dict(pokemon = [dict(hp = 100, moveTrack = [])])])
+  blocks = []
+  for i in range(5):
+    state = dict(state, turn = i + 1, sides = [dict(pokemon = [
+        dict(hp = 100 - 10 * i, moveTrack = [['tackle', i]] if i else [])])])
+    if i == 3:
+      state['pseudoWeather'] = ['trickroom']
+    probs = np.asarray([0.25, 0.75, 0., 0.], dtype = 'float32')
+    blocks.append(dict(
+        state = state,
+        candidates = ['move 1', 'move 2', None, None],
+        probs = probs,
+        log_probs = np.log(probs + 1e-8),
+        value_pred = 0.1 * i,
+        action = i % 2,
+        actionString = 'move %d' % (i % 2 + 1),
+        _updates = ['|turn|%d' % i]))
+  blocks.append(dict(result = 'winner', _updates = ['|win|p1']))
+  return blocks
+
+class ColumnarTest(unittest.TestCase):
+  def setUp(self):
+    self.dirname = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.dirname)
+
+  def _log(self, cls):
+    logger = cls('p1', self.dirname)
+    for block in _blocks():
+      logger.log(block)
+    logger.close()
+
+  def test_roundtrip(self):
+    self._log(battlelogs.ColumnarBattleLogger)
+    fname = os.path.join(self.dirname, 'p1.cols.npz')
+
+    expected = _blocks()
+    actual = battlelogs.load(fname)
+    self.assertEqual(len(expected), len(actual))
+    for e, a in zip(expected, actual):
+      self.assertSetEqual(set(e.keys()), set(a.keys()))
+      for k, v in e.items():
+        if isinstance(v, np.ndarray):
+          self.assertEqual(v.dtype, a[k].dtype)
+          self.assertTrue(np.array_equal(v, a[k]))
+        else:
+          self.assertEqual(v, a[k])
+
+    self.assertEqual(6, battlelogs.num_blocks(fname))
+    self.assertEqual('winner', battlelogs.result_only(fname))
+
+  def test_copy(self):
+    self._log(battlelogs.ColumnarBattleLogger)
+    fname = os.path.join(self.dirname, 'p1.cols.npz')
+
+    # Blocks may be modified in place by default, as with jsons logs
+    blocks = battlelogs.load(fname)
+    blocks[0]['state']['weather'] = 'raindance'
+    blocks[0]['probs'][0] = 1.
+    self.assertEqual('+none', blocks[1]['state']['weather'])
+    self.assertEqual(0.25, blocks[1]['probs'][0])
+    self.assertEqual(0.25, battlelogs.load(fname)[0]['probs'][0])
+
+    # Without copying, unchanged parts of consecutive states are shared
+    blocks = battlelogs.load(fname, copy = False)
+    self.assertIs(blocks[3]['state']['pseudoWeather'], blocks[4]['state']['pseudoWeather'])
+
+  def test_parse_matches_jsons(self):
+    self._log(battlelogs.BattleLogger)
+    jsons_fname = os.path.join(self.dirname, 'p1.jsons.gz')
+    _, cols_fname = battlelogs.convert(jsons_fname)
+    # The battle is found once, as its columnar log.
+    self.assertListEqual([cols_fname], list(battlelogs.find(self.dirname)))
+
+    expected = battlelogs.parse(jsons_fname, gamma = 0.9, lam = 0.8)
+    actual = battlelogs.parse(cols_fname, gamma = 0.9, lam = 0.8)
+    for e, a in zip(expected, actual):
+      for k in ['state', 'action', 'value_pred', 'return', 'advantage', 'candidates']:
+        self.assertEqual(e[k], a[k])
+
+class ComputeReturnsTest(unittest.TestCase):
+  def test_batch_matches_per_battle(self):
+    rng = np.random.RandomState(0)
+    battles = []
+    for length in [1, 7, 3, 12]:
+      path = [dict(value_pred = v, reward = r) for v, r in zip(rng.randn(length), rng.randn(length))]
+      battles.append((path, float(rng.choice([-1., 0., 1.]))))
+
+    value_preds, rewards, dones = [], [], []
+    for path, final_reward in battles:
+      value_preds.extend(t['value_pred'] for t in path)
+      rewards.extend(t['reward'] for t in path[:-1])
+      rewards.append(final_reward)
+      dones.extend([False] * (len(path) - 1) + [True])
+      battlelogs.compute_returns(path, final_reward, gamma = 0.9, lam = 0.8)
+
+    rv = battlelogs.compute_returns_batch(value_preds, rewards, dones, gamma = 0.9, lam = 0.8)
+    expected = [t for path, _ in battles for t in path]
+    for k in ['advantage', 'return', 'std_return']:
+      np.testing.assert_allclose([t[k] for t in expected], rv[k])
+
+class ForcedTest(unittest.TestCase):
+  def setUp(self):
+    self.dirname = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.dirname)
+
+  def _parse(self, blocks):
+    fname = os.path.join(self.dirname, 'p1.cols.npz')
+    battlelogs.dump_columnar(fname, blocks)
+    return battlelogs.parse(fname, gamma = 0.9, lam = 0.8)
+
+  def test_borrowed_value_pred(self):
+    blocks = _blocks()
+    for i in [2, 4]:
+      del blocks[i]['value_pred']
+      blocks[i]['forced'] = True
+    ts = self._parse(blocks)
+    self.assertEqual(5, len(ts))
+    self.assertAlmostEqual(0.3, ts[2]['value_pred'])
+    self.assertEqual(1.0, ts[4]['value_pred'])
+    self.assertAlmostEqual(0.0, ts[4]['advantage'])
+
+  def test_stateless_dropped(self):
+    blocks = _blocks()
+    del blocks[2]['state']
+    del blocks[2]['value_pred']
+    blocks[2]['forced'] = True
+    blocks[2]['reward'] = 0.5
+    ts = self._parse(blocks)
+    self.assertEqual([0, 1, 3, 4], [t['state']['turn'] - 1 for t in ts])
+    self.assertEqual(0.5, ts[1]['reward'])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,99 @@
+import functools
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from metagrok import datasets
+from metagrok import jsons
+
+class _Policy(object):
+  def __init__(self, scale = 1.):
+    self.scale = scale
+
+  def extract(self, state, candidates):
+    return dict(turn = np.asarray([self.scale * state['turn']], dtype = 'float32'))
+
+  def extract_fingerprint(self):
+    return str(self.scale)
+
+def _shift(item, amount):
+  item['advantage'] += amount
+  return item
+
+class _Shift(object):
+  def __init__(self, amount):
+    self.amount = amount
+
+  def __call__(self, item):
+    return _shift(item, self.amount)
+
+def _example(i):
+  return dict(
+      state = dict(turn = i), candidates = ['move 1'], action = 0, advantage = 0.5 * i,
+      value_pred = 0., **{'return': 1.})
+
+class ExampleJsonsDatasetTest(unittest.TestCase):
+  def setUp(self):
+    self.dirname = tempfile.mkdtemp()
+    self.fnames = []
+    for i, (lo, hi) in enumerate([(0, 3), (3, 3), (3, 10)]):
+      fname = os.path.join(self.dirname, '%d.jsons.gz' % i)
+      with gzip.open(fname, 'wt') as fd:
+        jsons.dump(fd, [_example(j) for j in range(lo, hi)])
+      self.fnames.append(fname)
+
+  def tearDown(self):
+    shutil.rmtree(self.dirname)
+
+  def test_index(self):
+    raw_fname, offsets = jsons.index(self.fnames[2])
+    self.assertEqual(8, len(offsets))
+    fd = os.open(raw_fname, os.O_RDONLY)
+    try:
+      self.assertIn('"turn": 5', jsons.read_line(fd, offsets, 2))
+    finally:
+      os.close(fd)
+
+  def test_random_access(self):
+    dataset = datasets.ExampleJsonsDataset(self.fnames, _Policy())
+    self.assertEqual(10, len(dataset))
+    for i in np.random.RandomState(0).permutation(10):
+      item = dataset[i]
+      self.assertEqual(i, item['features_turn'][0])
+      self.assertEqual(0.5 * i, item['advantages'][0])
+    self.assertEqual(9, dataset[-1]['features_turn'][0])
+    with self.assertRaises(IndexError):
+      dataset[10]
+
+  def test_featurized(self):
+    cache_root = os.path.join(self.dirname, 'cache')
+    source = datasets.ExampleJsonsDataset(self.fnames, _Policy())
+    dataset = datasets.FeaturizedDataset(source, cache_root)
+    self.assertEqual(10, len(dataset))
+    for i in range(10):
+      self.assertEqual(i, dataset[i]['features_turn'][0])
+      self.assertEqual(0.5 * i, dataset[i]['advantages'][0])
+    self.assertEqual(dataset.dirname, datasets.FeaturizedDataset(source, cache_root).dirname)
+
+    # A different extractor gets its own cache.
+    rescaled = datasets.FeaturizedDataset(
+        datasets.ExampleJsonsDataset(self.fnames, _Policy(2.)), cache_root)
+    self.assertNotEqual(dataset.dirname, rescaled.dirname)
+    self.assertEqual(18, rescaled[9]['features_turn'][0])
+
+  def test_cache_key_transform(self):
+    def key(transform):
+      return datasets.cache_key(
+          datasets.ExampleJsonsDataset(self.fnames, _Policy(), transform = transform))
+
+    # Transforms with parameters are keyed on them, not just on their type.
+    for mk in [lambda amount: functools.partial(_shift, amount = amount), _Shift]:
+      self.assertEqual(key(mk(1)), key(mk(1)))
+      self.assertNotEqual(key(mk(1)), key(mk(2)))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,65 @@
+import json
+import os
+import unittest
+
+from metagrok import config
+from metagrok import formats
+from metagrok import showdown_stdio
+
+PROG = '{}/{}/pokemon-showdown'.format(
+    config.get('showdown_root'),
+    config.get('showdown_server_dir'))
+
+def _options(seed):
+  options = dict(formats.get('gen7randombattle'))
+  options['seed'] = seed
+  return options
+
+def _play(battles, max_blocks = 1000):
+  '''Plays `battles` to the end, one step of each in turn, with every player making the default
+  choice. Returns the blocks of each battle.'''
+  blocks = [[] for _ in battles]
+  live = list(range(len(battles)))
+  while live:
+    for i in list(live):
+      block = battles[i].recv()
+      blocks[i].append(block)
+      assert len(blocks[i]) < max_blocks, 'battle %d did not end' % i
+      if block['winner']:
+        live.remove(i)
+        continue
+
+      actions = {}
+      for name in ['p1', 'p2']:
+        for req in block[name + 'req']:
+          if req.startswith('|request|') and not json.loads(req[len('|request|'):]).get('wait'):
+            actions[name] = 'default'
+      battles[i].send(actions.get('p1'), actions.get('p2'))
+  return blocks
+
+@unittest.skipUnless(os.path.isfile(PROG), 'needs the Showdown server at %s' % PROG)
+class SimulatorPoolTest(unittest.TestCase):
+  def test_same_blocks(self):
+    seeds = [[1, 2, 3, 4], [5, 6, 7, 8]]
+
+    expected = []
+    for seed in seeds:
+      battle = showdown_stdio.Battle(options = _options(seed), prog = PROG)
+      expected.extend(_play([battle]))
+      battle.close()
+
+    pool = showdown_stdio.SimulatorPool(PROG)
+    try:
+      battles = [pool.battle(options = _options(seed)) for seed in seeds]
+      self.assertEqual(2, pool.num_battles)
+      actual = _play(battles)
+      for battle in battles:
+        battle.close()
+      self.assertEqual(0, pool.num_battles)
+    finally:
+      pool.close()
+
+    self.assertEqual(expected, actual)
+
+if __name__ == '__main__':
+  unittest.main()
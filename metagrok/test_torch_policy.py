@@ -0,0 +1,39 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import torch
+
+from metagrok import torch_policy
+
+class SharedWeightsTest(unittest.TestCase):
+  def setUp(self):
+    self.dirname = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.dirname)
+
+  def test_share_and_load(self):
+    tag = 'metagrok.games.tictactoe.Policy'
+    policy = torch_policy.load(tag)
+    model_file = os.path.join(self.dirname, 'model.pytorch')
+    torch.save(policy.state_dict(), model_file)
+
+    shared_tag = torch_policy.share('%s:%s' % (tag, model_file), self.dirname)
+    self.assertTrue(shared_tag.endswith(torch_policy.SHARED_EXT))
+    self.assertEqual(shared_tag, torch_policy.share('%s:%s' % (tag, model_file), self.dirname))
+
+    p1 = torch_policy.load(shared_tag)
+    p2 = torch_policy.load(shared_tag)
+    for k, v in policy.state_dict().items():
+      self.assertTrue(torch.equal(v, p1.state_dict()[k]), k)
+
+    # Writes stay private to the process (and policy) that makes them.
+    next(p1.parameters()).data.fill_(3.)
+    self.assertFalse(torch.equal(next(p1.parameters()).data, next(p2.parameters()).data))
+    p3 = torch_policy.load(shared_tag)
+    self.assertTrue(torch.equal(next(policy.parameters()).data, next(p3.parameters()).data))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,5 +1,10 @@
-import time
+import hashlib
+import inspect
+import json
 import logging
+import os
+import sys
+import time
 import numpy as np
 
 import torch
@@ -13,6 +18,23 @@ _STRICT_DEFAULT_FALSE = object()
 
 logger = logging.getLogger(__name__)
 
+def _source_digests(module):
+  '''Returns {module name: digest of its source} for `module` and the metagrok modules it imports
+  from (directly).'''
+  names = {module.__name__}
+  for v in vars(module).values():
+    name = v.__name__ if inspect.ismodule(v) else getattr(v, '__module__', None)
+    if isinstance(name, str) and name.split('.')[0] == 'metagrok':
+      names.add(name)
+
+  rv = {}
+  for name in sorted(names):
+    fname = name in sys.modules and inspect.getsourcefile(sys.modules[name])
+    if fname:
+      with open(fname, 'rb') as fd:
+        rv[name] = hashlib.sha1(fd.read()).hexdigest()
+  return rv
+
 class TorchPolicy(nn.Module):
   @staticmethod
   def unpkl(arg):
@@ -30,15 +52,37 @@ class TorchPolicy(nn.Module):
   def extract(self, state, candidates):
     raise NotImplementedError
 
+  def extract_fingerprint(self):
+    '''Returns a digest that changes whenever `extract` may produce different features.
+
+    It covers the policy's class, its constructor arguments, and the source of the module that
+    defines it (e.g. its default feature lists) and of the metagrok modules that module imports
+    from (e.g. the parser and the dex code). Data files that features are looked up in are not
+    covered here; policies that use them add them (see v4_speedup.Policy).
+    '''
+    cls = type(self)
+    module = sys.modules[cls.__module__]
+    return utils.fingerprint([cls, _source_digests(module), self._mg_args, self._mg_kwargs])
+
   def forward(self, **kwargs):
     raise NotImplementedError
 
-  def act(self, state, candidates):
+  def act(self, state, candidates, return_features = False):
     features = self.extract(state, candidates)
+    rv = self.act_batch([features])[0]
+    if return_features:
+      rv['features'] = features
+    return rv
 
+  def act_batch(self, features_list):
+    '''Runs a single forward pass over several already-extracted feature dicts.
+
+    Returns a list of dicts (value_pred, probs, log_probs), one per element of `features_list`.
+    '''
     torch_features = {}
-    for k, v in list(features.items()):
-      v = ag.Variable(torch.from_numpy(np.expand_dims(v, axis = 0)))
+    for k in features_list[0]:
+      v = np.stack([features[k] for features in features_list], axis = 0)
+      v = ag.Variable(torch.from_numpy(v))
       if config.use_cuda():
         v = v.cuda()
       torch_features[k] = v
@@ -54,15 +98,17 @@ class TorchPolicy(nn.Module):
       p = p.cpu()
       lp = lp.cpu()
 
-    vp = np.asscalar(vp.numpy())
-    p = p.numpy().flatten()
-    lp = lp.numpy().flatten()
+    vp = vp.numpy().reshape(len(features_list))
+    p = p.numpy().reshape(len(features_list), -1)
+    lp = lp.numpy().reshape(len(features_list), -1)
 
-    return dict(
-        value_pred = vp,
-        probs = p,
-        log_probs = lp,
-    )
+    return [
+        dict(
+            value_pred = vp[i].item(),
+            probs = p[i],
+            log_probs = lp[i],
+        )
+        for i in range(len(features_list))]
 
   def evaluate_batch(self, features, actions, keys = None):
     rv = {}
@@ -95,6 +141,87 @@ class TorchPolicy(nn.Module):
       strict = False
     return super(TorchPolicy, self).load_state_dict(state_dict, strict)
 
+def load_state(policy, arg):
+  '''Loads the weights named by the policy tag `arg` into `policy`, which must be of its class.'''
+  class_name, model_file = arg.split(':', 1)
+  cls = utils.hydrate(class_name)
+  if type(policy) is not cls:
+    raise ValueError('Cannot load %s into a %s' % (arg, type(policy).__name__))
+  _load_weights(policy, model_file)
+  return policy
+
+# -----------------------------------------------------------------------------
+# Shared weights
+#
+# A `.mmap` weights file holds every tensor of a state dict back to back (each 64-byte aligned),
+# next to a `.mmap.json` index of names, dtypes, shapes and offsets. Policies loaded from one map
+# their parameters straight from the file, so any number of processes loading the same file share
+# a single copy of the weights in the page cache.
+#
+# The mapping is copy-on-write: in-place updates (e.g. nn.Embedding's max_norm renormalization)
+# only privatize the pages they touch, and never reach the file.
+
+SHARED_EXT = '.mmap'
+
+def share(arg, dirname):
+  '''Writes the weights of policy tag `arg` to a shared weights file, returning its policy tag.'''
+  if arg.startswith(',') or ':' not in arg:
+    return arg
+  class_name, model_file = arg.split(':', 1)
+  if model_file.endswith(SHARED_EXT):
+    return arg
+
+  st = os.stat(model_file)
+  key = '%s:%s:%s' % (os.path.abspath(model_file), st.st_size, st.st_mtime)
+  fname = os.path.join(dirname, hashlib.sha1(key.encode('utf-8')).hexdigest() + SHARED_EXT)
+  if not os.path.isfile(fname + '.json'):
+    save_shared(torch.load(model_file), fname)
+  return '%s:%s' % (class_name, fname)
+
+def save_shared(state_dict, fname):
+  index = []
+  offset = 0
+  for name, tensor in state_dict.items():
+    arr = tensor.detach().cpu().numpy()
+    offset = (offset + 63) // 64 * 64
+    index.append(dict(name = name, dtype = arr.dtype.name, shape = list(arr.shape), offset = offset))
+    offset += arr.nbytes
+
+  mm = np.memmap(fname, dtype = 'uint8', mode = 'w+', shape = (max(offset, 1),))
+  for entry, tensor in zip(index, state_dict.values()):
+    arr = tensor.detach().cpu().numpy()
+    mm[entry['offset']:entry['offset'] + arr.nbytes] = np.frombuffer(arr.tobytes(), dtype = 'uint8')
+  mm.flush()
+  del mm
+
+  # The index is written last; its presence means the weights file is complete.
+  with open(fname + '.json', 'w') as fd:
+    json.dump(index, fd)
+
+def load_shared(policy, fname):
+  with open(fname + '.json') as fd:
+    index = json.load(fd)
+  mm = np.memmap(fname, dtype = 'uint8', mode = 'c')
+
+  tensors = dict(policy.named_parameters())
+  tensors.update(policy.named_buffers())
+  for entry in index:
+    if entry['name'] not in tensors:
+      continue
+    dtype = np.dtype(entry['dtype'])
+    count = int(np.prod(entry['shape']))
+    arr = np.frombuffer(mm, dtype = dtype, count = count, offset = entry['offset'])
+    target = tensors[entry['name']]
+    assert list(target.shape) == entry['shape'], (entry['name'], target.shape, entry['shape'])
+    target.data = torch.from_numpy(arr.reshape(entry['shape']))
+  return policy
+
+def _load_weights(policy, model_file):
+  if model_file.endswith(SHARED_EXT):
+    load_shared(policy, model_file)
+  else:
+    policy.load_state_dict(torch.load(model_file))
+
 def load(arg):
   if arg.startswith(','):
     class_name = arg[1:]
@@ -110,7 +237,6 @@ def load(arg):
 
   policy = utils.hydrate(class_name)()
   if model_file:
-    state_dict = torch.load(model_file)
-    policy.load_state_dict(state_dict)
+    _load_weights(policy, model_file)
   
   return policy
@@ -1,6 +1,9 @@
 import os
 import shutil
 import tempfile
+import threading
+
+from six.moves import queue
 
 import numpy as np
 import numpy.random as npr
@@ -8,36 +11,258 @@ import torch
 
 from torch.utils.data.dataset import Dataset
 
+# How TTensorDictDataset.shuffle_ shuffles:
+# - copy: gathers every tensor through a permutation. Simple, but briefly holds a second copy of
+#     the whole dataset.
+# - index: only permutes an index; reads gather the rows they need (e.g. one batch at a time).
+# - blocks: moves blocks of `block_size` consecutive rows to random places, one block at a time,
+#     then shuffles the rows within each block. Works in place with one block of scratch space, but
+#     rows from the same block stay close to each other, and the last len % block_size rows, which
+#     do not fill a block, are only shuffled among themselves and always stay at the end.
+SHUFFLE_STRATEGIES = ['copy', 'index', 'blocks']
+
 class TTensorDictDataset(Dataset):
-  def __init__(self, tensors, in_place_shuffle = True):
+  def __init__(self, tensors, in_place_shuffle = True, shuffle = 'copy', block_size = 4096):
     super(TTensorDictDataset, self).__init__()
+    assert shuffle in SHUFFLE_STRATEGIES, shuffle
     self.in_place_shuffle = in_place_shuffle
+    self.shuffle = shuffle
+    self.block_size = block_size
 
     self._tensors = tensors
     self._size = next(iter(tensors.values())).shape[0]
+    self._perm = None
 
   def __getitem__(self, index):
+    if self._perm is not None:
+      if isinstance(index, torch.Tensor):
+        index = index.long()
+      index = self._perm[index]
     return {k: self._tensors[k][index] for k in self._tensors}
 
   def __len__(self):
     return self._size
 
   def shuffle_(self):
+    if self.shuffle == 'index':
+      self._perm = torch.randperm(len(self))
+    elif self.shuffle == 'blocks':
+      self._shuffle_blocks()
+    else:
+      self._shuffle_copy()
+
+  def _shuffle_copy(self):
     perm = torch.randperm(len(self))
     for k in self._tensors:
       self._tensors[k] = self._tensors[k][perm]
 
+  def _shuffle_blocks(self):
+    n = len(self)
+    size = self.block_size
+    num_blocks = n // size
+    perm = npr.permutation(num_blocks)
+    for v in self._tensors.values():
+      # Follow the cycles of the block permutation, so each block is written exactly once.
+      visited = np.zeros(num_blocks, dtype = bool)
+      for start in range(num_blocks):
+        if visited[start]:
+          continue
+        scratch = v[start * size:(start + 1) * size].clone()
+        dst = start
+        visited[dst] = True
+        while perm[dst] != start:
+          src = perm[dst]
+          v[dst * size:(dst + 1) * size] = v[src * size:(src + 1) * size]
+          visited[src] = True
+          dst = src
+        v[dst * size:(dst + 1) * size] = scratch
+
+    # Then shuffle within blocks (the tail that does not fill a block is a block of its own).
+    for start in range(0, n, size):
+      end = min(start + size, n)
+      perm = torch.randperm(end - start)
+      for v in self._tensors.values():
+        v[start:end] = v[start:end][perm]
+
 class NDArrayDictDataset(TTensorDictDataset):
-  def __init__(self, ndarrays, in_place_shuffle = True):
+  def __init__(self, ndarrays, in_place_shuffle = True, shuffle = 'copy', block_size = 4096):
     super(NDArrayDictDataset, self).__init__(
-        {k: torch.from_numpy(v) for k, v in ndarrays.items()}, in_place_shuffle)
+        {k: torch.from_numpy(v) for k, v in ndarrays.items()}, in_place_shuffle,
+        shuffle = shuffle, block_size = block_size)
     self._ndarrays = ndarrays
 
-  def shuffle_(self):
+  def _shuffle_copy(self):
     perm = npr.permutation(len(self))
     for v in self._ndarrays.values():
       np.take(v, perm, axis = 0, out = v)
 
+class ConcatNDArrayDictDataset(Dataset):
+  '''Presents several dicts of parallel ndarrays (e.g. memory-mapped rollups) as one dataset.
+
+  Nothing is concatenated or copied up front: shuffle_ only permutes an index, and indexing
+  gathers just the requested rows from each part.
+  '''
+  def __init__(self, parts, in_place_shuffle = True):
+    super(ConcatNDArrayDictDataset, self).__init__()
+    self.in_place_shuffle = in_place_shuffle
+
+    self._parts = [p for p in parts if len(next(iter(p.values())))]
+    keys = set(self._parts[0].keys())
+    for part in self._parts:
+      assert set(part.keys()) == keys, (sorted(part.keys()), sorted(keys))
+    self._keys = sorted(keys)
+
+    sizes = [len(next(iter(p.values()))) for p in self._parts]
+    self._offsets = np.cumsum([0] + sizes)
+    self._size = int(self._offsets[-1])
+    self._perm = None
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      idxs = np.arange(self._size)[index] if self._perm is None else self._perm[index]
+      return self._gather(idxs)
+    if isinstance(index, (np.ndarray, torch.Tensor)):
+      idxs = np.asarray(index)
+      return self._gather(idxs if self._perm is None else self._perm[idxs])
+    if self._perm is not None:
+      index = self._perm[index]
+    part_idx = np.searchsorted(self._offsets, index, side = 'right') - 1
+    part = self._parts[part_idx]
+    row = index - self._offsets[part_idx]
+    return {k: torch.from_numpy(np.array(part[k][row])) for k in self._keys}
+
+  def __len__(self):
+    return self._size
+
+  def shuffle_(self):
+    self._perm = npr.permutation(self._size)
+
+  def _gather(self, idxs):
+    # Reading rows in order is much kinder to memory-mapped parts; they are put back in the
+    # requested order afterwards.
+    order = None
+    if np.any(idxs[1:] < idxs[:-1]):
+      order = np.argsort(idxs, kind = 'stable')
+      idxs = idxs[order]
+    part_idxs = np.searchsorted(self._offsets, idxs, side = 'right') - 1
+    bounds = np.searchsorted(part_idxs, np.arange(len(self._parts) + 1))
+
+    rv = {}
+    for k in self._keys:
+      chunks = [
+          part[k][idxs[bounds[i]:bounds[i + 1]] - self._offsets[i]]
+          for i, part in enumerate(self._parts)
+          if bounds[i] < bounds[i + 1]]
+      if len(chunks) == 1:
+        rows = np.asarray(chunks[0])
+      else:
+        rows = np.concatenate(chunks or [self._parts[0][k][:0]])
+      if order is not None:
+        unsorted = np.empty_like(rows)
+        unsorted[order] = rows
+        rows = unsorted
+      rv[k] = torch.from_numpy(rows)
+    return rv
+
+def shard(dataset, rank, num_shards):
+  '''Returns the `rank`th of `num_shards` equal, contiguous slices of a TTensorDictDataset or
+  ConcatNDArrayDictDataset, as a dataset of the same kind.
+
+  Rows that do not divide evenly are left out, so every shard has the same length. Tensors and
+  arrays are sliced, not copied.
+  '''
+  size = len(dataset) // num_shards
+  start = rank * size
+  end = start + size
+
+  if isinstance(dataset, TTensorDictDataset):
+    assert dataset._perm is None, 'cannot shard a dataset shuffled by index'
+    return TTensorDictDataset(
+        {k: v[start:end] for k, v in dataset._tensors.items()},
+        dataset.in_place_shuffle,
+        shuffle = dataset.shuffle,
+        block_size = dataset.block_size)
+
+  if isinstance(dataset, ConcatNDArrayDictDataset):
+    assert dataset._perm is None, 'cannot shard a shuffled dataset'
+    parts = []
+    for part, offset in zip(dataset._parts, dataset._offsets):
+      lo = max(start - offset, 0)
+      hi = max(end - offset, 0)
+      parts.append({k: v[lo:hi] for k, v in part.items()})
+    return ConcatNDArrayDictDataset(parts, dataset.in_place_shuffle)
+
+  raise TypeError('Cannot shard a %s' % type(dataset).__name__)
+
+def supports_batches(dataset):
+  '''Whether `dataset[idx]` returns whole batches for slices and index arrays (see iterate_batches).'''
+  return isinstance(dataset, (TTensorDictDataset, ConcatNDArrayDictDataset))
+
+def iterate_batches(dataset, batch_size, drop_last = True, prefetch = False):
+  '''Yields random batches (dicts of tensors) from a dataset for which supports_batches holds.
+
+  Batches are read from the dataset whole, never collated from single examples. A dataset that
+  shuffles in place is shuffled once and read in consecutive slices, which for tensor-backed
+  datasets are views; any other is read through a random permutation. With prefetch, the next batch
+  is read in a background thread while the current one is in use.
+  '''
+  size = len(dataset)
+  if getattr(dataset, 'in_place_shuffle', False):
+    dataset.shuffle_()
+    perm = None
+  else:
+    perm = torch.randperm(size)
+
+  def batches():
+    for start in range(0, size, batch_size):
+      end = min(start + batch_size, size)
+      if drop_last and end - start < batch_size:
+        break
+      if perm is None:
+        yield dataset[start:end]
+      else:
+        yield dataset[perm[start:end]]
+
+  if not prefetch:
+    return batches()
+  return _prefetch(batches())
+
+def _prefetch(itr):
+  # Holds at most one batch besides the one being used.
+  q = queue.Queue(maxsize = 1)
+  done = object()
+  stop = threading.Event()
+
+  def fill():
+    try:
+      for batch in itr:
+        q.put(batch)
+        if stop.is_set():
+          return
+      q.put(done)
+    except Exception as e:
+      q.put(e)
+
+  thread = threading.Thread(target = fill)
+  thread.daemon = True
+  thread.start()
+
+  try:
+    while True:
+      batch = q.get()
+      if batch is done:
+        break
+      if isinstance(batch, Exception):
+        raise batch
+      yield batch
+  finally:
+    stop.set()
+    while thread.is_alive():
+      try:
+        q.get_nowait()
+      except queue.Empty:
+        thread.join(0.01)
+
 class MemmapDictDataset(Dataset):
   def __init__(self, npzfile):
     self.dirname = tempfile.mkdtemp()
@@ -0,0 +1,94 @@
+import unittest
+
+import numpy as np
+
+import torch
+
+from metagrok.torch_utils import data
+from metagrok.torch_utils.data import ConcatNDArrayDictDataset, NDArrayDictDataset
+
+class ConcatNDArrayDictDatasetTest(unittest.TestCase):
+  def test_matches_concatenation(self):
+    parts = [
+        dict(x = np.arange(n * 2, dtype = 'float32').reshape(n, 2) + 100 * i, y = np.arange(n) + 100 * i)
+        for i, n in enumerate([5, 0, 3, 7])]
+    expected = {k: np.concatenate([p[k] for p in parts]) for k in ['x', 'y']}
+
+    dataset = ConcatNDArrayDictDataset(parts)
+    self.assertEqual(15, len(dataset))
+
+    batch = dataset[2:9]
+    for k in ['x', 'y']:
+      self.assertTrue(np.array_equal(expected[k][2:9], batch[k].numpy()))
+    self.assertTrue(np.array_equal(expected['x'][11], dataset[11]['x'].numpy()))
+
+    dataset.shuffle_()
+    seen = np.concatenate([dataset[i:i + 4]['y'].numpy() for i in range(0, 15, 4)])
+    self.assertListEqual(sorted(expected['y'].tolist()), sorted(seen.tolist()))
+    for i in [0, 7, 14]:
+      row = dataset[i]
+      j = list(expected['y']).index(row['y'].item())
+      self.assertTrue(np.array_equal(expected['x'][j], row['x'].numpy()))
+
+  def test_index_order(self):
+    parts = [dict(y = np.arange(5)), dict(y = np.arange(5, 12))]
+    dataset = ConcatNDArrayDictDataset(parts)
+    idxs = np.asarray([9, 2, 11, 0, 2, 6])
+    self.assertListEqual(idxs.tolist(), dataset[idxs]['y'].tolist())
+    self.assertListEqual([9, 2], dataset[torch.tensor([9, 2])]['y'].tolist())
+
+class ShuffleTest(unittest.TestCase):
+  def test_strategies(self):
+    for shuffle in data.SHUFFLE_STRATEGIES:
+      x = np.arange(46, dtype = 'float32').reshape(23, 2)
+      dataset = NDArrayDictDataset(dict(x = x, y = np.arange(23)), shuffle = shuffle, block_size = 4)
+      dataset.shuffle_()
+      batch = dataset[0:23]
+      self.assertListEqual(list(range(23)), sorted(batch['y'].tolist()), shuffle)
+      self.assertTrue(np.array_equal(batch['x'][:, 0].numpy(), 2 * batch['y'].numpy()), shuffle)
+      self.assertNotEqual(list(range(23)), batch['y'].tolist(), shuffle)
+
+class IterateBatchesTest(unittest.TestCase):
+  def _check(self, dataset, prefetch):
+    batches = list(data.iterate_batches(dataset, 4, prefetch = prefetch))
+    self.assertEqual(3, len(batches))
+    ys = torch.cat([b['y'] for b in batches]).numpy()
+    self.assertEqual(12, len(set(ys.tolist())))
+    for b in batches:
+      self.assertTrue(np.array_equal(b['x'][:, 0].numpy(), 2 * b['y'].numpy().astype('float32')))
+
+  def test_in_place_shuffle(self):
+    for prefetch in [False, True]:
+      dataset = NDArrayDictDataset(dict(
+          x = np.arange(30, dtype = 'float32').reshape(15, 2), y = np.arange(15)))
+      self._check(dataset, prefetch)
+
+  def test_permutation(self):
+    for prefetch in [False, True]:
+      dataset = ConcatNDArrayDictDataset([
+          dict(x = np.arange(20, dtype = 'float32').reshape(10, 2), y = np.arange(10)),
+          dict(x = np.arange(20, 30, dtype = 'float32').reshape(5, 2), y = np.arange(10, 15))],
+          in_place_shuffle = False)
+      self._check(dataset, prefetch)
+
+  def test_views(self):
+    dataset = NDArrayDictDataset(dict(x = np.zeros((8, 2), dtype = 'float32'), y = np.arange(8)))
+    batch = next(data.iterate_batches(dataset, 4))
+    batch['x'] += 1.
+    self.assertEqual(8., dataset._ndarrays['x'].sum())
+
+class ShardTest(unittest.TestCase):
+  def test_shards(self):
+    parts = [dict(y = np.arange(10)), dict(y = np.arange(10, 15)), dict(y = np.arange(15, 23))]
+    datasets = [
+        data.TTensorDictDataset(dict(y = torch.arange(23))),
+        ConcatNDArrayDictDataset(parts),
+    ]
+    for dataset in datasets:
+      shards = [data.shard(dataset, rank, 3) for rank in range(3)]
+      self.assertListEqual([7, 7, 7], [len(s) for s in shards])
+      ys = [s[0:7]['y'].tolist() for s in shards]
+      self.assertListEqual(list(range(21)), sum(ys, []))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -7,7 +7,9 @@ import datetime
 import errno
 import functools
 import fnmatch
+import hashlib
 import importlib
+import inspect
 import logging
 import os
 import random
@@ -230,4 +232,66 @@ def memory_dump(fname):
 
 def touch(path):
   with open(path, 'a'):
-    os.utime(path, None)
\ No newline at end of file
+    os.utime(path, None)
+
+def fingerprint(obj):
+  '''Returns a hex digest that is stable across processes, and changes when `obj` does.
+
+  Functions are identified by their name, their source code and the values they close over, and
+  functools.partial objects by their function and arguments. Other objects are identified by their
+  type, the source of its class and their attributes (`__dict__`); what none of these reach, e.g.
+  the contents of arrays or of other modules, is not covered.
+  '''
+  h = hashlib.sha1()
+  _fingerprint_into(obj, h, set())
+  return h.hexdigest()
+
+def _fingerprint_into(obj, h, seen):
+  if obj is None or isinstance(obj, (bool, int, float, six.string_types, bytes)):
+    h.update(repr(obj).encode('utf-8'))
+  elif isinstance(obj, (list, tuple)):
+    h.update(('%s[' % type(obj).__name__).encode('utf-8'))
+    for v in obj:
+      _fingerprint_into(v, h, seen)
+    h.update(b']')
+  elif isinstance(obj, dict):
+    h.update(b'{')
+    for k in sorted(obj, key = repr):
+      _fingerprint_into(k, h, seen)
+      _fingerprint_into(obj[k], h, seen)
+    h.update(b'}')
+  elif inspect.isfunction(obj) or inspect.ismethod(obj):
+    h.update(('%s.%s' % (obj.__module__, obj.__qualname__)).encode('utf-8'))
+    if id(obj) in seen:
+      return
+    seen.add(id(obj))
+    _source_into(obj, h)
+    for cell in getattr(obj, '__closure__', None) or ():
+      try:
+        contents = cell.cell_contents
+      except ValueError:
+        continue
+      _fingerprint_into(contents, h, seen)
+  elif isinstance(obj, functools.partial):
+    h.update(b'partial(')
+    _fingerprint_into(obj.func, h, seen)
+    _fingerprint_into(obj.args, h, seen)
+    _fingerprint_into(obj.keywords, h, seen)
+    h.update(b')')
+  elif isinstance(obj, type):
+    h.update(('%s.%s' % (obj.__module__, obj.__qualname__)).encode('utf-8'))
+  else:
+    cls = type(obj)
+    h.update(('<%s.%s>' % (cls.__module__, cls.__qualname__)).encode('utf-8'))
+    if id(obj) in seen:
+      return
+    seen.add(id(obj))
+    _source_into(cls, h)
+    if isinstance(getattr(obj, '__dict__', None), dict):
+      _fingerprint_into(obj.__dict__, h, seen)
+
+def _source_into(obj, h):
+  try:
+    h.update(inspect.getsource(obj).encode('utf-8'))
+  except (IOError, TypeError):
+    pass